@@ -1,5 +1,8 @@
 from django.contrib import admin
-from .models import CustomUser, AIUsageLog, UserAIQuota
+from .models import CustomUser, AIUsageLog, AIUsageRollup, ProfilingRule, UserAIQuota
+from .profiling import profiling_rules
+from .quota import quota_counter
+from .throttling import invalidate_user_plan
 
 # Register your models here.
 admin.site.register(CustomUser)
@@ -7,10 +10,10 @@ admin.site.register(CustomUser)
 
 @admin.register(AIUsageLog)
 class AIUsageLogAdmin(admin.ModelAdmin):
-    list_display = ['user', 'endpoint', 'status_code', 'duration', 'ip_address', 'created_at']
+    list_display = ['user', 'endpoint', 'status_code', 'duration', 'prompt_tokens', 'ip_address', 'created_at']
     list_filter = ['endpoint', 'status_code', 'created_at']
     search_fields = ['user__username', 'ip_address', 'endpoint']
-    readonly_fields = ['user', 'endpoint', 'duration', 'status_code', 'ip_address', 'user_agent', 'created_at']
+    readonly_fields = ['user', 'endpoint', 'duration', 'status_code', 'prompt_tokens', 'ip_address', 'user_agent', 'created_at']
     date_hierarchy = 'created_at'
     
     def has_add_permission(self, request):
@@ -20,12 +23,26 @@ class AIUsageLogAdmin(admin.ModelAdmin):
         return False  # Logs should not be edited
 
 
+@admin.register(AIUsageRollup)
+class AIUsageRollupAdmin(admin.ModelAdmin):
+    list_display = ['hour', 'user', 'endpoint', 'ip_bucket', 'status_class', 'count', 'duration_sum']
+    list_filter = ['endpoint', 'status_class', 'hour']
+    search_fields = ['user__username', 'ip_bucket', 'endpoint']
+    date_hierarchy = 'hour'
+    
+    def has_add_permission(self, request):
+        return False  # Built from AIUsageLog
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(UserAIQuota)
 class UserAIQuotaAdmin(admin.ModelAdmin):
-    list_display = ['user', 'daily_usage', 'daily_limit', 'monthly_usage', 'monthly_limit', 'is_premium']
+    list_display = ['user', 'current_daily_usage', 'daily_limit', 'current_monthly_usage', 'monthly_limit', 'is_premium']
     list_filter = ['is_premium', 'last_reset_date']
     search_fields = ['user__username', 'user__email']
-    readonly_fields = ['daily_usage', 'monthly_usage', 'last_reset_date']
+    readonly_fields = ['current_daily_usage', 'current_monthly_usage', 'last_reset_date']
     
     fieldsets = (
         ('User', {
@@ -35,28 +52,52 @@ class UserAIQuotaAdmin(admin.ModelAdmin):
             'fields': ('daily_limit', 'monthly_limit')
         }),
         ('Usage', {
-            'fields': ('daily_usage', 'monthly_usage', 'last_reset_date')
+            'fields': ('current_daily_usage', 'current_monthly_usage', 'last_reset_date')
         }),
     )
     
     actions = ['reset_daily_quota', 'reset_monthly_quota', 'make_premium', 'remove_premium']
     
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        invalidate_user_plan([obj.user_id])
+    
     def reset_daily_quota(self, request, queryset):
+        quota_counter.reset(queryset.values_list('user_id', flat=True), daily=True)
         count = queryset.update(daily_usage=0)
         self.message_user(request, f'{count} user(s) daily quota reset.')
     reset_daily_quota.short_description = "Reset daily quota"
     
     def reset_monthly_quota(self, request, queryset):
+        quota_counter.reset(queryset.values_list('user_id', flat=True), daily=False, monthly=True)
         count = queryset.update(monthly_usage=0)
         self.message_user(request, f'{count} user(s) monthly quota reset.')
     reset_monthly_quota.short_description = "Reset monthly quota"
     
     def make_premium(self, request, queryset):
+        # Before the update: it can take rows out of a filtered queryset
+        user_ids = list(queryset.values_list('user_id', flat=True))
         count = queryset.update(is_premium=True)
+        invalidate_user_plan(user_ids)
         self.message_user(request, f'{count} user(s) upgraded to premium.')
     make_premium.short_description = "Make premium"
     
     def remove_premium(self, request, queryset):
+        # Before the update: it can take rows out of a filtered queryset
+        user_ids = list(queryset.values_list('user_id', flat=True))
         count = queryset.update(is_premium=False)
+        invalidate_user_plan(user_ids)
         self.message_user(request, f'{count} user(s) downgraded from premium.')
-    remove_premium.short_description = "Remove premium"
\ No newline at end of file
+    remove_premium.short_description = "Remove premium"
+
+
+@admin.register(ProfilingRule)
+class ProfilingRuleAdmin(admin.ModelAdmin):
+    list_display = ['url_name', 'method', 'sample_every', 'enabled', 'updated_at']
+    list_filter = ['enabled']
+    list_editable = ['sample_every', 'enabled']
+    
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # Other workers pick it up within PROFILING['rules_ttl']
+        profiling_rules.clear()
@@ -0,0 +1,163 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from .redis_client import LuaScript, get_redis_client
+from .rollups import hour_of, ip_bucket
+from .sketches import HyperLogLog, TopK
+
+KINDS = ('user', 'ip')
+
+# Space-Saving update of a sorted set, see sketches.TopK
+# KEYS: sorted set
+# ARGV: capacity, ttl, then item, count pairs
+TOP_K_ADD = LuaScript("""
+local capacity = tonumber(ARGV[1])
+for i = 3, #ARGV, 2 do
+    local item, count = ARGV[i], tonumber(ARGV[i + 1])
+    if redis.call('ZSCORE', KEYS[1], item) or redis.call('ZCARD', KEYS[1]) < capacity then
+        redis.call('ZINCRBY', KEYS[1], count, item)
+    else
+        local smallest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+        redis.call('ZREM', KEYS[1], smallest[1])
+        redis.call('ZADD', KEYS[1], tonumber(smallest[2]) + count, item)
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+""")
+
+
+class UsageAnalytics:
+    """
+    Approximate per-hour usage analytics in the cache
+
+    For every hour: a request counter, distinct users and IP buckets
+    (HyperLogLog) and the heaviest users and IPs (Space-Saving top-k).
+    Each is fixed-size, so "unique IPs this week" or "top 10 users" costs
+    the same whatever the traffic, and hours combine into any period.
+    Registered as a UsageLogBuffer listener; read by
+    `ai_usage_report --fast`.
+
+    On Redis these are native HLLs (PFADD, PFCOUNT over several hours)
+    and sorted sets kept to `top_capacity` items by a Lua script. Other
+    caches store the pure-Python HyperLogLog and TopK; updates there are
+    read-modify-write and may lose a concurrent batch, which is within
+    the error these sketches already have.
+    """
+
+    @property
+    def config(self):
+        return settings.AI_USAGE_ANALYTICS
+
+    def _key(self, name, hour):
+        return f'usage_analytics:{name}:{hour:%Y%m%d%H}'
+
+    def _hours(self, start, end):
+        hour, last = hour_of(start), hour_of(end)
+        while hour <= last:
+            yield hour
+            hour += timedelta(hours=1)
+
+    def record(self, logs):
+        config = self.config
+        if not config['enabled']:
+            return
+
+        hours = {}
+        for log in logs:
+            bucket = hours.setdefault(hour_of(log.created_at), {
+                'requests': 0, 'user': {}, 'ip': {}
+            })
+            bucket['requests'] += 1
+            for kind, value in (('user', log.user_id), ('ip', ip_bucket(log.ip_address))):
+                if value is not None:
+                    bucket[kind][value] = bucket[kind].get(value, 0) + 1
+
+        ttl = config['ttl_days'] * 24 * 60 * 60
+        client = get_redis_client()
+        if client is not None:
+            pipe = client.pipeline(transaction=False)
+            for hour, bucket in hours.items():
+                requests_key = cache.make_key(self._key('requests', hour))
+                pipe.incrby(requests_key, bucket['requests'])
+                pipe.expire(requests_key, ttl)
+                for kind in KINDS:
+                    if bucket[kind]:
+                        unique_key = cache.make_key(self._key(f'unique:{kind}', hour))
+                        pipe.pfadd(unique_key, *bucket[kind])
+                        pipe.expire(unique_key, ttl)
+            pipe.execute()
+            for hour, bucket in hours.items():
+                for kind in KINDS:
+                    if bucket[kind]:
+                        args = [config['top_capacity'], ttl]
+                        for value, count in bucket[kind].items():
+                            args += [value, count]
+                        TOP_K_ADD(client, keys=[self._key(f'top:{kind}', hour)], args=args)
+            return
+
+        for hour, bucket in hours.items():
+            requests_key = self._key('requests', hour)
+            cache.add(requests_key, 0, ttl)
+            cache.incr(requests_key, bucket['requests'])
+
+            keys = [self._key(f'{name}:{kind}', hour) for kind in KINDS for name in ('unique', 'top')]
+            stored = cache.get_many(keys)
+            updated = {}
+            for kind in KINDS:
+                unique_key, top_key = self._key(f'unique:{kind}', hour), self._key(f'top:{kind}', hour)
+                unique = stored.get(unique_key) or HyperLogLog()
+                top = stored.get(top_key) or TopK(config['top_capacity'])
+                for value, count in bucket[kind].items():
+                    unique.add(value)
+                    top.add(value, count)
+                updated[unique_key], updated[top_key] = unique, top
+            cache.set_many(updated, ttl)
+
+    def requests(self, start, end):
+        """Requests logged in the hours from `start` to `end`"""
+        keys = [self._key('requests', hour) for hour in self._hours(start, end)]
+        client = get_redis_client()
+        if client is not None:
+            return sum(int(value or 0) for value in client.mget([cache.make_key(key) for key in keys]))
+        return sum(cache.get_many(keys).values())
+
+    def unique(self, kind, start, end):
+        """Approximate distinct users ('user') or IP buckets ('ip') from `start` to `end`"""
+        keys = [self._key(f'unique:{kind}', hour) for hour in self._hours(start, end)]
+        client = get_redis_client()
+        if client is not None:
+            # PFCOUNT over several keys counts their union
+            return client.pfcount(*[cache.make_key(key) for key in keys])
+
+        merged = HyperLogLog()
+        for sketch in cache.get_many(keys).values():
+            merged.merge(sketch)
+        return merged.count()
+
+    def top(self, kind, start, end, n=10):
+        """Approximate [(value, count)] of the `n` heaviest users or IP buckets"""
+        keys = [self._key(f'top:{kind}', hour) for hour in self._hours(start, end)]
+        merged = TopK(self.config['top_capacity'])
+        client = get_redis_client()
+        if client is not None:
+            pipe = client.pipeline(transaction=False)
+            for key in keys:
+                pipe.zrange(cache.make_key(key), 0, -1, withscores=True)
+            for items in pipe.execute():
+                merged.merge(TopK(counts={
+                    value.decode() if isinstance(value, bytes) else value: int(score)
+                    for value, score in items
+                }))
+        else:
+            for sketch in cache.get_many(keys).values():
+                merged.merge(sketch)
+
+        top = merged.top(n)
+        if kind == 'user':
+            # Redis hands members back as strings
+            top = [(int(value), count) for value, count in top]
+        return top
+
+
+usage_analytics = UsageAnalytics()
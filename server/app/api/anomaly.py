@@ -0,0 +1,193 @@
+import logging
+import math
+import threading
+import time
+from collections import namedtuple
+from django.conf import settings
+from django.core.cache import cache
+from .redis_client import LuaScript, get_redis_client
+from .rollups import ip_bucket
+
+logger = logging.getLogger(__name__)
+
+# KEYS: per subject, previous and current window request counters, then
+#       previous and current window error counters
+# ARGV: counter ttl, then per subject: requests, errors
+OBSERVE = LuaScript("""
+local result = {}
+for i = 0, #KEYS / 4 - 1 do
+    local requests = redis.call('INCRBY', KEYS[i * 4 + 2], ARGV[i * 2 + 2])
+    redis.call('EXPIRE', KEYS[i * 4 + 2], ARGV[1])
+    local errors = redis.call('INCRBY', KEYS[i * 4 + 4], ARGV[i * 2 + 3])
+    redis.call('EXPIRE', KEYS[i * 4 + 4], ARGV[1])
+    result[#result + 1] = tonumber(redis.call('GET', KEYS[i * 4 + 1]) or '0')
+    result[#result + 1] = requests
+    result[#result + 1] = tonumber(redis.call('GET', KEYS[i * 4 + 3]) or '0')
+    result[#result + 1] = errors
+end
+return result
+""")
+
+
+# A request refused before the view (by a throttle or the IP limit), which
+# never reaches the usage logs
+Rejection = namedtuple('Rejection', ['user_id', 'ip_address', 'status_code'])
+
+
+def _blocklist_key(kind, value):
+    return f'blocklist:{kind}:{value}'
+
+
+def block(kind, value, seconds, reason):
+    """Block a 'user' (id) or 'ip' (ip_bucket) for `seconds`"""
+    cache.set(_blocklist_key(kind, value), {'reason': reason, 'until': time.time() + seconds}, seconds)
+
+
+def blocked(kind, value):
+    """
+    The block entry ({'reason', 'until'}) for a user id or IP bucket, or
+    None. A single cache GET, cheap enough for every AI request.
+    """
+    if value is None:
+        return None
+    return cache.get(_blocklist_key(kind, value))
+
+
+def unblock(kind, value):
+    cache.delete(_blocklist_key(kind, value))
+
+
+class AnomalyDetector:
+    """
+    Flags users and IPs from the stream of AI usage logs
+
+    Registered as a UsageLogBuffer listener, so it sees each batch within
+    a flush interval of the requests. Keeps sliding-window request and
+    error counters per user and per IP bucket in the cache (one Lua
+    script call per batch on Redis; the previous window is weighted by
+    its overlap, as in SlidingWindowLimiter). A subject over
+    AI_ANOMALY_DETECTION's request or error-rate thresholds is logged
+    and put on the blocklist, which IPRateLimitMiddleware (IPs) and
+    require_verified_user (users) check on every AI request.
+
+    Requests refused before the view are counted too, through `reject`:
+    without them a client hammering through its 429s would never get past
+    what the throttles let through.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._rejections = []
+        self._rejections_since = clock()
+        self._lock = threading.Lock()
+
+    @property
+    def config(self):
+        return settings.AI_ANOMALY_DETECTION
+
+    def reject(self, user_id, ip_address):
+        """
+        Count a request refused by a throttle or the IP limit. Kept in this
+        worker and counted with the next batch, or on its own once
+        `rejection_interval` seconds have passed, so a flood of refusals
+        costs one counter update per interval rather than per request.
+        """
+        config = self.config
+        if not config['enabled']:
+            return
+        with self._lock:
+            self._rejections.append(Rejection(user_id, ip_address, 429))
+            if self.clock() - self._rejections_since < config['rejection_interval']:
+                return
+        self.observe([])
+
+    def discard(self):
+        """Drop refused requests not counted yet (tests)"""
+        with self._lock:
+            self._rejections = []
+
+    def observe(self, logs):
+        """Count a batch of usage logs. Returns the (kind, value, reason) newly blocked"""
+        config = self.config
+        if not config['enabled']:
+            return []
+
+        with self._lock:
+            rejections, self._rejections = self._rejections, []
+            self._rejections_since = self.clock()
+
+        batch = {}
+        for log in [*logs, *rejections]:
+            # 5xx only: a 429 or other 4xx means a throttle or validation already did its job
+            error = log.status_code >= 500
+            for subject in (('user', log.user_id), ('ip', ip_bucket(log.ip_address))):
+                if subject[1] is None:
+                    continue
+                counts = batch.setdefault(subject, [0, 0])
+                counts[0] += 1
+                counts[1] += error
+        if not batch:
+            return []
+
+        flagged = []
+        for (kind, value), (requests, errors) in self._count(batch, config['window']).items():
+            reason = self._check(kind, requests, errors, config)
+            if reason is None or blocked(kind, value) is not None:
+                continue
+            block(kind, value, config['block_seconds'], reason)
+            logger.warning(f"AI Anomaly - Blocked {kind} {value} for {config['block_seconds']}s: {reason}")
+            flagged.append((kind, value, reason))
+        return flagged
+
+    def _check(self, kind, requests, errors, config):
+        limit = config[f'{kind}_requests']
+        if requests >= limit:
+            return f'{requests:.0f} requests in the last {config["window"]}s (limit {limit})'
+        if requests >= config['min_requests'] and errors / requests > config['error_rate']:
+            return f'error rate {errors / requests:.0%} over {requests:.0f} requests'
+        return None
+
+    def _count(self, batch, window):
+        """Add the batch to the counters; sliding-window (requests, errors) per subject"""
+        now = self.clock()
+        index = math.floor(now / window)
+        weight = 1 - (now / window - index)
+        subjects = list(batch)
+        keys = []
+        for kind, value in subjects:
+            prefix = f'anomaly:{kind}:{value}'
+            keys += [
+                f'{prefix}:requests:{index - 1}', f'{prefix}:requests:{index}',
+                f'{prefix}:errors:{index - 1}', f'{prefix}:errors:{index}',
+            ]
+
+        client = get_redis_client()
+        if client is not None:
+            args = [2 * window]
+            for subject in subjects:
+                args += batch[subject]
+            values = [int(value) for value in OBSERVE(client, keys=keys, args=args)]
+        else:
+            previous = cache.get_many(keys[0::2])
+            values = []
+            for i, subject in enumerate(subjects):
+                requests, errors = batch[subject]
+                current = []
+                for key, amount in ((keys[i * 4 + 1], requests), (keys[i * 4 + 3], errors)):
+                    cache.add(key, 0, 2 * window)
+                    current.append(cache.incr(key, amount) if amount else cache.get(key, 0))
+                values += [
+                    previous.get(keys[i * 4], 0), current[0],
+                    previous.get(keys[i * 4 + 2], 0), current[1],
+                ]
+
+        return {
+            subject: (
+                values[i * 4] * weight + values[i * 4 + 1],
+                values[i * 4 + 2] * weight + values[i * 4 + 3],
+            )
+            for i, subject in enumerate(subjects)
+        }
+
+
+anomaly_detector = AnomalyDetector()
@@ -4,3 +4,17 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from django.db.models.signals import post_delete
+        from .analytics import usage_analytics
+        from .anomaly import anomaly_detector
+        from .chat_context import chat_message_deleted
+        from .models import ChatMessage
+        from .rollups import record_rollups
+        from .usage_log import usage_log_buffer
+        usage_log_buffer.add_listener(record_rollups)
+        usage_log_buffer.add_listener(anomaly_detector.observe)
+        usage_log_buffer.add_listener(usage_analytics.record)
+        # Deleted turns must not live on in the summary or the caches
+        post_delete.connect(chat_message_deleted, sender=ChatMessage)
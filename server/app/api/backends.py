@@ -0,0 +1,301 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import defaultdict
+import requests
+from django.conf import settings
+from .deadline import get_current_deadline
+from .hedging import Hedger, LatencyTracker
+from .metrics import AI_UPSTREAM_DURATION
+from .retry import RetryBudget, RetryPolicy, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+
+class BackendStats:
+    """Latency and throughput of one backend for one endpoint (per worker)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = LatencyTracker(window=500)
+        self.calls = 0
+        self.failures = 0
+        self.busy_seconds = 0.0
+        self.output_chars = 0
+
+    def record(self, duration, output_chars=0, failed=False):
+        self.latency.record(duration)
+        with self._lock:
+            self.calls += 1
+            self.failures += int(failed)
+            self.busy_seconds += duration
+            self.output_chars += output_chars
+
+    def snapshot(self):
+        with self._lock:
+            calls, failures = self.calls, self.failures
+            busy, chars = self.busy_seconds, self.output_chars
+        return {
+            'calls': calls,
+            'failures': failures,
+            'avg_latency': busy / calls if calls else 0,
+            'p50_latency': self.latency.percentile(50) or 0,
+            'p95_latency': self.latency.percentile(95) or 0,
+            # While busy, how fast this backend turns requests into text
+            'calls_per_second': calls / busy if busy else 0,
+            'chars_per_second': chars / busy if busy else 0,
+        }
+
+
+class InferenceBackend:
+    """
+    Text generation backend used by HuggingFaceAI
+
+    `generate` returns the Inference API response shape
+    (`[{'generated_text': ...}]`) or None when nothing usable came back,
+    in which case the caller serves its fallback.
+    """
+
+    name = None
+
+    def __init__(self):
+        self.stats = defaultdict(BackendStats)
+
+    def generate(self, model, prompt, parameters, deadline=None, endpoint=None, **options):
+        start = time.monotonic()
+        result = None
+        try:
+            result = self._generate(model, prompt, parameters, deadline, **options)
+            return result
+        finally:
+            text = ''
+            if isinstance(result, list) and result:
+                text = result[0].get('generated_text') or result[0].get('summary_text') or ''
+            duration = time.monotonic() - start
+            self.stats[endpoint].record(duration, output_chars=len(text), failed=result is None)
+            AI_UPSTREAM_DURATION.observe(
+                duration,
+                backend=self.name,
+                endpoint=endpoint or '',
+                outcome='failed' if result is None else 'ok',
+            )
+
+    def _generate(self, model, prompt, parameters, deadline=None, **options):
+        raise NotImplementedError
+
+    def report(self):
+        return {endpoint: stats.snapshot() for endpoint, stats in self.stats.items()}
+
+
+class RemoteHTTPBackend(InferenceBackend):
+    """Hugging Face router (hf-inference) over HTTP, with retries and optional hedging"""
+
+    name = 'remote'
+
+    def __init__(self):
+        super().__init__()
+        self.api_key = settings.HUGGINGFACE_API_KEY
+        self.api_url = "https://router.huggingface.co/hf-inference/models/"
+        self.timeout = settings.HUGGING_FACE_TIMEOUT
+
+        retry = settings.AI_RETRY_POLICY
+        self.retry_policy = RetryPolicy(
+            max_attempts=retry['max_attempts'],
+            base_delay=retry['base_delay'],
+            max_delay=retry['max_delay'],
+            budget=RetryBudget(retry['budget_ratio'], retry['budget_reserve']),
+        )
+
+        hedging = settings.AI_CHAT_HEDGING
+        self.hedger = Hedger(
+            percentile=hedging['percentile'],
+            min_samples=hedging['min_samples'],
+            initial_delay=hedging['initial_delay'],
+            max_hedge_rate=hedging['max_hedge_rate'],
+        )
+
+    def _upstream_timeout(self, deadline=None):
+        """
+        Timeout for the next upstream call, capped by the request deadline.
+        Returns None when there isn't enough budget left to be worth calling.
+        """
+        deadline = deadline or get_current_deadline()
+        if deadline is None:
+            return self.timeout
+
+        timeout = deadline.cap(self.timeout, reserve=settings.AI_DEADLINE_RESERVE)
+        if timeout < settings.AI_MIN_UPSTREAM_TIMEOUT:
+            return None
+        return timeout
+
+    def _post(self, model, payload, deadline=None, cancel=None):
+        """
+        POST to the inference API, retrying transient failures (429/5xx
+        gateway errors, connection errors) with jittered backoff while the
+        retry budget and the request deadline allow it. Once `cancel` (a
+        threading.Event, set by the Hedger for the losing call) is set, no
+        further attempt is made and no retry budget is spent.
+
+        Returns the last response received, or None if no attempt got one.
+        """
+        policy = self.retry_policy
+        deadline = deadline or get_current_deadline()
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        policy.budget.deposit()
+
+        response = None
+        attempt = 0
+        outcome = 'deadline'
+        while attempt < policy.max_attempts:
+            if cancel is not None and cancel.is_set():
+                outcome = 'cancelled'
+                break
+            timeout = self._upstream_timeout(deadline)
+            if timeout is None:
+                outcome = 'deadline'
+                break
+
+            attempt += 1
+            retry_after = None
+            try:
+                response = requests.post(
+                    f"{self.api_url}{model}",
+                    headers=headers,
+                    json=payload,
+                    timeout=timeout
+                )
+            except requests.RequestException as e:
+                logger.warning(f"Upstream Error - Model: {model}, Attempt: {attempt}, Error: {str(e)}")
+                response = None
+            else:
+                if not policy.is_retryable_status(response.status_code):
+                    outcome = 'success' if response.status_code == 200 else 'error'
+                    break
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+
+            outcome = 'exhausted'
+            if attempt >= policy.max_attempts:
+                break
+
+            delay = policy.backoff(attempt, retry_after)
+            if delay is None:
+                outcome = 'retry_after'
+                break
+            if deadline is not None and (
+                deadline.remaining() - delay - settings.AI_DEADLINE_RESERVE
+                < settings.AI_MIN_UPSTREAM_TIMEOUT
+            ):
+                outcome = 'deadline'
+                break
+            if cancel is not None and cancel.is_set():
+                outcome = 'cancelled'
+                break
+            if not policy.budget.try_spend():
+                outcome = 'budget'
+                break
+            policy.sleep(delay)
+
+        policy.stats.record(attempt, outcome)
+        if attempt != 1:
+            logger.info(f"Upstream Retries - Model: {model}, Attempts: {attempt}, Outcome: {outcome}")
+        return response
+
+    def _generate(self, model, prompt, parameters, deadline=None, hedge=False):
+        payload = {"inputs": prompt, "parameters": parameters}
+
+        if hedge:
+            # Resolve here: context variables don't follow work into the pool threads
+            deadline = deadline or get_current_deadline()
+            response = self.hedger.call(
+                lambda cancel: self._post(model, payload, deadline, cancel=cancel),
+                is_success=lambda r: r is not None and r.status_code == 200,
+                timeout=deadline.remaining() if deadline else None,
+            )
+        else:
+            response = self._post(model, payload, deadline)
+
+        if response is None or response.status_code != 200:
+            return None
+        return response.json()
+
+
+_local_pipelines = {}
+_local_pipelines_lock = threading.Lock()
+
+def _get_local_pipeline(model):
+    """Lazily load and cache a transformers text-generation pipeline on CPU."""
+    with _local_pipelines_lock:
+        if model not in _local_pipelines:
+            from transformers import pipeline
+            _local_pipelines[model] = pipeline('text-generation', model=model, device=-1)
+    return _local_pipelines[model]
+
+
+class LocalTransformersBackend(InferenceBackend):
+    """
+    Small model run in-process with transformers (CPU, see Dockerfile.ai)
+
+    The upstream model name is ignored; AI_LOCAL_MODEL is used instead.
+    Generation can't be interrupted, so it is skipped when the request
+    deadline is already too close.
+    """
+
+    name = 'local'
+
+    def __init__(self):
+        super().__init__()
+        self.model = settings.AI_LOCAL_MODEL
+        self.lock = threading.Lock()
+
+    def _generate(self, model, prompt, parameters, deadline=None, **options):
+        deadline = deadline or get_current_deadline()
+        if deadline is not None and deadline.remaining() - settings.AI_DEADLINE_RESERVE < settings.AI_MIN_UPSTREAM_TIMEOUT:
+            return None
+
+        generator = _get_local_pipeline(self.model)
+        kwargs = {
+            'max_new_tokens': parameters.get('max_length', 200),
+            'do_sample': parameters.get('do_sample', True),
+            'return_full_text': False,
+        }
+        for key in ('temperature', 'top_p'):
+            if key in parameters:
+                kwargs[key] = parameters[key]
+
+        # One generation at a time per worker; torch already uses every core
+        with self.lock:
+            return generator(prompt, **kwargs)
+
+
+class MockBackend(InferenceBackend):
+    """Deterministic canned output for tests, load tests and local development"""
+
+    name = 'mock'
+
+    def _generate(self, model, prompt, parameters, deadline=None, **options):
+        digest = hashlib.sha256(prompt.encode()).hexdigest()[:12]
+        text = f"Bot: [mock {digest}] Thanks for your message. Here is a generated answer."
+        return [{'generated_text': text, 'summary_text': text}]
+
+
+BACKENDS = {
+    RemoteHTTPBackend.name: RemoteHTTPBackend,
+    LocalTransformersBackend.name: LocalTransformersBackend,
+    MockBackend.name: MockBackend,
+}
+
+_backend_instances = {}
+
+def get_backend(name):
+    """Per-worker backend instance, shared so stats and budgets accumulate"""
+    if name not in _backend_instances:
+        try:
+            _backend_instances[name] = BACKENDS[name]()
+        except KeyError:
+            raise ValueError(f"Unknown inference backend: {name}")
+    return _backend_instances[name]
+
+def backend_report():
+    """Latency/throughput of every backend used so far in this worker"""
+    return {name: backend.report() for name, backend in _backend_instances.items()}
@@ -0,0 +1,132 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from .models import ChatSummary
+
+
+class ChatContextCache:
+    """
+    Two-level cache of each user's chat context (summary + recent exchanges)
+
+    L1 is a small per-worker LRU with a short TTL, L2 is the shared cache
+    (Redis). Both are written on every turn, so the next turn's read is
+    normally a hit and the database is only read when both are cold.
+    L1 can be a turn behind when a user's turns hop between workers;
+    record_chat_turn detects that on write and redoes the turn on fresh data.
+    """
+
+    def __init__(self, local_entries=1000, local_ttl=30, ttl=86400):
+        self.local_entries = local_entries
+        self.local_ttl = local_ttl
+        self.ttl = ttl
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, user_id):
+        return f'chat_context:{user_id}'
+
+    def _get_local(self, user_id):
+        with self._lock:
+            entry = self._local.get(user_id)
+            if entry is None:
+                return None
+            expires_at, context = entry
+            if expires_at < time.monotonic():
+                del self._local[user_id]
+                return None
+            self._local.move_to_end(user_id)
+            return context
+
+    def _set_local(self, user_id, context):
+        with self._lock:
+            self._local[user_id] = (time.monotonic() + self.local_ttl, context)
+            self._local.move_to_end(user_id)
+            while len(self._local) > self.local_entries:
+                self._local.popitem(last=False)
+
+    def get(self, user_id):
+        context = self._get_local(user_id)
+        if context is None:
+            context = cache.get(self._key(user_id))
+            if context is not None:
+                self._set_local(user_id, context)
+        return context
+
+    def set(self, user_id, context):
+        cache.set(self._key(user_id), context, self.ttl)
+        self._set_local(user_id, context)
+
+    def invalidate(self, user_id):
+        cache.delete(self._key(user_id))
+        with self._lock:
+            self._local.pop(user_id, None)
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+
+
+chat_context_cache = ChatContextCache(**settings.CHAT_CONTEXT_CACHE)
+
+
+def _as_context(chat_summary):
+    return {
+        'id': chat_summary.pk,
+        'summary': chat_summary.summary,
+        'recent_exchanges': chat_summary.recent_exchanges,
+        'turn_count': chat_summary.turn_count,
+    }
+
+
+def get_chat_summary(user):
+    """The user's ChatSummary for the next turn, from cache when warm"""
+    context = chat_context_cache.get(user.pk)
+    if context is not None:
+        return ChatSummary(user=user, **context)
+
+    chat_summary = ChatSummary.for_user(user)
+    chat_context_cache.set(user.pk, _as_context(chat_summary))
+    return chat_summary
+
+
+def reset_chat_context(user_id):
+    """
+    Drop the user's summary and cached context, e.g. after chat messages
+    were deleted: the next turn seeds a new summary from the messages left
+    """
+    ChatSummary.objects.filter(user_id=user_id).delete()
+    chat_context_cache.invalidate(user_id)
+
+
+def chat_message_deleted(sender, instance, **kwargs):
+    """post_delete receiver for ChatMessage, see ApiConfig.ready"""
+    reset_chat_context(instance.user_id)
+
+
+def record_chat_turn(chat_summary, message, response):
+    """Append a finished turn to the summary, persist it and refresh the cache"""
+    expected_turn = chat_summary.turn_count
+    chat_summary.add_exchange(message, response)
+
+    # Conditional UPDATE: no SELECT needed, and a stale cached copy can't
+    # overwrite a newer turn written by another worker
+    updated = ChatSummary.objects.filter(
+        pk=chat_summary.pk,
+        turn_count=expected_turn
+    ).update(
+        summary=chat_summary.summary,
+        recent_exchanges=chat_summary.recent_exchanges,
+        turn_count=chat_summary.turn_count,
+        updated_at=timezone.now()
+    )
+
+    if not updated:
+        chat_summary = ChatSummary.for_user(chat_summary.user)
+        chat_summary.add_exchange(message, response)
+        chat_summary.save()
+
+    chat_context_cache.set(chat_summary.user_id, _as_context(chat_summary))
+    return chat_summary
@@ -0,0 +1,55 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_current_deadline = ContextVar('ai_request_deadline', default=None)
+
+
+class Deadline:
+    """
+    Absolute time budget for a single request
+
+    Created once per request (see DeadlineMiddleware) and consulted by
+    anything that waits on the network so the total never exceeds the budget.
+    """
+
+    def __init__(self, budget, clock=time.monotonic):
+        self.clock = clock
+        self.budget = budget
+        self.started_at = clock()
+        self.expires_at = self.started_at + budget
+
+    def elapsed(self):
+        return self.clock() - self.started_at
+
+    def remaining(self):
+        """Seconds left before the deadline (never negative)"""
+        return max(0.0, self.expires_at - self.clock())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def cap(self, timeout, reserve=0.0):
+        """
+        Shrink a timeout so it ends `reserve` seconds before the deadline.
+        Returns 0 when there is no usable time left.
+        """
+        return max(0.0, min(timeout, self.remaining() - reserve))
+
+    def __repr__(self):
+        return f"<Deadline budget={self.budget:.2f}s remaining={self.remaining():.2f}s>"
+
+
+def get_current_deadline():
+    """Deadline of the request being handled on this thread/task, if any"""
+    return _current_deadline.get()
+
+
+@contextmanager
+def deadline_scope(deadline):
+    """Make `deadline` the current deadline for the duration of the block"""
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
@@ -1,11 +1,31 @@
+from contextvars import ContextVar
 from functools import wraps
 from django.core.cache import cache
 from rest_framework.response import Response
 from rest_framework import status
 from django.utils import timezone
 import hashlib
+import math
 import time
 
+_current_usage = ContextVar('ai_usage', default=None)
+
+
+def record_ai_usage(**fields):
+    """
+    Attach details of the AI call in progress (e.g. prompt_tokens) to the
+    AIUsageLog row written by log_ai_usage. No-op outside a logged view.
+    """
+    usage = _current_usage.get()
+    if usage is not None:
+        usage.update(fields)
+
+
+def ai_fallback_used():
+    """True if the AI call in progress served a canned fallback instead of a generation"""
+    usage = _current_usage.get()
+    return bool(usage and usage.get('fallback'))
+
 def ai_rate_limit(max_requests=10, time_window=3600):
     """
     Custom decorator for additional AI rate limiting
@@ -75,6 +95,19 @@ def require_verified_user(view_func):
                 'message': 'AI features are available 1 hour after account creation'
             }, status=status.HTTP_403_FORBIDDEN)
         
+        # Flagged by the anomaly detector
+        from api.anomaly import blocked
+        entry = blocked('user', request.user.pk)
+        if entry is not None:
+            from api.metrics import THROTTLE_REJECTIONS
+            THROTTLE_REJECTIONS.inc(throttle='user_blocklist')
+            return Response({
+                'error': 'Access suspended',
+                'message': 'AI features are paused for your account due to unusual activity'
+            }, status=status.HTTP_429_TOO_MANY_REQUESTS, headers={
+                'Retry-After': str(max(1, math.ceil(entry['until'] - time.time())))
+            })
+        
         return view_func(request, *args, **kwargs)
     
     return wrapper
@@ -87,21 +120,29 @@ def log_ai_usage(view_func):
     @wraps(view_func)
     def wrapper(request, *args, **kwargs):
         start_time = time.time()
+        usage = {}
+        token = _current_usage.set(usage)
         
         # Execute view
-        response = view_func(request, *args, **kwargs)
+        try:
+            response = view_func(request, *args, **kwargs)
+        finally:
+            _current_usage.reset(token)
         
         # Log usage
         duration = time.time() - start_time
         
-        # Store in database or logging system
-        from api.models import AIUsageLog
-        AIUsageLog.objects.create(
+        # Queue for a batched insert, off the request path
+        from api.middleware import get_client_ip
+        from api.usage_log import usage_log_buffer
+        usage_log_buffer.add(
             user=request.user if request.user.is_authenticated else None,
             endpoint=view_func.__name__,
             duration=duration,
             status_code=response.status_code,
-            ip_address=request.META.get('REMOTE_ADDR'),
+            ip_address=get_client_ip(request),
+            prompt_tokens=usage.pop('prompt_tokens', None),
+            request_data=usage or None,
         )
         
         return response
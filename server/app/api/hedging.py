@@ -0,0 +1,165 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+from .retry import RetryBudget
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Lazily create the shared pool that runs hedged attempts."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='ai-hedge')
+    return _executor
+
+
+class LatencyTracker:
+    """Rolling window of recent call latencies (seconds)"""
+
+    def __init__(self, window=500):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        with self._lock:
+            self._samples.append(latency)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, pct):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+        return samples[index]
+
+
+class HedgeStats:
+    """Per-worker counters for hedged calls"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+
+    def incr(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+                'budget_denied': self.budget_denied,
+                'hedge_rate': self.hedged / self.calls if self.calls else 0,
+            }
+
+
+class Hedger:
+    """
+    Issue a second, identical call when the first is slower than usual
+
+    The hedge is sent once the primary has run longer than the configured
+    percentile of recent latencies; whichever call succeeds first wins.
+    Hedges draw from a RetryBudget so they never exceed `max_hedge_rate`
+    of calls (plus a small reserve).
+
+    `fn(cancel_event)` performs one attempt and returns its result. The
+    losing attempt has its event set and is dropped; `fn` should check the
+    event between steps (RemoteHTTPBackend._post does before every attempt
+    and backoff). requests cannot abort an in-flight HTTP call, so a loser
+    already waiting on one finishes it in the pool thread and its result is
+    discarded.
+
+    `timeout` bounds the whole call, hedge delay included; when it runs
+    out the attempts still running are cancelled and the result is None.
+    """
+
+    def __init__(self, percentile=95, min_samples=50, initial_delay=5.0,
+                 max_hedge_rate=0.05, reserve=2, window=500, executor=None):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.budget = RetryBudget(ratio=max_hedge_rate, reserve=reserve)
+        self.latency = LatencyTracker(window)
+        self.stats = HedgeStats()
+        self.executor = executor
+
+    def hedge_delay(self):
+        """How long to wait on the primary before hedging"""
+        if len(self.latency) < self.min_samples:
+            return self.initial_delay
+        return self.latency.percentile(self.percentile)
+
+    def _timed(self, fn, cancel):
+        start = time.monotonic()
+        try:
+            return fn(cancel)
+        finally:
+            # Losers are recorded too, otherwise the slow tail would vanish
+            # from the window and the hedge delay would keep shrinking
+            self.latency.record(time.monotonic() - start)
+
+    def call(self, fn, is_success=lambda result: result is not None, timeout=None):
+        executor = self.executor or _get_executor()
+        self.stats.incr('calls')
+        self.budget.deposit()
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+        primary_cancel = threading.Event()
+        primary = executor.submit(self._timed, fn, primary_cancel)
+        delay = self.hedge_delay()
+        done, _ = wait([primary], timeout=delay if deadline is None else min(delay, remaining()))
+        if done:
+            return primary.result()
+        if remaining() == 0:
+            primary_cancel.set()
+            return None
+
+        if not self.budget.try_spend():
+            self.stats.incr('budget_denied')
+            try:
+                return primary.result(timeout=remaining())
+            except TimeoutError:
+                primary_cancel.set()
+                return None
+
+        self.stats.incr('hedged')
+        hedge_cancel = threading.Event()
+        hedge = executor.submit(self._timed, fn, hedge_cancel)
+        cancels = {primary: primary_cancel, hedge: hedge_cancel}
+
+        pending = {primary, hedge}
+        result = None
+        while pending:
+            done, pending = wait(pending, timeout=remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            future = done.pop()
+            pending |= done
+            try:
+                result = future.result()
+            except Exception:
+                result = None
+            if is_success(result):
+                if future is hedge:
+                    self.stats.incr('hedge_wins')
+                break
+
+        for future in pending:
+            cancels[future].set()
+            future.cancel()
+        return result
@@ -0,0 +1,154 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from .redis_client import LuaScript, get_redis_client
+
+# KEYS: previous window counter, current window counter
+# ARGV: limit, window (seconds), elapsed share of the current window (0..1)
+SLIDING_WINDOW = LuaScript("""
+local previous = tonumber(redis.call('GET', KEYS[1]) or '0')
+local current = tonumber(redis.call('GET', KEYS[2]) or '0')
+local estimate = previous * (1 - tonumber(ARGV[3])) + current
+if estimate >= tonumber(ARGV[1]) then
+    return {0, previous, current}
+end
+current = redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], 2 * tonumber(ARGV[2]))
+return {1, previous, current}
+""")
+
+
+class LocalBlocklist:
+    """
+    Per-worker LRU of keys the shared limiter recently refused
+
+    A refusal comes with the time the key will be allowed again. Until
+    then the key is refused here without a cache round trip: other workers
+    can only have added requests, never removed them. Nothing is ever
+    allowed locally, so Redis stays authoritative. Under a flood from a
+    few keys this leaves about one Redis call per key per retry period.
+    """
+
+    def __init__(self, max_keys=10000, clock=time.time):
+        self.max_keys = max_keys
+        self.clock = clock
+        self._blocked = OrderedDict()
+        self._lock = threading.Lock()
+
+    def retry_after(self, key):
+        """Seconds `key` is still known to be refused, or None"""
+        with self._lock:
+            until = self._blocked.get(key)
+            if until is None:
+                return None
+            remaining = until - self.clock()
+            if remaining <= 0:
+                del self._blocked[key]
+                return None
+            self._blocked.move_to_end(key)
+            return remaining
+
+    def block(self, key, seconds):
+        if seconds <= 0:
+            return
+        with self._lock:
+            self._blocked[key] = self.clock() + seconds
+            self._blocked.move_to_end(key)
+            while len(self._blocked) > self.max_keys:
+                self._blocked.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._blocked.clear()
+
+
+class SlidingWindowLimiter:
+    """
+    Sliding-window counter: `limit` requests per `window` seconds per key
+
+    Keeps two integers per key (this window's and the previous window's
+    count) instead of a timestamp per request. The previous window is
+    weighted by how much of it still overlaps the sliding window, which
+    assumes its requests were spread evenly. On Redis the check and the
+    increment are one Lua script, so workers can't race past the limit.
+
+    With a `local` LocalBlocklist, keys refused recently are refused
+    again without touching the cache.
+
+    Usage:
+        limiter = SlidingWindowLimiter('ip_rate_limit', limit=20, window=3600)
+        allowed, retry_after = limiter.hit(ip)
+    """
+
+    def __init__(self, prefix, limit, window, clock=time.time, local=None):
+        self.prefix = prefix
+        self.limit = limit
+        self.window = window
+        self.clock = clock
+        self.local = local
+
+    def _keys(self, key, index):
+        return (
+            f'{self.prefix}:{key}:{index - 1}',
+            f'{self.prefix}:{key}:{index}',
+        )
+
+    def retry_after(self, previous, current, elapsed):
+        """Seconds until the estimate drops below the limit again"""
+        remaining = self.window * (1 - elapsed)
+        if previous:
+            # Previous window's weight shrinks linearly until this one ends
+            wait = self.window * (previous * (1 - elapsed) + current - self.limit) / previous
+            if wait < remaining:
+                return max(0.0, wait)
+        # Otherwise wait for this window to become the previous one
+        if current <= 0:
+            return remaining
+        return remaining + self.window * max(0.0, 1 - self.limit / current)
+
+    def hit(self, key):
+        """Count a request for `key`. Returns (allowed, retry_after seconds)"""
+        if self.local is not None:
+            retry_after = self.local.retry_after(key)
+            if retry_after is not None:
+                return False, retry_after
+
+        allowed, retry_after = self._hit(key)
+        if not allowed and self.local is not None:
+            self.local.block(key, retry_after)
+        return allowed, retry_after
+
+    def _hit(self, key):
+        now = self.clock()
+        index = math.floor(now / self.window)
+        elapsed = now / self.window - index
+        previous_key, current_key = self._keys(key, index)
+
+        client = get_redis_client()
+        if client is not None:
+            allowed, previous, current = SLIDING_WINDOW(
+                client,
+                keys=[previous_key, current_key],
+                args=[self.limit, self.window, elapsed],
+            )
+            if allowed:
+                return True, 0
+            return False, self.retry_after(int(previous), int(current), elapsed)
+
+        counts = cache.get_many([previous_key, current_key])
+        previous = counts.get(previous_key, 0)
+        current = counts.get(current_key, 0)
+        if previous * (1 - elapsed) + current >= self.limit:
+            return False, self.retry_after(previous, current, elapsed)
+
+        # Count, then give it back if a concurrent request got there first:
+        # incr is atomic per key
+        cache.add(current_key, 0, 2 * self.window)
+        current = cache.incr(current_key)
+        if previous * (1 - elapsed) + current - 1 >= self.limit:
+            cache.decr(current_key)
+            return False, self.retry_after(previous, current - 1, elapsed)
+        return True, 0
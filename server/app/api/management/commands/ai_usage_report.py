@@ -1,10 +1,16 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth import get_user_model
 from django.utils import timezone
-from django.db.models import Count, Avg, Sum
-from api.models import AIUsageLog, UserAIQuota
+from django.db.models import Count, Sum, Q
+from api.analytics import usage_analytics
+from api.models import AIUsageLog, AIUsageRollup, UserAIQuota
+from api.rollups import UsageSummary, hour_of, rebuild_rollups
+from api.sketches import LatencySketch
 from datetime import timedelta
 import json
 
+User = get_user_model()
+
 class Command(BaseCommand):
     help = 'Generate AI usage report'
 
@@ -22,75 +28,256 @@ class Command(BaseCommand):
             default='text',
             help='Output format',
         )
+        parser.add_argument(
+            '--endpoint',
+            type=str,
+            help='Only include this endpoint',
+        )
+        parser.add_argument(
+            '--user',
+            type=str,
+            help='Only include this username',
+        )
+        parser.add_argument(
+            '--hourly',
+            action='store_true',
+            help='Include per-hour totals, written out as the scan goes',
+        )
+        parser.add_argument(
+            '--fast',
+            action='store_true',
+            help='Approximate totals, unique users/IPs and top users/IPs from the cached sketches',
+        )
+        parser.add_argument(
+            '--backfill',
+            action='store_true',
+            help='Rebuild the hourly rollups for the period from raw usage logs first '
+                 '(done automatically for the start of the period when it has no rollups)',
+        )
 
     def handle(self, *args, **options):
         days = options['days']
         output_format = options['format']
-        
-        start_date = timezone.now() - timedelta(days=days)
-        
-        # Get usage statistics
-        logs = AIUsageLog.objects.filter(created_at__gte=start_date)
-        
-        total_requests = logs.count()
-        successful_requests = logs.filter(status_code=201).count()
-        failed_requests = logs.exclude(status_code=201).count()
-        
-        avg_duration = logs.aggregate(Avg('duration'))['duration__avg'] or 0
-        
-        # Top users
-        top_users = logs.values('user__username').annotate(
-            count=Count('id')
-        ).order_by('-count')[:10]
-        
-        # Endpoint usage
-        endpoint_usage = logs.values('endpoint').annotate(
-            count=Count('id'),
-            avg_duration=Avg('duration')
-        ).order_by('-count')
-        
+        self.json = output_format == 'json'
+
+        now = timezone.now()
+        start_date = now - timedelta(days=days)
+        if options['fast']:
+            if options['endpoint'] or options['user'] or options['hourly'] or options['backfill']:
+                raise CommandError('--fast only reports whole-site totals')
+            return self.fast_report(days, start_date, now)
+
+        # Rollups are per hour, so the period starts at the top of its first hour
+        since = hour_of(start_date)
+        if options['backfill']:
+            count = rebuild_rollups(start_date, now)
+            self.stderr.write(f'Rebuilt {count} hourly rollups')
+        else:
+            self.backfill_missing(since, now)
+
+        # Everything below comes from one ordered scan of the hourly rollups
+        rollups = AIUsageRollup.objects.filter(hour__gte=since)
+        quotas = UserAIQuota.objects.all()
+        filters = {}
+        if options['endpoint']:
+            filters['endpoint'] = options['endpoint']
+            rollups = rollups.filter(endpoint=options['endpoint'])
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f'User "{options["user"]}" not found')
+            filters['user'] = user.username
+            rollups = rollups.filter(user=user)
+            quotas = quotas.filter(user=user)
+
+        fields = ['user__username', 'endpoint', 'status_class', 'count', 'duration_sum', 'prompt_tokens', 'latency']
+        if options['hourly']:
+            rollups = rollups.order_by('hour')
+            fields.append('hour')
+        else:
+            rollups = rollups.order_by()
+        rows = rollups.values(*fields).iterator(chunk_size=2000)
+
+        if self.json:
+            self.write(
+                f'{{\n  "period_days": {days},\n  "since": {json.dumps(since.isoformat())},\n'
+                f'  "filters": {json.dumps(filters)},\n'
+            )
+            if options['hourly']:
+                self.write('  "hourly": [')
+        else:
+            self.write(self.style.SUCCESS(f'\n=== AI Usage Report (Last {days} days) ===\n') + '\n')
+            self.write(f'Since {since:%Y-%m-%d %H:00} UTC (whole hours)\n')
+            if filters:
+                self.write(f"Filters: {', '.join(f'{key}={value}' for key, value in filters.items())}\n")
+            if options['hourly']:
+                self.write(self.style.SUCCESS('\n=== Hourly ===') + '\n')
+
+        summary = self.scan(rows, hourly=options['hourly'])
+
+        if self.json and options['hourly']:
+            self.write('\n  ],\n')
+
         # Quota information
-        quota_stats = UserAIQuota.objects.aggregate(
-            total_daily=Sum('daily_usage'),
-            total_monthly=Sum('monthly_usage'),
-            avg_daily=Avg('daily_usage'),
-            avg_monthly=Avg('monthly_usage')
+        # Rows roll over lazily, so only count usage from the current period
+        today = timezone.localdate()
+        quota_stats = quotas.aggregate(
+            users=Count('id'),
+            total_daily=Sum('daily_usage', filter=Q(last_reset_date=today)),
+            total_monthly=Sum('monthly_usage', filter=Q(last_reset_date__gte=today.replace(day=1)))
         )
-        
-        if output_format == 'json':
+        users = quota_stats.pop('users')
+        quota_stats['avg_daily'] = (quota_stats['total_daily'] or 0) / users if users else 0
+        quota_stats['avg_monthly'] = (quota_stats['total_monthly'] or 0) / users if users else 0
+
+        total_requests = summary.total
+        successful_requests = summary.successful
+        failed_requests = total_requests - successful_requests
+        avg_duration = summary.duration_sum / total_requests if total_requests else 0
+        percentiles = summary.percentiles()
+        top_users = summary.top_users()
+        endpoint_usage = summary.endpoint_usage()
+
+        if self.json:
             report = {
-                'period_days': days,
                 'total_requests': total_requests,
                 'successful_requests': successful_requests,
                 'failed_requests': failed_requests,
+                'requests_by_status': summary.by_status,
                 'success_rate': f"{(successful_requests/total_requests*100):.2f}%" if total_requests > 0 else "0%",
                 'avg_duration_seconds': f"{avg_duration:.2f}",
-                'top_users': list(top_users),
-                'endpoint_usage': list(endpoint_usage),
+                'duration_percentiles': percentiles,
+                'prompt_tokens': summary.prompt_tokens,
+                'top_users': top_users,
+                'endpoint_usage': endpoint_usage,
                 'quota_stats': quota_stats
             }
-            self.stdout.write(json.dumps(report, indent=2, default=str))
+            # Continue the object opened above, without its braces
+            body = json.dumps(report, indent=2, default=str)
+            self.write(body[2:] + '\n')
         else:
-            self.stdout.write(self.style.SUCCESS(f'\n=== AI Usage Report (Last {days} days) ===\n'))
             self.stdout.write(f'Total Requests: {total_requests}')
             self.stdout.write(f'Successful: {successful_requests}')
             self.stdout.write(f'Failed: {failed_requests}')
+            for status_class, count in sorted(summary.by_status.items()):
+                self.stdout.write(f'  {status_class}: {count}')
             self.stdout.write(f'Success Rate: {(successful_requests/total_requests*100):.2f}%' if total_requests > 0 else 'N/A')
             self.stdout.write(f'Average Duration: {avg_duration:.2f}s')
-            
+            if total_requests:
+                self.stdout.write(
+                    'Duration Percentiles: '
+                    + ', '.join(f'{key}: {value:.2f}s' for key, value in percentiles.items())
+                )
+            self.stdout.write(f'Prompt Tokens: {summary.prompt_tokens}')
+
             self.stdout.write(self.style.SUCCESS('\n=== Top 10 Users ==='))
             for user in top_users:
                 self.stdout.write(f"  {user['user__username']}: {user['count']} requests")
-            
+
             self.stdout.write(self.style.SUCCESS('\n=== Endpoint Usage ==='))
             for endpoint in endpoint_usage:
                 self.stdout.write(
                     f"  {endpoint['endpoint']}: {endpoint['count']} requests "
-                    f"(avg: {endpoint['avg_duration']:.2f}s)"
+                    f"(avg: {endpoint['avg_duration']:.2f}s, p95: {endpoint['p95_duration']:.2f}s, "
+                    f"p99: {endpoint['p99_duration']:.2f}s)"
                 )
-            
+
             self.stdout.write(self.style.SUCCESS('\n=== Quota Statistics ==='))
             self.stdout.write(f"Total Daily Usage: {quota_stats['total_daily'] or 0}")
             self.stdout.write(f"Total Monthly Usage: {quota_stats['total_monthly'] or 0}")
             self.stdout.write(f"Avg Daily per User: {quota_stats['avg_daily'] or 0:.2f}")
             self.stdout.write(f"Avg Monthly per User: {quota_stats['avg_monthly'] or 0:.2f}")
+
+    def backfill_missing(self, since, now):
+        """
+        Rebuild the rollups for the start of the period when it has usage
+        logs but no rollups, e.g. logs written before rollups existed
+        """
+        first = AIUsageRollup.objects.filter(hour__gte=since).order_by('hour').values_list('hour', flat=True).first()
+        if first == since:
+            return
+        end = first or now
+        if not AIUsageLog.objects.filter(created_at__gte=since, created_at__lt=end).exists():
+            return
+        count = rebuild_rollups(since, end)
+        self.stderr.write(f'No rollups before {end:%Y-%m-%d %H:%M}: rebuilt {count} from usage logs')
+
+    def fast_report(self, days, start_date, now):
+        """Report from usage_analytics: costs the same per hour whatever the traffic"""
+        top_user_counts = usage_analytics.top('user', start_date, now)
+        usernames = dict(User.objects.filter(
+            pk__in=[user_id for user_id, _ in top_user_counts]
+        ).values_list('pk', 'username'))
+        report = {
+            'period_days': days,
+            'approximate': True,
+            'total_requests': usage_analytics.requests(start_date, now),
+            'unique_users': usage_analytics.unique('user', start_date, now),
+            'unique_ips': usage_analytics.unique('ip', start_date, now),
+            'top_users': [
+                {'user__username': usernames.get(user_id), 'count': count}
+                for user_id, count in top_user_counts
+            ],
+            'top_ips': [
+                {'ip_address': ip, 'count': count}
+                for ip, count in usage_analytics.top('ip', start_date, now)
+            ],
+        }
+
+        if self.json:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write(self.style.SUCCESS(f'\n=== AI Usage Report (Last {days} days, approximate) ===\n'))
+        self.stdout.write(f"Total Requests: {report['total_requests']}")
+        self.stdout.write(f"Unique Users: ~{report['unique_users']}")
+        self.stdout.write(f"Unique IPs: ~{report['unique_ips']}")
+
+        self.stdout.write(self.style.SUCCESS('\n=== Top 10 Users ==='))
+        for user in report['top_users']:
+            self.stdout.write(f"  {user['user__username']}: ~{user['count']} requests")
+
+        self.stdout.write(self.style.SUCCESS('\n=== Top 10 IPs ==='))
+        for ip in report['top_ips']:
+            self.stdout.write(f"  {ip['ip_address']}: ~{ip['count']} requests")
+
+    def write(self, text):
+        self.stdout.write(text, ending='')
+        self.stdout.flush()
+
+    def scan(self, rows, hourly=False):
+        """Fold rollup rows into a UsageSummary, writing each hour out as it completes"""
+        summary = UsageSummary()
+        hour, first = None, True
+        for row in rows:
+            if hourly and (hour is None or row['hour'] != hour['hour']):
+                if hour is not None:
+                    self.write_hour(hour, first)
+                    first = False
+                hour = {'hour': row['hour'], 'count': 0, 'successful': 0, 'duration_sum': 0.0, 'latency': LatencySketch()}
+            summary.add(row)
+            if hourly:
+                hour['count'] += row['count']
+                hour['successful'] += row['count'] if row['status_class'] == 2 else 0
+                hour['duration_sum'] += row['duration_sum']
+                hour['latency'].merge(LatencySketch(row['latency']))
+        if hour is not None:
+            self.write_hour(hour, first)
+        return summary
+
+    def write_hour(self, hour, first):
+        entry = {
+            'hour': hour['hour'].isoformat(),
+            'count': hour['count'],
+            'failed': hour['count'] - hour['successful'],
+            'avg_duration': hour['duration_sum'] / hour['count'],
+            'p95_duration': hour['latency'].quantile(0.95),
+        }
+        if self.json:
+            self.write(('\n' if first else ',\n') + '    ' + json.dumps(entry))
+        else:
+            self.write(
+                f"  {entry['hour']}: {entry['count']} requests, {entry['failed']} failed "
+                f"(avg: {entry['avg_duration']:.2f}s, p95: {entry['p95_duration']:.2f}s)\n"
+            )
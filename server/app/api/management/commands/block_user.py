@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
+from api.anomaly import unblock
 from api.models import UserAIQuota
 
 User = get_user_model()
@@ -27,6 +28,8 @@ class Command(BaseCommand):
                 quota.daily_limit = 50
                 quota.monthly_limit = 1000
                 quota.save()
+                # Also lift a block set by the anomaly detector
+                unblock('user', user.pk)
                 self.stdout.write(
                     self.style.SUCCESS(f'Successfully unblocked user: {username}')
                 )
@@ -1,21 +1,25 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from django.db.models import Count
-from api.models import AIUsageLog
+from django.db.models import Q, Sum
+from api.models import AIUsageRollup
+from api.rollups import hour_of
 from datetime import timedelta
 
 class Command(BaseCommand):
+    # Live detection and blocking happen in api/anomaly.py; this is the hourly summary
     help = 'Check for suspicious AI usage patterns'
 
     def handle(self, *args, **options):
-        now = timezone.now()
-        last_hour = now - timedelta(hours=1)
+        # The last complete hour of rollups (the cron runs on the hour)
+        last_hour = AIUsageRollup.objects.filter(
+            hour=hour_of(timezone.now()) - timedelta(hours=1)
+        )
         
         # Check for high-frequency users (potential bots)
-        high_frequency_users = AIUsageLog.objects.filter(
-            created_at__gte=last_hour
-        ).values('user_id', 'user__username').annotate(
-            count=Count('id')
+        high_frequency_users = last_hour.filter(user__isnull=False).values(
+            'user_id', 'user__username'
+        ).annotate(
+            count=Sum('count')
         ).filter(count__gte=20).order_by('-count')
         
         if high_frequency_users:
@@ -29,10 +33,10 @@ class Command(BaseCommand):
                 )
         
         # Check for high-frequency IPs
-        high_frequency_ips = AIUsageLog.objects.filter(
-            created_at__gte=last_hour
-        ).values('ip_address').annotate(
-            count=Count('id')
+        high_frequency_ips = last_hour.filter(ip_bucket__isnull=False).values(
+            'ip_bucket'
+        ).annotate(
+            count=Sum('count')
         ).filter(count__gte=30).order_by('-count')
         
         if high_frequency_ips:
@@ -40,14 +44,17 @@ class Command(BaseCommand):
             for ip in high_frequency_ips:
                 self.stdout.write(
                     self.style.WARNING(
-                        f"IP: {ip['ip_address']} - {ip['count']} requests"
+                        f"IP: {ip['ip_bucket']} - {ip['count']} requests"
                     )
                 )
         
         # Check for high error rates
-        recent_logs = AIUsageLog.objects.filter(created_at__gte=last_hour)
-        total = recent_logs.count()
-        errors = recent_logs.exclude(status_code=201).count()
+        totals = last_hour.aggregate(
+            total=Sum('count'),
+            errors=Sum('count', filter=~Q(status_class=2))
+        )
+        total = totals['total'] or 0
+        errors = totals['errors'] or 0
         
         if total > 0:
             error_rate = (errors / total) * 100
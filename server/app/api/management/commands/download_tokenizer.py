@@ -0,0 +1,11 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from api.prompts import load_tokenizer
+
+class Command(BaseCommand):
+    help = 'Download the tokenizer used for prompt token counts into the local Hugging Face cache'
+
+    def handle(self, *args, **options):
+        if load_tokenizer(download=True) is None:
+            raise CommandError(f'Could not load tokenizer {settings.AI_TOKENIZER_MODEL}')
+        self.stdout.write(self.style.SUCCESS(f'Tokenizer {settings.AI_TOKENIZER_MODEL} is cached'))
@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from api import partitions
+
+class Command(BaseCommand):
+    help = 'Create upcoming AIUsageLog partitions and remove logs past retention'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months-ahead',
+            type=int,
+            default=settings.AI_USAGE_LOG_PARTITIONS_AHEAD,
+            help='Partitions to keep ready beyond the current month',
+        )
+        parser.add_argument(
+            '--retention-months',
+            type=int,
+            default=settings.AI_USAGE_LOG_RETENTION_MONTHS,
+            help='Whole months of logs to keep before the current one',
+        )
+        parser.add_argument(
+            '--detach',
+            action='store_true',
+            help='Detach expired partitions instead of dropping them',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Rows per DELETE when the table is not partitioned',
+        )
+
+    def handle(self, *args, **options):
+        retention = options['retention_months']
+
+        if not partitions.is_partitioned():
+            count = partitions.delete_old_logs(retention, batch_size=options['batch_size'])
+            self.stdout.write(
+                self.style.SUCCESS(f'Deleted {count} usage logs older than {retention} months')
+            )
+            return
+
+        for name in partitions.ensure_partitions(options['months_ahead']):
+            self.stdout.write(f'Created partition {name}')
+
+        removed = partitions.drop_partitions(retention, detach=options['detach'])
+        action = 'Detached' if options['detach'] else 'Dropped'
+        for name in removed:
+            self.stdout.write(f'{action} partition {name}')
+        self.stdout.write(
+            self.style.SUCCESS(f'{action} {len(removed)} usage log partitions older than {retention} months')
+        )
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from api.quota import quota_counter
+
+class Command(BaseCommand):
+    help = 'Write AI quota counters from the cache back to UserAIQuota'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Rows per bulk update',
+        )
+
+    def handle(self, *args, **options):
+        count = quota_counter.reconcile(batch_size=options['batch_size'])
+        self.stdout.write(
+            self.style.SUCCESS(f'Reconciled AI quotas for {count} users')
+        )
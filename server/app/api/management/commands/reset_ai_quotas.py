@@ -1,10 +1,9 @@
 from django.core.management.base import BaseCommand
-from django.utils import timezone
 from api.models import UserAIQuota
-from datetime import date
+from api.quota import quota_counter
 
 class Command(BaseCommand):
-    help = 'Reset daily and monthly AI quotas'
+    help = 'Reset daily or monthly AI quota usage immediately'
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -20,32 +19,20 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         if options['daily']:
+            quota_counter.reset(UserAIQuota.objects.values_list('user_id', flat=True), daily=True)
             count = UserAIQuota.objects.all().update(daily_usage=0)
             self.stdout.write(
                 self.style.SUCCESS(f'Successfully reset daily quotas for {count} users')
             )
         elif options['monthly']:
+            quota_counter.reset(UserAIQuota.objects.values_list('user_id', flat=True), daily=False, monthly=True)
             count = UserAIQuota.objects.all().update(monthly_usage=0)
             self.stdout.write(
                 self.style.SUCCESS(f'Successfully reset monthly quotas for {count} users')
             )
         else:
-            # Auto-detect based on date
-            today = date.today()
-            if today.day == 1:
-                count = UserAIQuota.objects.all().update(
-                    daily_usage=0,
-                    monthly_usage=0,
-                    last_reset_date=today
-                )
-                self.stdout.write(
-                    self.style.SUCCESS(f'Successfully reset monthly and daily quotas for {count} users')
-                )
-            else:
-                count = UserAIQuota.objects.all().update(
-                    daily_usage=0,
-                    last_reset_date=today
-                )
-                self.stdout.write(
-                    self.style.SUCCESS(f'Successfully reset daily quotas for {count} users')
-                )
+            # Nothing to do on a schedule: UserAIQuota.roll_period and the
+            # per-day/per-month counters start each period from zero lazily
+            self.stdout.write(
+                'Quota periods roll over automatically; use --daily or --monthly to reset usage now'
+            )
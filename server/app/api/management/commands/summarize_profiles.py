@@ -0,0 +1,89 @@
+import os
+import time
+from collections import Counter
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from api.profiling import read_profile
+
+class Command(BaseCommand):
+    help = 'Merge sampled request profiles and show where the time goes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--directory',
+            type=str,
+            default=settings.PROFILING['directory'],
+            help='Where the profiles are (default: PROFILING["directory"])',
+        )
+        parser.add_argument(
+            '--url-name',
+            type=str,
+            help='Only profiles of this URL name, e.g. job-recommended',
+        )
+        parser.add_argument(
+            '--since',
+            type=float,
+            help='Only profiles from the last this many hours',
+        )
+        parser.add_argument(
+            '--top',
+            type=int,
+            default=20,
+            help='Functions to list (default: 20)',
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            help='Also write the merged folded stacks here, for flamegraph.pl or speedscope',
+        )
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        if not os.path.isdir(directory):
+            raise CommandError(f'No profiles in {directory}')
+
+        cutoff = time.time() - options['since'] * 3600 if options['since'] else None
+        stacks = Counter()
+        profiles, durations = 0, []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not name.endswith('.folded') or (cutoff and os.path.getmtime(path) < cutoff):
+                continue
+            try:
+                meta, profile = read_profile(path)
+            except (OSError, ValueError):
+                continue  # rotated away while reading
+            if options['url_name'] and meta.get('url_name') != options['url_name']:
+                continue
+            stacks.update(profile)
+            profiles += 1
+            durations.append(float(meta.get('duration', 0)))
+
+        if not profiles:
+            self.stdout.write('No matching profiles')
+            return
+
+        # Own time: the innermost frame. Total: anywhere on the stack, once per sample
+        own, total = Counter(), Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        samples = sum(stacks.values())
+
+        durations.sort()
+        self.stdout.write(self.style.SUCCESS(f'\n=== {profiles} Profiles, {samples} Samples ==='))
+        self.stdout.write(
+            f'Request duration: median {durations[len(durations) // 2]:.3f}s, max {durations[-1]:.3f}s'
+        )
+        for title, counts in (('Own Time', own), ('Total Time', total)):
+            self.stdout.write(self.style.SUCCESS(f'\n=== Top Functions by {title} ==='))
+            for frame, count in counts.most_common(options['top']):
+                self.stdout.write(f'  {count / samples:6.1%}  {frame}')
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f'{stack} {count}\n')
+            self.stdout.write(f"\nMerged stacks written to {options['output']}")
@@ -0,0 +1,369 @@
+import atexit
+import bisect
+import fcntl
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def boot_id():
+    """
+    This run of the service: the parent's (gunicorn master's) pid and,
+    where /proc has it, its start time, so a restarted service whose
+    master got the same pid still counts as a new run
+    """
+    ppid = os.getppid()
+    try:
+        with open(f'/proc/{ppid}/stat') as f:
+            # Field 22, starttime; fields are counted after the '(comm)' one
+            started = f.read().rpartition(')')[2].split()[19]
+    except (OSError, IndexError):
+        return str(ppid)
+    return f'{ppid}.{started}'
+
+
+class Registry:
+    """
+    Prometheus-style metrics, aggregated across gunicorn workers
+
+    Each worker keeps its counters and histograms in memory and writes them
+    to its own file in METRICS['directory'] at most every `flush_interval`
+    seconds (a background thread, plus at exit). `render()` merges the
+    files into the text exposition format, served by `views.metrics_view`
+    at /metrics. Files are named `<boot id>-<pid>-<start>.json`, so a
+    reused pid gets a new file. Files of exited workers are folded into
+    one `<boot id>-merged.json` at the next scrape, so counters never go
+    backwards and the directory doesn't grow as gunicorn recycles workers;
+    files from an earlier run of the service (another boot id) are deleted
+    rather than summed. Without a directory each process only reports
+    itself.
+
+    Usage:
+        REQUESTS = counter('tailorhire_things_total', 'Things done', ['kind'])
+        REQUESTS.inc(kind='a')
+        LATENCY = histogram('tailorhire_thing_seconds', 'Thing latency', ['kind'])
+        LATENCY.observe(0.2, kind='a')
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self._values = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._thread = None
+        self._pid = None
+        self._file_pid = None
+        self._boot = None
+        self._file = None
+        atexit.register(self.flush)
+
+    @property
+    def config(self):
+        return settings.METRICS
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def _update(self, metric, labels, update):
+        key = (metric.name, tuple(str(labels.get(name, '')) for name in metric.labels))
+        with self._lock:
+            self._values[key] = update(self._values.get(key))
+            self._dirty = True
+        if self.config['directory']:
+            self._ensure_thread()
+
+    def snapshot(self):
+        with self._lock:
+            return [[name, list(labels), value] for (name, labels), value in self._values.items()]
+
+    def _identity(self):
+        """(boot id, file name) of this process, worked out again after a fork"""
+        pid = os.getpid()
+        if self._file_pid != pid:
+            self._file_pid, self._boot = pid, boot_id()
+            self._file = f'{self._boot}-{pid}-{time.time_ns()}.json'
+        return self._boot, self._file
+
+    def _path(self):
+        return os.path.join(self.config['directory'], self._identity()[1])
+
+    def flush(self):
+        """Write this worker's values to its file"""
+        directory = self.config['directory']
+        if not directory or not self._dirty:
+            return
+        with self._lock:
+            self._dirty = False
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # Write then rename, so readers never see half a file
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, self._path())
+        except OSError as e:
+            logger.error(f"Metrics Flush Error - {str(e)}")
+
+    def collect(self):
+        """Values of every worker, summed per metric and label set"""
+        directory = self.config['directory']
+        if not directory:
+            return self._sum([self.snapshot()])
+        self.flush()
+        boot, own = self._identity()
+        merged = f'{boot}-merged.json'
+        names, dead = [], []
+        for name in os.listdir(directory) if os.path.isdir(directory) else []:
+            if not name.endswith('.json'):
+                continue
+            if not name.startswith(f'{boot}-'):
+                # Left by an earlier run of the service
+                _remove(os.path.join(directory, name))
+            elif name not in (own, merged) and not _pid_alive(name[len(boot) + 1:].split('-')[0]):
+                dead.append(name)
+            else:
+                names.append(name)
+        if dead:
+            self._merge(directory, merged, dead)
+
+        # Workers' files before the merged one: a file merged in between is
+        # then listed in it, rather than missing from both
+        files = {name: _read(os.path.join(directory, name)) for name in names if name != merged}
+        aggregate = _read(os.path.join(directory, merged)) or {'merged': [], 'values': []}
+        snapshots = [aggregate['values']]
+        for name, snapshot in files.items():
+            # None when replaced while reading; it's in the next scrape
+            if snapshot is not None and name not in aggregate['merged']:
+                snapshots.append(snapshot)
+        return self._sum(snapshots)
+
+    def _merge(self, directory, merged, names):
+        """
+        Add the files of exited workers to the merged file, then delete
+        them. The merged file lists what it holds, so a file is never
+        counted twice if deleting it fails or two workers scrape at once.
+        """
+        path = os.path.join(directory, merged)
+        with open(os.path.join(directory, '.merge.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            aggregate = _read(path) or {'merged': [], 'values': []}
+            snapshots = [aggregate['values']]
+            done = set(aggregate['merged'])
+            for name in names:
+                snapshot = None if name in done else _read(os.path.join(directory, name))
+                if snapshot is not None:
+                    snapshots.append(snapshot)
+                    done.add(name)
+            aggregate = {
+                # Only names whose files are still there need remembering
+                'merged': sorted(name for name in done if os.path.exists(os.path.join(directory, name))),
+                'values': [[name, list(labels), value] for (name, labels), value in self._sum(snapshots).items()],
+            }
+            try:
+                fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(aggregate, f)
+                os.replace(tmp, path)
+            except OSError as e:
+                logger.error(f"Metrics Merge Error - {str(e)}")
+                return
+            for name in done:
+                _remove(os.path.join(directory, name))
+
+    def _sum(self, snapshots):
+        totals = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot:
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                key = (name, tuple(labels))
+                totals[key] = metric.merge(totals.get(key), value)
+        return totals
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        totals = self.collect()
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.type}')
+            for (metric_name, labels), value in sorted(totals.items()):
+                if metric_name == name:
+                    lines.extend(metric.render(dict(zip(metric.labels, labels)), value))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """Forget this process's values (tests)"""
+        with self._lock:
+            self._values.clear()
+            self._dirty = True
+
+    def _ensure_thread(self):
+        # Started lazily and again after a fork: threads don't survive it
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.config['flush_interval'])
+            self.flush()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True  # someone else's process, or not a worker file
+    return True
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass  # another worker got there first
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, registry, name, documentation, labels=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def inc(self, amount=1, **labels):
+        self.registry._update(self, labels, lambda value: (value or 0) + amount)
+
+    def merge(self, total, value):
+        return (total or 0) + value
+
+    def render(self, labels, value):
+        return [f'{self.name}{_format_labels(labels)} {_format_value(value)}']
+
+
+class Histogram:
+    """Cumulative-bucket histogram; stored as per-bucket counts, then sum and count"""
+
+    type = 'histogram'
+
+    def __init__(self, registry, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        def update(current):
+            current = current or [0] * (len(self.buckets) + 1) + [0.0, 0]
+            # First bucket whose upper bound is >= value; the last one is +Inf
+            current[bisect.bisect_left(self.buckets, value)] += 1
+            current[-2] += value
+            current[-1] += 1
+            return current
+        self.registry._update(self, labels, update)
+
+    def merge(self, total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def render(self, labels, value):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), value):
+            cumulative += count
+            lines.append(
+                f'{self.name}_bucket{_format_labels({**labels, "le": _format_value(bound)})} {cumulative}'
+            )
+        lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(value[-2])}')
+        lines.append(f'{self.name}_count{_format_labels(labels)} {value[-1]}')
+        return lines
+
+
+registry = Registry()
+
+
+def counter(name, documentation, labels=()):
+    return registry.register(Counter(registry, name, documentation, labels))
+
+
+def histogram(name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(registry, name, documentation, labels, buckets))
+
+
+def render():
+    return registry.render()
+
+
+HTTP_REQUEST_DURATION = histogram(
+    'tailorhire_http_request_duration_seconds',
+    'Time from the first middleware to the response, by route pattern and status',
+    ['method', 'route', 'status'],
+)
+THROTTLE_REJECTIONS = counter(
+    'tailorhire_throttle_rejections_total',
+    'Requests refused by a rate limit, quota or blocklist',
+    ['throttle'],
+)
+AI_FALLBACKS = counter(
+    'tailorhire_ai_fallbacks_total',
+    'AI responses served from the canned fallback instead of a generation',
+    ['feature'],
+)
+AI_UPSTREAM_DURATION = histogram(
+    'tailorhire_ai_upstream_duration_seconds',
+    'Inference backend call latency, including retries and hedges',
+    ['backend', 'endpoint', 'outcome'],
+)
+DB_QUERIES = histogram(
+    'tailorhire_db_queries_per_request',
+    'Database queries run by a request, for requests sampled by QueryInstrumentationMiddleware',
+    ['route'],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
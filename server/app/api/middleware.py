@@ -1,11 +1,211 @@
-from django.core.cache import cache
 from django.http import JsonResponse
 from django.utils.deprecation import MiddlewareMixin
 import hashlib
+import ipaddress
+import logging
+import math
+import random
 import time
-from collections import defaultdict
+from django.conf import settings
+from django.db import connection
+from django.urls import Resolver404, resolve
+from .deadline import Deadline, deadline_scope
+from .metrics import DB_QUERIES, HTTP_REQUEST_DURATION, THROTTLE_REJECTIONS
+from .profiling import SamplingProfiler, profiling_rules, save_profile
+from .query_stats import QueryStats
+from .anomaly import anomaly_detector, blocked
+from .limiters import LocalBlocklist, SlidingWindowLimiter
+from .rollups import ip_bucket
 import re
 
+logger = logging.getLogger(__name__)
+
+AI_ENDPOINTS = ['/api/chat/', '/api/cover-letters/', '/api/jobs/recommended/']
+
+
+def is_ai_endpoint(path):
+    """Check if path is an AI endpoint"""
+    return any(endpoint in path for endpoint in AI_ENDPOINTS)
+
+
+def _trusted_proxy(address):
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in ipaddress.ip_network(network, strict=False) for network in settings.TRUSTED_PROXIES)
+
+
+def get_client_ip(request):
+    """
+    Real client IP. X-Forwarded-For is only read when the request came
+    from one of TRUSTED_PROXIES, and then the right-most hop that isn't a
+    trusted proxy is the client: the hops left of it are whatever the
+    client sent.
+    """
+    ip = request.META.get('REMOTE_ADDR')
+    if not _trusted_proxy(ip or ''):
+        return ip
+    for hop in reversed(request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')):
+        hop = hop.strip()
+        try:
+            # Client-supplied: it ends up in cache keys and AIUsageLog
+            ipaddress.ip_address(hop)
+        except ValueError:
+            break
+        ip = hop
+        if not _trusted_proxy(hop):
+            break
+    return ip
+
+
+def retry_after_header(seconds):
+    return str(max(1, math.ceil(seconds)))
+
+
+def get_route(request):
+    """URL pattern, not the path, so ids don't each get their own series"""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        # Answered before URL resolution, e.g. by the IP rate limit
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return 'unmatched'
+    return match.route
+
+
+class MetricsMiddleware:
+    """
+    Request latency histogram by route pattern, method and status code,
+    for every request including those answered by other middleware
+    """
+    
+    METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+    
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        HTTP_REQUEST_DURATION.observe(
+            time.perf_counter() - start,
+            method=request.method if request.method in self.METHODS else 'other',
+            route=get_route(request),
+            status=response.status_code,
+        )
+        return response
+
+
+class QueryInstrumentationMiddleware:
+    """
+    Counts and times the database queries of a sample of requests
+    (QUERY_INSTRUMENTATION['sample_rate']) to find N+1s in production.
+    
+    A sampled request gets a Server-Timing header with its query count
+    and DB time, and its query count goes into the
+    tailorhire_db_queries_per_request histogram. One over the query or
+    DB time thresholds, or that runs the same query (by fingerprint,
+    literals removed) `repeat_threshold` or more times, is logged.
+    Unsampled requests only pay for one random() call.
+    """
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+    
+    def __call__(self, request):
+        config = settings.QUERY_INSTRUMENTATION
+        if not config['enabled'] or random.random() >= config['sample_rate']:
+            return self.get_response(request)
+        
+        stats = QueryStats()
+        with connection.execute_wrapper(stats):
+            response = self.get_response(request)
+        
+        route = get_route(request)
+        DB_QUERIES.observe(stats.count, route=route)
+        if config['server_timing']:
+            response['Server-Timing'] = ', '.join(
+                value for value in (response.get('Server-Timing'), stats.server_timing()) if value
+            )
+        
+        repeated = stats.repeated(config['repeat_threshold'])
+        if (
+            stats.count >= config['max_queries']
+            or stats.duration * 1000 >= config['max_db_ms']
+            or repeated
+        ):
+            message = (
+                f"Query Stats - {request.method} {route} ({request.path}): "
+                f"{stats.count} queries, {stats.duration * 1000:.0f}ms in the database"
+            )
+            for sql, count in repeated[:3]:
+                message += f"; {count}x {sql[:300]}"
+            logger.warning(message)
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Statistical profile of 1 in N requests to the URLs listed in
+    PROFILING['routes'] or a ProfilingRule, written to
+    PROFILING['directory']. Read them with `manage.py summarize_profiles`.
+    """
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+    
+    def __call__(self, request):
+        config = settings.PROFILING
+        if not config['enabled']:
+            return self.get_response(request)
+        try:
+            url_name = resolve(request.path_info).url_name
+        except Resolver404:
+            return self.get_response(request)
+        every = profiling_rules.sample_every(request.method, url_name)
+        if not every or random.random() * every >= 1:
+            return self.get_response(request)
+        
+        profiler = SamplingProfiler(config['interval']).start()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.stop()
+        try:
+            save_profile(
+                profiler,
+                url_name=url_name,
+                method=request.method,
+                path=request.path,
+                status=response.status_code,
+            )
+        except OSError as e:
+            logger.error(f"Profile Save Error - {str(e)}")
+        return response
+
+
+class DeadlineMiddleware:
+    """
+    Start the time budget for AI requests as early as possible
+    so every later stage (throttles, quota checks, upstream calls)
+    shares one deadline instead of stacking independent timeouts
+    """
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+    
+    def __call__(self, request):
+        if not is_ai_endpoint(request.path):
+            request.deadline = None
+            return self.get_response(request)
+        
+        request.deadline = Deadline(settings.AI_REQUEST_DEADLINE)
+        with deadline_scope(request.deadline):
+            return self.get_response(request)
+
+
 class BotProtectionMiddleware(MiddlewareMixin):
     """
     Detect and block suspicious bot behavior
@@ -68,46 +268,48 @@ class IPRateLimitMiddleware(MiddlewareMixin):
     Prevents distributed bot attacks
     """
     
+    # IP_RATE_LIMIT requests per hour per IP; IPs over it are refused locally until they may retry
+    limiter = SlidingWindowLimiter(
+        'ip_rate_limit', limit=settings.IP_RATE_LIMIT, window=3600,
+        local=LocalBlocklist(settings.LOCAL_BLOCKLIST_MAX_KEYS)
+    )
+    
     def __init__(self, get_response):
         self.get_response = get_response
-        self.ip_request_counts = defaultdict(list)
     
     def __call__(self, request):
-        ip = self.get_client_ip(request)
-        current_time = time.time()
-        
         # Check IP-based rate limit for AI endpoints
         if self.is_ai_endpoint(request.path):
-            cache_key = f'ip_rate_limit:{ip}'
-            request_times = cache.get(cache_key, [])
-            
-            # Remove requests older than 1 hour
-            request_times = [t for t in request_times if current_time - t < 3600]
-            
-            # Check if exceeded limit (20 requests per hour per IP)
-            if len(request_times) >= 20:
-                return JsonResponse({
+            ip = self.get_client_ip(request)
+            # Flagged by the anomaly detector: refuse before counting
+            entry = blocked('ip', ip_bucket(ip))
+            if entry is not None:
+                THROTTLE_REJECTIONS.inc(throttle='ip_blocklist')
+                response = JsonResponse({
+                    'error': 'Access suspended',
+                    'message': 'Unusual activity from your network. Please try again later.'
+                }, status=429)
+                response['Retry-After'] = retry_after_header(entry['until'] - time.time())
+                return response
+
+            allowed, retry_after = self.limiter.hit(ip)
+            if not allowed:
+                THROTTLE_REJECTIONS.inc(throttle='ip_rate_limit')
+                anomaly_detector.reject(None, ip)
+                response = JsonResponse({
                     'error': 'Rate limit exceeded',
                     'message': 'Too many requests from your IP address. Please try again later.'
                 }, status=429)
-            
-            # Add current request
-            request_times.append(current_time)
-            cache.set(cache_key, request_times, 3600)
+                response['Retry-After'] = retry_after_header(retry_after)
+                return response
         
         response = self.get_response(request)
         return response
     
     def get_client_ip(self, request):
         """Get real client IP (handles proxies)"""
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        if x_forwarded_for:
-            ip = x_forwarded_for.split(',')[0]
-        else:
-            ip = request.META.get('REMOTE_ADDR')
-        return ip
+        return get_client_ip(request)
     
     def is_ai_endpoint(self, path):
         """Check if path is an AI endpoint"""
-        ai_endpoints = ['/api/chat/', '/api/cover-letters/', '/api/jobs/recommended/']
-        return any(endpoint in path for endpoint in ai_endpoints)
\ No newline at end of file
+        return is_ai_endpoint(path)
\ No newline at end of file
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-19 11:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_chatmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aiusagelog',
+            name='prompt_tokens',
+            field=models.IntegerField(blank=True, help_text='Tokens sent upstream in the prompt', null=True),
+        ),
+    ]
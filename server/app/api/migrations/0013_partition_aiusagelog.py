@@ -0,0 +1,116 @@
+"""
+Store AIUsageLog in monthly partitions on Postgres
+
+The table is rebuilt as PARTITION BY RANGE (created_at) with one
+partition per month, from the oldest row to MONTHS_AHEAD months ahead,
+and the existing rows are copied over. Postgres requires the partition
+key in the primary key, so it becomes (id, created_at); ids still come
+from one sequence and stay unique. Indexes and foreign keys are
+recreated under their current names, so later schema migrations keep
+working. Other databases keep the plain table.
+
+Copying runs inside the migration's transaction and locks the table
+until it's done; on large tables run it in a maintenance window.
+"""
+from datetime import datetime, timezone as dt_timezone
+from django.db import migrations
+
+TABLE = 'api_aiusagelog'
+OLD = 'api_aiusagelog_old'
+SEQUENCE = 'api_aiusagelog_id_seq'
+MONTHS_AHEAD = 3
+
+
+def add_months(day, months):
+    month = day.month - 1 + months
+    return day.replace(year=day.year + month // 12, month=month % 12 + 1, day=1)
+
+
+def rebuild(cursor, partitioned):
+    cursor.execute(
+        'SELECT indexname, indexdef FROM pg_indexes '
+        'WHERE schemaname = current_schema() AND tablename = %s AND indexname != %s',
+        [TABLE, f'{TABLE}_pkey']
+    )
+    # Partitioned parents report their indexes as "ON ONLY <table>"
+    indexes = [(name, sql.replace(' ON ONLY ', ' ON ')) for name, sql in cursor.fetchall()]
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = to_regclass(%s) AND contype = 'f'",
+        [TABLE]
+    )
+    foreign_keys = cursor.fetchall()
+
+    # Move the current table aside, freeing every name for the new one
+    cursor.execute(f'ALTER TABLE {TABLE} RENAME TO {OLD}')
+    cursor.execute(f'ALTER TABLE {OLD} DROP CONSTRAINT {TABLE}_pkey')
+    for name, _ in indexes:
+        cursor.execute(f'DROP INDEX {name}')
+    for name, _ in foreign_keys:
+        cursor.execute(f'ALTER TABLE {OLD} DROP CONSTRAINT {name}')
+    cursor.execute(f'ALTER TABLE {OLD} ALTER COLUMN id DROP DEFAULT')
+    cursor.execute(f'ALTER TABLE {OLD} ALTER COLUMN id DROP IDENTITY IF EXISTS')
+    cursor.execute(f'DROP SEQUENCE IF EXISTS {SEQUENCE}')
+
+    cursor.execute(
+        f'CREATE TABLE {TABLE} (LIKE {OLD} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
+        + (' PARTITION BY RANGE (created_at)' if partitioned else '')
+    )
+    if partitioned:
+        cursor.execute(f'SELECT min(created_at) FROM {OLD}')
+        oldest = cursor.fetchone()[0]
+        now = datetime.now(dt_timezone.utc)
+        month = (oldest or now).astimezone(dt_timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        last = add_months(now.replace(hour=0, minute=0, second=0, microsecond=0), MONTHS_AHEAD)
+        while month <= last:
+            cursor.execute(
+                f'CREATE TABLE {TABLE}_p{month:%Y%m} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)',
+                [month, add_months(month, 1)]
+            )
+            month = add_months(month, 1)
+
+    cursor.execute(f'INSERT INTO {TABLE} SELECT * FROM {OLD}')
+    cursor.execute(f'DROP TABLE {OLD}')
+
+    primary_key = '(id, created_at)' if partitioned else '(id)'
+    cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey PRIMARY KEY {primary_key}')
+    for _, sql in indexes:
+        cursor.execute(sql)
+    for name, definition in foreign_keys:
+        cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {name} {definition}')
+
+    cursor.execute(f'CREATE SEQUENCE {SEQUENCE} OWNED BY {TABLE}.id')
+    cursor.execute(f"ALTER TABLE {TABLE} ALTER COLUMN id SET DEFAULT nextval('{SEQUENCE}')")
+    cursor.execute(f"SELECT setval('{SEQUENCE}', COALESCE((SELECT max(id) FROM {TABLE}), 0) + 1, false)")
+
+
+def is_partitioned(cursor):
+    cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)', [TABLE])
+    return cursor.fetchone() is not None
+
+
+def partition_usage_log(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        if not is_partitioned(cursor):
+            rebuild(cursor, partitioned=True)
+
+
+def unpartition_usage_log(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        if is_partitioned(cursor):
+            rebuild(cursor, partitioned=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_aiusagelog_created_at_default'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_usage_log, unpartition_usage_log),
+    ]
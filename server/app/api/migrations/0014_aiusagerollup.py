@@ -0,0 +1,34 @@
+# Generated by Django 5.2.3 on 2026-10-19 12:11
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_partition_aiusagelog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AIUsageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField(help_text='Start of the hour (UTC)')),
+                ('endpoint', models.CharField(max_length=100)),
+                ('ip_bucket', models.GenericIPAddressField(blank=True, help_text='Client IPv4 address, or the /64 network of an IPv6 one', null=True)),
+                ('status_class', models.PositiveSmallIntegerField(help_text='status_code // 100')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('duration_sum', models.FloatField(default=0, help_text='Total duration in seconds')),
+                ('prompt_tokens', models.PositiveBigIntegerField(default=0)),
+                ('latency', models.JSONField(default=dict, help_text='LatencySketch buckets')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-hour'],
+                'indexes': [models.Index(fields=['hour'], name='api_aiusage_hour_a3de9a_idx'), models.Index(fields=['user', 'hour'], name='api_aiusage_user_id_95cd8c_idx')],
+            },
+        ),
+    ]
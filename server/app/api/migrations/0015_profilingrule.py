@@ -0,0 +1,29 @@
+# Generated by Django 5.2.3 on 2026-10-19 12:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_aiusagerollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfilingRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url_name', models.CharField(help_text='e.g. job-recommended, cover-letter-list', max_length=100)),
+                ('method', models.CharField(blank=True, help_text='Only this HTTP method; blank for any', max_length=10)),
+                ('sample_every', models.PositiveIntegerField(default=100, help_text='Profile 1 in this many requests')),
+                ('enabled', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['url_name', 'method'],
+                'unique_together': {('url_name', 'method')},
+            },
+        ),
+    ]
@@ -0,0 +1,62 @@
+"""
+Give the partitioned AIUsageLog a DEFAULT partition
+
+Without one, every insert fails once maintain_usage_logs has not run for
+longer than the partitions created ahead cover. Rows that land in it are
+moved to their month's partition the next time the command runs (see
+partitions.create_partition). Other databases are left alone.
+"""
+from datetime import timezone as dt_timezone
+from django.db import migrations
+
+TABLE = 'api_aiusagelog'
+DEFAULT = 'api_aiusagelog_default'
+
+
+def add_months(day, months):
+    month = day.month - 1 + months
+    return day.replace(year=day.year + month // 12, month=month % 12 + 1, day=1)
+
+
+def is_partitioned(cursor):
+    cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)', [TABLE])
+    return cursor.fetchone() is not None
+
+
+def add_default_partition(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        if is_partitioned(cursor):
+            cursor.execute(f'CREATE TABLE IF NOT EXISTS {DEFAULT} PARTITION OF {TABLE} DEFAULT')
+
+
+def remove_default_partition(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s)', [DEFAULT])
+        if cursor.fetchone()[0] is None:
+            return
+        # Give its rows monthly partitions, then route them there
+        cursor.execute(f'ALTER TABLE {TABLE} DETACH PARTITION {DEFAULT}')
+        cursor.execute(f"SELECT DISTINCT date_trunc('month', created_at AT TIME ZONE 'UTC') FROM {DEFAULT}")
+        for (month,) in cursor.fetchall():
+            month = month.replace(tzinfo=dt_timezone.utc)
+            cursor.execute(
+                f'CREATE TABLE IF NOT EXISTS {TABLE}_p{month:%Y%m} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)',
+                [month, add_months(month, 1)]
+            )
+        cursor.execute(f'INSERT INTO {TABLE} SELECT * FROM {DEFAULT}')
+        cursor.execute(f'DROP TABLE {DEFAULT}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_profilingrule'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_default_partition, remove_default_partition),
+    ]
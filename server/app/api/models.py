@@ -2,6 +2,8 @@ from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import FileExtensionValidator
 from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.utils import timezone
 
 # Create your models here.
 class CustomUser(AbstractUser):
@@ -30,15 +32,20 @@ User = get_user_model()
 class AIUsageLog(models.Model):
     """
     Track AI usage for monitoring and cost management
+
+    On Postgres the table is partitioned by month on created_at (see
+    migration 0013 and the maintain_usage_logs command).
     """
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
     endpoint = models.CharField(max_length=100)
     request_data = models.JSONField(null=True, blank=True)
     duration = models.FloatField(help_text="Request duration in seconds")
     status_code = models.IntegerField()
+    prompt_tokens = models.IntegerField(null=True, blank=True, help_text="Tokens sent upstream in the prompt")
     ip_address = models.GenericIPAddressField(null=True, blank=True)
     user_agent = models.TextField(null=True, blank=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add: rows are written in batches, after the request
+    created_at = models.DateTimeField(default=timezone.now)
     
     class Meta:
         ordering = ['-created_at']
@@ -52,6 +59,36 @@ class AIUsageLog(models.Model):
         return f"{self.endpoint} - {self.user} - {self.created_at}"
 
 
+class AIUsageRollup(models.Model):
+    """
+    Hourly AIUsageLog totals, so reports read a few rows per hour instead
+    of every request. Kept up to date as usage logs are written (see
+    api/rollups.py); one row per hour, user, endpoint, client IP bucket
+    and status class.
+    """
+    hour = models.DateTimeField(help_text="Start of the hour (UTC)")
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    endpoint = models.CharField(max_length=100)
+    ip_bucket = models.GenericIPAddressField(
+        null=True, blank=True, help_text="Client IPv4 address, or the /64 network of an IPv6 one"
+    )
+    status_class = models.PositiveSmallIntegerField(help_text="status_code // 100")
+    count = models.PositiveIntegerField(default=0)
+    duration_sum = models.FloatField(default=0, help_text="Total duration in seconds")
+    prompt_tokens = models.PositiveBigIntegerField(default=0)
+    latency = models.JSONField(default=dict, help_text="LatencySketch buckets")
+
+    class Meta:
+        ordering = ['-hour']
+        indexes = [
+            models.Index(fields=['hour']),
+            models.Index(fields=['user', 'hour']),
+        ]
+
+    def __str__(self):
+        return f"{self.hour:%Y-%m-%d %H:00} - {self.endpoint} - {self.user} - {self.count}"
+
+
 class UserAIQuota(models.Model):
     """
     Track user AI quotas and limits
@@ -64,6 +101,34 @@ class UserAIQuota(models.Model):
     last_reset_date = models.DateField(auto_now_add=True)
     is_premium = models.BooleanField(default=False)
     
+    def _period_usage(self, today=None):
+        """
+        (daily, monthly) usage for the current period
+
+        Periods roll lazily: counts from an earlier day or month than
+        last_reset_date read as zero, so no nightly reset is needed.
+        """
+        today = today or timezone.localdate()
+        last = self.last_reset_date
+        daily = self.daily_usage if last == today else 0
+        same_month = last is not None and (last.year, last.month) == (today.year, today.month)
+        monthly = self.monthly_usage if same_month else 0
+        return daily, monthly
+    
+    @property
+    def current_daily_usage(self):
+        return self._period_usage()[0]
+    
+    @property
+    def current_monthly_usage(self):
+        return self._period_usage()[1]
+    
+    def roll_period(self, today=None):
+        """Zero counters left over from an earlier period (not saved)"""
+        today = today or timezone.localdate()
+        self.daily_usage, self.monthly_usage = self._period_usage(today)
+        self.last_reset_date = today
+    
     def reset_daily(self):
         """Reset daily usage counter"""
         self.daily_usage = 0
@@ -78,10 +143,12 @@ class UserAIQuota(models.Model):
         """Check if user can make AI request"""
         if self.is_premium:
             return True
-        return self.daily_usage < self.daily_limit and self.monthly_usage < self.monthly_limit
+        daily, monthly = self._period_usage()
+        return daily < self.daily_limit and monthly < self.monthly_limit
     
     def increment_usage(self):
         """Increment usage counters"""
+        self.roll_period()
         self.daily_usage += 1
         self.monthly_usage += 1
         self.save()
@@ -195,4 +262,77 @@ class ChatMessage(models.Model):
         ordering = ['-created_at']
 
     def __str__(self):
-        return f"{self.user.username}: {self.message[:50]}"
\ No newline at end of file
+        return f"{self.user.username}: {self.message[:50]}"
+
+class ChatSummary(models.Model):
+    """
+    Running summary of a user's chat, updated after every turn
+
+    Holds the latest exchange(s) verbatim plus a compact summary of
+    everything older, so building the next prompt reads one row no
+    matter how long the conversation has run.
+    """
+    user = models.OneToOneField(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='chat_summary'
+    )
+    summary = models.TextField(blank=True, default='')
+    recent_exchanges = models.JSONField(default=list)
+    turn_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Chat summary for {self.user.username} ({self.turn_count} turns)"
+
+    @classmethod
+    def for_user(cls, user):
+        """Get the user's summary, seeding a new one from their latest messages"""
+        summary, created = cls.objects.get_or_create(user=user)
+        if created:
+            window = settings.CHAT_HISTORY_WINDOW
+            latest = ChatMessage.objects.filter(user=user).order_by('-created_at')[:window]
+            summary.recent_exchanges = [
+                {'message': msg.message, 'response': msg.response}
+                for msg in reversed(latest)
+            ]
+            if summary.recent_exchanges:
+                summary.save(update_fields=['recent_exchanges'])
+        return summary
+
+    def add_exchange(self, message, response):
+        """Append the newest exchange, folding ones beyond the window into the summary"""
+        from .prompts import fold_into_summary
+
+        exchanges = self.recent_exchanges + [{'message': message, 'response': response}]
+        while len(exchanges) > settings.CHAT_HISTORY_WINDOW:
+            oldest = exchanges.pop(0)
+            self.summary = fold_into_summary(
+                self.summary,
+                oldest['message'],
+                oldest['response'],
+                settings.CHAT_SUMMARY_MAX_TOKENS,
+            )
+        self.recent_exchanges = exchanges
+        self.turn_count += 1
+
+
+class ProfilingRule(models.Model):
+    """
+    Profile 1 in `sample_every` requests to a URL (see api/profiling.py),
+    alongside PROFILING['routes']. Picked up by every worker within
+    PROFILING['rules_ttl'] seconds of being saved.
+    """
+    url_name = models.CharField(max_length=100, help_text="e.g. job-recommended, cover-letter-list")
+    method = models.CharField(max_length=10, blank=True, help_text="Only this HTTP method; blank for any")
+    sample_every = models.PositiveIntegerField(default=100, help_text="Profile 1 in this many requests")
+    enabled = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['url_name', 'method']
+        ordering = ['url_name', 'method']
+
+    def __str__(self):
+        return f"{self.method or 'ANY'} {self.url_name} (1 in {self.sample_every})"
@@ -0,0 +1,179 @@
+import logging
+import re
+from datetime import datetime, timezone as dt_timezone
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import AIUsageLog
+
+logger = logging.getLogger(__name__)
+
+TABLE = AIUsageLog._meta.db_table
+# Catches rows for months without a partition (migration 0016), so inserts
+# keep working if maintain_usage_logs stops running
+DEFAULT_PARTITION = f'{TABLE}_default'
+PARTITION_NAME = re.compile(rf'^{TABLE}_p(\d{{4}})(\d{{2}})$')
+
+
+def add_months(day, months):
+    """First day of the month `months` after `day`'s month"""
+    month = day.month - 1 + months
+    return day.replace(year=day.year + month // 12, month=month % 12 + 1, day=1)
+
+
+def partition_name(month):
+    return f'{TABLE}_p{month:%Y%m}'
+
+
+def month_bounds(month):
+    """[start, end) of `month` as UTC datetimes, the partition's range"""
+    start = datetime(month.year, month.month, 1, tzinfo=dt_timezone.utc)
+    end = add_months(start, 1)
+    return start, end
+
+
+def retention_cutoff(retention_months, today=None):
+    """Rows created before this are past retention"""
+    today = today or timezone.now().date()
+    return month_bounds(add_months(today, -retention_months))[0]
+
+
+def is_partitioned():
+    """Whether AIUsageLog is stored in monthly partitions (Postgres only)"""
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)',
+            [TABLE]
+        )
+        return cursor.fetchone() is not None
+
+
+def list_partitions():
+    """Months with a partition attached, oldest first"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE pg_inherits.inhparent = to_regclass(%s)',
+            [TABLE]
+        )
+        names = [row[0] for row in cursor.fetchall()]
+
+    months = []
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            months.append(datetime(int(match[1]), int(match[2]), 1).date())
+    return sorted(months)
+
+
+def default_months():
+    """Months with rows in the DEFAULT partition, oldest first"""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s)', [DEFAULT_PARTITION])
+        if cursor.fetchone()[0] is None:
+            return []
+        cursor.execute(
+            f"SELECT DISTINCT date_trunc('month', created_at AT TIME ZONE 'UTC') "
+            f'FROM {DEFAULT_PARTITION} ORDER BY 1'
+        )
+        return [row[0].date() for row in cursor.fetchall()]
+
+
+def create_partition(month):
+    """
+    Create `month`'s partition. Rows for it that went to the DEFAULT
+    partition are moved into it first: Postgres refuses a new partition
+    whose range still has rows in DEFAULT. Returns the rows moved.
+    """
+    name = partition_name(month)
+    start, end = month_bounds(month)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s)', [DEFAULT_PARTITION])
+        if cursor.fetchone()[0] is not None:
+            # Hold off inserts for this month until its partition is attached
+            cursor.execute(f'LOCK TABLE {DEFAULT_PARTITION} IN ACCESS EXCLUSIVE MODE')
+            cursor.execute(
+                f'SELECT count(*) FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s',
+                [start, end]
+            )
+            stranded = cursor.fetchone()[0]
+            if stranded:
+                cursor.execute(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+                cursor.execute(
+                    f'INSERT INTO {name} SELECT * FROM {DEFAULT_PARTITION} '
+                    f'WHERE created_at >= %s AND created_at < %s',
+                    [start, end]
+                )
+                cursor.execute(
+                    f'DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s',
+                    [start, end]
+                )
+                # Indexes and foreign keys are added to match the parent's
+                cursor.execute(
+                    f'ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)',
+                    [start, end]
+                )
+                logger.warning(f"Usage Log Partitions - Moved {stranded} rows from {DEFAULT_PARTITION} to {name}")
+                return stranded
+
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS {name} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)',
+            [start, end]
+        )
+        return 0
+
+
+def ensure_partitions(months_ahead=3, today=None):
+    """
+    Create the partitions for this month, the next `months_ahead`, and any
+    month with rows in the DEFAULT partition (while this wasn't running).
+    Returns the names of the partitions created.
+    """
+    this_month = (today or timezone.now().date()).replace(day=1)
+    months = {add_months(this_month, offset) for offset in range(months_ahead + 1)}
+    months.update(default_months())
+    existing = set(list_partitions())
+    created = []
+    for month in sorted(months - existing):
+        create_partition(month)
+        created.append(partition_name(month))
+    return created
+
+
+def drop_partitions(retention_months, detach=False, today=None):
+    """
+    Remove whole partitions older than `retention_months`. With `detach`
+    they are only detached and kept as plain tables, e.g. for archiving.
+    Returns the names of the partitions removed.
+    """
+    cutoff = retention_cutoff(retention_months, today).date()
+    removed = []
+    with connection.cursor() as cursor:
+        for month in list_partitions():
+            if add_months(month, 1) > cutoff:
+                continue
+            name = partition_name(month)
+            cursor.execute(f'ALTER TABLE {TABLE} DETACH PARTITION {name}')
+            if not detach:
+                cursor.execute(f'DROP TABLE {name}')
+            removed.append(name)
+    return removed
+
+
+def delete_old_logs(retention_months, batch_size=5000, today=None):
+    """
+    Delete rows older than `retention_months` from an unpartitioned table
+    (SQLite, or Postgres before the partitioning migration), a batch at a
+    time so no single statement holds locks for long.
+    Returns the number of rows deleted.
+    """
+    cutoff = retention_cutoff(retention_months, today)
+    old = AIUsageLog.objects.filter(created_at__lt=cutoff).order_by()
+    deleted = 0
+    while True:
+        ids = list(old.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += AIUsageLog.objects.filter(id__in=ids).delete()[0]
@@ -0,0 +1,152 @@
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+from .models import ProfilingRule
+
+logger = logging.getLogger(__name__)
+
+
+def stack_of(frame):
+    """Folded call stack, outermost call first: 'module:function;module:function'"""
+    names = []
+    while frame is not None:
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for one thread
+
+    A helper thread records the profiled thread's call stack every
+    `interval` seconds. Nothing is hooked into the profiled code, so the
+    cost is one stack walk per interval however many calls the request
+    makes, which makes it safe to leave on for a sample of production
+    requests. The result is a Counter of folded stacks, the format
+    flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, thread_id=None):
+        self._target = thread_id or threading.get_ident()
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self._started
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is not None:
+                self.stacks[stack_of(frame)] += 1
+
+
+class ProfilingRules:
+    """
+    1-in-N sampling rates by URL name, from PROFILING['routes'] and
+    enabled ProfilingRule rows. Keys are 'url-name' or 'METHOD url-name'.
+    Read from the database at most every PROFILING['rules_ttl'] seconds
+    per worker.
+    """
+
+    def __init__(self):
+        self._rules = None
+        self._loaded = 0.0
+
+    def sample_every(self, method, url_name):
+        rules = self._load()
+        return rules.get(f'{method} {url_name}') or rules.get(url_name)
+
+    def clear(self):
+        self._rules = None
+
+    def _load(self):
+        config = settings.PROFILING
+        if self._rules is not None and time.monotonic() - self._loaded < config['rules_ttl']:
+            return self._rules
+
+        rules = dict(config['routes'])
+        try:
+            for rule in ProfilingRule.objects.filter(enabled=True):
+                key = f'{rule.method.upper()} {rule.url_name}' if rule.method else rule.url_name
+                rules[key] = rule.sample_every
+        except DatabaseError as e:
+            logger.error(f"Profiling Rules Error - {str(e)}")
+        self._rules, self._loaded = rules, time.monotonic()
+        return rules
+
+
+profiling_rules = ProfilingRules()
+
+
+def save_profile(profiler, **meta):
+    """
+    Write a profile to PROFILING['directory'] as a folded-stack file with
+    `# key: value` header lines, then delete the oldest files beyond
+    PROFILING['max_files']. Returns the path.
+    """
+    config = settings.PROFILING
+    directory = config['directory']
+    os.makedirs(directory, exist_ok=True)
+
+    meta = {'duration': f'{profiler.duration:.4f}', 'interval': profiler.interval, **meta}
+    slug = re.sub(r'[^A-Za-z0-9]+', '-', str(meta.get('url_name', 'request'))).strip('-')
+    # Timestamp first, so files sort oldest to newest by name
+    path = os.path.join(directory, f'{timezone.now():%Y%m%dT%H%M%S%f}-{slug}-{os.getpid()}.folded')
+
+    # Write then rename, so summarize_profiles never reads half a file
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        for key, value in meta.items():
+            f.write(f'# {key}: {value}\n')
+        for stack, count in profiler.stacks.most_common():
+            f.write(f'{stack} {count}\n')
+    os.replace(tmp, path)
+
+    rotate(directory, config['max_files'])
+    return path
+
+
+def rotate(directory, max_files):
+    profiles = sorted(name for name in os.listdir(directory) if name.endswith('.folded'))
+    for name in profiles[:-max_files]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass  # another worker got there first
+
+
+def read_profile(path):
+    """(meta, Counter of folded stacks) from a file written by save_profile"""
+    meta, stacks = {}, Counter()
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('# '):
+                key, _, value = line[2:].partition(': ')
+                meta[key] = value
+            elif line:
+                stack, _, count = line.rpartition(' ')
+                stacks[stack] += int(count)
+    return meta, stacks
@@ -0,0 +1,229 @@
+import logging
+import math
+import re
+import threading
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_tokenizer = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+
+_WORD_RE = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_RE = re.compile(r'(?<=[.!?;])\s+|\n+')
+_TERM_RE = re.compile(r'[a-z0-9][a-z0-9+#.]*[a-z0-9+#]|[a-z0-9]')
+
+STOPWORDS = {
+    'the', 'and', 'for', 'with', 'you', 'our', 'are', 'will', 'your', 'this',
+    'that', 'have', 'from', 'who', 'all', 'can', 'not', 'but', 'was', 'were',
+    'has', 'its', 'their', 'they', 'them', 'into', 'about', 'what', 'when',
+    'also', 'more', 'any', 'such', 'other', 'than', 'been', 'being', 'work',
+}
+
+# Words that mark a sentence as describing what the role actually needs
+REQUIREMENT_CUES = (
+    'require', 'must', 'experience', 'skill', 'responsib', 'qualif',
+    'proficien', 'knowledge', 'degree', 'years', 'familiar', 'expert',
+)
+
+
+def load_tokenizer(download=False):
+    """
+    Load the generation model's tokenizer from the local Hugging Face cache
+    (on the first `count_tokens` call, once per worker). Without it, or
+    without transformers, token counts are approximate. Only
+    `download_tokenizer` passes download=True: fetching it inside a request
+    would hold up every AI request in the worker, whatever their deadline.
+    """
+    with _tokenizer_lock:
+        return _load_tokenizer(download)
+
+
+def _load_tokenizer(download):
+    global _tokenizer, _tokenizer_loaded
+    _tokenizer_loaded = True
+    try:
+        from transformers import AutoTokenizer
+    except ImportError:
+        _tokenizer = None
+        return None
+    try:
+        _tokenizer = AutoTokenizer.from_pretrained(
+            settings.AI_TOKENIZER_MODEL, local_files_only=not download
+        )
+    except Exception as e:
+        logger.info(f"Tokenizer unavailable, using approximate token counts: {str(e)}")
+        _tokenizer = None
+    return _tokenizer
+
+
+def _get_tokenizer():
+    """The tokenizer, loaded from the local cache on first use, or None; tried once"""
+    if not _tokenizer_loaded:
+        with _tokenizer_lock:
+            if not _tokenizer_loaded:
+                _load_tokenizer(download=False)
+    return _tokenizer
+
+
+def count_tokens(text):
+    """Token count with the local tokenizer, or a close approximation without it"""
+    if not text:
+        return 0
+    tokenizer = _get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+    # ~4 characters per token for English words, punctuation is its own token
+    return sum(max(1, math.ceil(len(piece) / 4)) for piece in _WORD_RE.findall(text))
+
+
+def truncate_to_tokens(text, budget):
+    """Keep the leading words of `text` that fit in `budget` tokens"""
+    if count_tokens(text) <= budget:
+        return text
+    words = text.split()
+    low, high = 0, len(words)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(' '.join(words[:mid])) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    return ' '.join(words[:low])
+
+
+def _terms(text):
+    return {term for term in _TERM_RE.findall(text.lower()) if len(term) > 1 and term not in STOPWORDS}
+
+
+def select_sentences(text, budget, keywords=''):
+    """
+    Shrink `text` to `budget` tokens by keeping its most important sentences
+
+    Sentences are ranked by overlap with `keywords` (e.g. the candidate's
+    skills), requirement cue words and position (earlier is better), then
+    taken greedily and put back in their original order.
+    """
+    if count_tokens(text) <= budget:
+        return text
+
+    sentences = [s.strip() for s in _SENTENCE_RE.split(text) if s and s.strip()]
+    keyword_terms = _terms(keywords)
+
+    scored = []
+    for index, sentence in enumerate(sentences):
+        lower = sentence.lower()
+        score = 2 * len(_terms(sentence) & keyword_terms)
+        score += sum(1 for cue in REQUIREMENT_CUES if cue in lower)
+        score += 1 / (1 + index)
+        scored.append((score, index, sentence, count_tokens(sentence)))
+
+    chosen = []
+    remaining = budget
+    for score, index, sentence, tokens in sorted(scored, key=lambda item: -item[0]):
+        # +1 for the joining space
+        if tokens + 1 <= remaining:
+            chosen.append((index, sentence))
+            remaining -= tokens + 1
+
+    if not chosen:
+        top = max(scored, key=lambda item: item[0])
+        return truncate_to_tokens(top[2], budget)
+
+    return ' '.join(sentence for index, sentence in sorted(chosen))
+
+
+def _first_sentence(text, max_words):
+    sentence = _SENTENCE_RE.split(text.strip(), maxsplit=1)[0]
+    words = sentence.split()
+    if len(words) > max_words:
+        return ' '.join(words[:max_words]) + '...'
+    return sentence
+
+
+def fold_into_summary(summary, message, response, max_tokens):
+    """
+    Add one exchange to a running conversation summary
+
+    Extractive and cheap on purpose: no upstream call, just the gist of
+    each side. The oldest lines are dropped once over `max_tokens`.
+    """
+    line = f"- User asked: {_first_sentence(message, 25)} Advice given: {_first_sentence(response, 30)}"
+    lines = [l for l in summary.splitlines() if l.strip()] + [line]
+    while len(lines) > 1 and count_tokens('\n'.join(lines)) > max_tokens:
+        lines.pop(0)
+    # A single oversized line is cut rather than dropped
+    return truncate_to_tokens('\n'.join(lines), max_tokens)
+
+
+class PromptBuilder:
+    """
+    Builds upstream prompts within a per-endpoint token budget
+    (AI_PROMPT_TOKEN_BUDGETS). Each build method returns (prompt, token_count).
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.budget = settings.AI_PROMPT_TOKEN_BUDGETS[endpoint]
+
+    def cover_letter(self, resume_text, job_description, user_profile):
+        resume_summary = resume_text[:500] if resume_text else 'Not provided'
+        template = """
+            Generate a professional cover letter based on the following:
+
+            Candidate Profile:
+            Name: {name}
+            Skills: {skills}
+            Bio: {bio}
+
+            Job Description:
+            {job_description}
+
+            Resume Summary:
+            {resume_summary}
+            """
+        fields = {
+            'name': user_profile.get('name', ''),
+            'skills': user_profile.get('skills', ''),
+            'bio': user_profile.get('bio', ''),
+            'resume_summary': resume_summary,
+        }
+
+        # Everything except the job description is small and fixed;
+        # the job description gets whatever budget is left
+        fixed_tokens = count_tokens(template.format(job_description='', **fields))
+        job_budget = max(0, self.budget - fixed_tokens)
+        keywords = f"{fields['skills']} {resume_summary}"
+        job_description = select_sentences(job_description, job_budget, keywords=keywords)
+
+        prompt = template.format(job_description=job_description, **fields)
+        return prompt, count_tokens(prompt)
+
+    def chat(self, user_message, conversation_history=None, summary=''):
+        turn = f"\nUser: {user_message}\nBot:"
+        turn_tokens = count_tokens(turn)
+        if turn_tokens > self.budget:
+            turn = f"\nUser: {truncate_to_tokens(user_message, self.budget - 4)}\nBot:"
+            turn_tokens = count_tokens(turn)
+
+        header = ''
+        if summary:
+            header = f"Conversation so far:\n{summary}\n"
+            if turn_tokens + count_tokens(header) > self.budget:
+                header = ''
+
+        # Newest exchanges first, stopping at the first that doesn't fit
+        remaining = self.budget - turn_tokens - count_tokens(header)
+        exchanges = []
+        for msg in reversed(conversation_history or []):
+            exchange = f"User: {msg['message']}\nBot: {msg['response']}"
+            tokens = count_tokens(exchange) + 1
+            if tokens > remaining:
+                break
+            exchanges.append(exchange)
+            remaining -= tokens
+
+        context = "\n".join(reversed(exchanges))
+        prompt = f"{header}{context}{turn}"
+        return prompt, count_tokens(prompt)
@@ -0,0 +1,51 @@
+import re
+import time
+from collections import Counter
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%s|\?')
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_SPACE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """
+    SQL with its literal values taken out, so the same query run for
+    different rows (the signature of an N+1) counts as one:
+        SELECT ... WHERE "api_job"."id" = 3  ->  ... WHERE "api_job"."id" = ?
+    """
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _PLACEHOLDER.sub('?', sql)
+    sql = _IN_LIST.sub('(...)', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+class QueryStats:
+    """
+    Query count, time in the database and per-fingerprint counts for one
+    request. Installed with `connection.execute_wrapper(stats)` by
+    QueryInstrumentationMiddleware.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+            self.fingerprints[fingerprint(sql)] += 1
+
+    def repeated(self, threshold):
+        """[(fingerprint, count)] of queries run at least `threshold` times, most first"""
+        return [(sql, count) for sql, count in self.fingerprints.most_common() if count >= threshold]
+
+    def server_timing(self):
+        return f'db;dur={self.duration * 1000:.1f};desc="{self.count} queries"'
@@ -0,0 +1,290 @@
+from collections import namedtuple
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
+from .models import UserAIQuota
+from .redis_client import LuaScript, get_redis_client
+
+DAY_TTL = 60 * 60 * 48
+MONTH_TTL = 60 * 60 * 24 * 32
+DIRTY_KEY = 'ai_quota:dirty'
+# Other cache backends: one flag per user, since a shared set can't be
+# updated atomically
+DIRTY_FLAG = 'ai_quota:dirty:{user_id}'
+
+# KEYS: day counter, month counter, dirty set
+# ARGV: daily limit, monthly limit (-1 = unlimited), day seed, month seed,
+#       day ttl, month ttl, user id
+CHECK_AND_INCREMENT = LuaScript("""
+redis.call('SET', KEYS[1], ARGV[3], 'NX', 'EX', ARGV[5])
+redis.call('SET', KEYS[2], ARGV[4], 'NX', 'EX', ARGV[6])
+local daily = tonumber(redis.call('GET', KEYS[1]))
+local monthly = tonumber(redis.call('GET', KEYS[2]))
+local daily_limit = tonumber(ARGV[1])
+local monthly_limit = tonumber(ARGV[2])
+if (daily_limit >= 0 and daily >= daily_limit) or (monthly_limit >= 0 and monthly >= monthly_limit) then
+    return {0, daily, monthly}
+end
+daily = redis.call('INCR', KEYS[1])
+monthly = redis.call('INCR', KEYS[2])
+redis.call('SADD', KEYS[3], ARGV[7])
+return {1, daily, monthly}
+""")
+
+# KEYS: day counter, month counter
+# A counter that expired or rolled over since the reservation is left
+# alone rather than recreated at -1
+RELEASE = LuaScript("""
+for _, key in ipairs(KEYS) do
+    if tonumber(redis.call('GET', key) or '0') > 0 then
+        redis.call('DECR', key)
+    end
+end
+return 0
+""")
+
+
+class Reservation(namedtuple('Reservation', ['allowed', 'daily_usage', 'monthly_usage', 'quota', 'day'])):
+    """
+    Capacity held for one AI request. Usage counts include the held
+    request; `day` is the period it was taken from.
+    """
+
+    @property
+    def daily_remaining(self):
+        return max(0, self.quota.daily_limit - self.daily_usage)
+
+    @property
+    def monthly_remaining(self):
+        return max(0, self.quota.monthly_limit - self.monthly_usage)
+
+
+class QuotaCounter:
+    """
+    AI usage counters for UserAIQuota, kept in the cache
+
+    One counter per user per day and per month. `reserve` checks both
+    limits and takes one unit in a single atomic step (one Lua script
+    round trip on Redis), so concurrent requests can't lose increments or
+    slip past the limit. The unit is held while the upstream call runs:
+    `commit` keeps it, `release` gives it back when the generation failed.
+    Users touched since the last run are tracked in a set and `reconcile`
+    writes their totals back to UserAIQuota in bulk.
+
+    Other cache backends (LocMemCache in tests) use cache.incr, which is
+    atomic per key, and a dirty flag per user.
+    """
+
+    def _keys(self, user_id, today):
+        return (
+            f'ai_quota:{user_id}:day:{today:%Y%m%d}',
+            f'ai_quota:{user_id}:month:{today:%Y%m}',
+        )
+
+    def reserve(self, quota):
+        """Hold one AI request against `quota` if both limits allow it"""
+        today = timezone.localdate()
+        day_key, month_key = self._keys(quota.user_id, today)
+        # Counters that went missing (e.g. Redis restarted) resume from the
+        # last reconciled totals, as long as those are for the same period
+        day_seed, month_seed = quota._period_usage(today)
+        daily_limit = -1 if quota.is_premium else quota.daily_limit
+        monthly_limit = -1 if quota.is_premium else quota.monthly_limit
+
+        client = get_redis_client()
+        if client is not None:
+            allowed, daily, monthly = CHECK_AND_INCREMENT(
+                client,
+                keys=[day_key, month_key, DIRTY_KEY],
+                args=[daily_limit, monthly_limit, day_seed, month_seed, DAY_TTL, MONTH_TTL, quota.user_id],
+            )
+            return Reservation(bool(allowed), int(daily), int(monthly), quota, today)
+
+        cache.add(day_key, day_seed, DAY_TTL)
+        cache.add(month_key, month_seed, MONTH_TTL)
+        daily = cache.incr(day_key)
+        if 0 <= daily_limit < daily:
+            cache.decr(day_key)
+            return Reservation(False, daily - 1, cache.get(month_key, 0), quota, today)
+        monthly = cache.incr(month_key)
+        if 0 <= monthly_limit < monthly:
+            cache.decr(day_key)
+            cache.decr(month_key)
+            return Reservation(False, daily - 1, monthly - 1, quota, today)
+
+        self.mark_dirty([quota.user_id])
+        return Reservation(True, daily, monthly, quota, today)
+
+    def commit(self, reservation):
+        """Keep the reserved unit; it was counted when reserved"""
+
+    def release(self, reservation):
+        """Give back a reserved unit, e.g. when the generation fell back"""
+        if not reservation.allowed:
+            return
+        keys = self._keys(reservation.quota.user_id, reservation.day)
+
+        client = get_redis_client()
+        if client is not None:
+            RELEASE(client, keys=list(keys), args=[])
+            return
+
+        for key in keys:
+            try:
+                cache.decr(key)
+            except ValueError:
+                # Counter expired meanwhile, nothing left to give back
+                pass
+
+    def usage(self, user_ids):
+        """Current (daily, monthly) counts for each user id"""
+        today = timezone.localdate()
+        keys = {user_id: self._keys(user_id, today) for user_id in user_ids}
+        flat = [key for pair in keys.values() for key in pair]
+
+        client = get_redis_client()
+        if client is not None:
+            values = dict(zip(flat, client.mget([cache.make_key(key) for key in flat])))
+        else:
+            values = cache.get_many(flat)
+
+        return {
+            user_id: (int(values.get(day_key) or 0), int(values.get(month_key) or 0))
+            for user_id, (day_key, month_key) in keys.items()
+        }
+
+    def pop_dirty(self, batch_size=1000):
+        """Ids of users counted since the last call, clearing the set"""
+        client = get_redis_client()
+        if client is not None:
+            key = cache.make_key(DIRTY_KEY)
+            pipe = client.pipeline(transaction=True)
+            pipe.smembers(key)
+            pipe.delete(key)
+            members, _ = pipe.execute()
+            return {int(member) for member in members}
+
+        # Flags can't be listed, so check every user with a quota row
+        dirty = set()
+        user_ids = list(UserAIQuota.objects.values_list('user_id', flat=True).order_by('user_id'))
+        for start in range(0, len(user_ids), batch_size):
+            flags = {DIRTY_FLAG.format(user_id=user_id): user_id for user_id in user_ids[start:start + batch_size]}
+            found = cache.get_many(list(flags))
+            cache.delete_many(list(found))
+            dirty.update(flags[key] for key in found)
+        return dirty
+
+    def mark_dirty(self, user_ids):
+        if not user_ids:
+            return
+        client = get_redis_client()
+        if client is not None:
+            client.sadd(cache.make_key(DIRTY_KEY), *user_ids)
+            return
+        cache.set_many({DIRTY_FLAG.format(user_id=user_id): True for user_id in user_ids}, None)
+
+    def reset(self, user_ids, daily=True, monthly=False):
+        """Zero the current period's counters, e.g. from the admin"""
+        today = timezone.localdate()
+        keys = []
+        for user_id in user_ids:
+            day_key, month_key = self._keys(user_id, today)
+            if daily:
+                keys.append(day_key)
+            if monthly:
+                keys.append(month_key)
+        cache.delete_many(keys)
+
+    def reconcile(self, batch_size=500):
+        """
+        Write counters of recently active users back to UserAIQuota.
+        Returns the number of rows updated.
+        """
+        user_ids = sorted(self.pop_dirty())
+        today = timezone.localdate()
+        updated = 0
+        try:
+            for start in range(0, len(user_ids), batch_size):
+                batch = user_ids[start:start + batch_size]
+                counts = self.usage(batch)
+                quotas = list(UserAIQuota.objects.filter(user_id__in=batch))
+                for quota in quotas:
+                    quota.daily_usage, quota.monthly_usage = counts[quota.user_id]
+                    quota.last_reset_date = today
+                updated += UserAIQuota.objects.bulk_update(
+                    quotas, ['daily_usage', 'monthly_usage', 'last_reset_date']
+                )
+        except Exception:
+            # Put them back so the next run picks them up
+            self.mark_dirty(user_ids)
+            raise
+        return updated
+
+
+class DatabaseQuotaCounter:
+    """
+    Same API as QuotaCounter, counting directly on the UserAIQuota row
+
+    Each reservation is one conditional UPDATE that only matches while
+    the row is under its limits, so concurrent requests can't overshoot
+    and no row lock is held. For deployments without Redis.
+    """
+
+    def reserve(self, quota):
+        today = timezone.localdate()
+        if quota.last_reset_date != today:
+            # Start the new period; a no-op if a concurrent request already did
+            daily, monthly = quota._period_usage(today)
+            UserAIQuota.objects.filter(
+                pk=quota.pk,
+                last_reset_date=quota.last_reset_date
+            ).update(daily_usage=daily, monthly_usage=monthly, last_reset_date=today)
+
+        rows = UserAIQuota.objects.filter(pk=quota.pk, last_reset_date=today)
+        if not quota.is_premium:
+            rows = rows.filter(daily_usage__lt=F('daily_limit'), monthly_usage__lt=F('monthly_limit'))
+        allowed = rows.update(
+            daily_usage=F('daily_usage') + 1,
+            monthly_usage=F('monthly_usage') + 1
+        ) == 1
+
+        quota.refresh_from_db(fields=['daily_usage', 'monthly_usage', 'last_reset_date'])
+        return Reservation(allowed, quota.daily_usage, quota.monthly_usage, quota, today)
+
+    def commit(self, reservation):
+        """Keep the reserved unit; it was counted when reserved"""
+
+    def release(self, reservation):
+        if not reservation.allowed:
+            return
+        UserAIQuota.objects.filter(
+            pk=reservation.quota.pk,
+            last_reset_date=reservation.day,
+            daily_usage__gt=0
+        ).update(
+            daily_usage=F('daily_usage') - 1,
+            monthly_usage=F('monthly_usage') - 1
+        )
+
+    def usage(self, user_ids):
+        today = timezone.localdate()
+        return {
+            quota.user_id: quota._period_usage(today)
+            for quota in UserAIQuota.objects.filter(user_id__in=user_ids)
+        }
+
+    def reset(self, user_ids, daily=True, monthly=False):
+        """Nothing to do, the rows are the counters"""
+
+    def reconcile(self, batch_size=500):
+        """Nothing to do, the rows are the counters"""
+        return 0
+
+
+QUOTA_COUNTERS = {
+    'cache': QuotaCounter,
+    'database': DatabaseQuotaCounter,
+}
+
+quota_counter = QUOTA_COUNTERS[settings.AI_QUOTA_STORE]()
@@ -0,0 +1,34 @@
+from django.core.cache import cache
+
+
+def get_redis_client():
+    """Raw Redis client behind the default cache, or None for other backends"""
+    # Same check as django_redis.get_redis_connection, without raising on
+    # every call when the cache isn't Redis
+    client = getattr(cache, 'client', None)
+    if client is None or not hasattr(client, 'get_client'):
+        return None
+    return client.get_client(write=True)
+
+
+class LuaScript:
+    """
+    Server-side script run against the default cache's Redis
+
+    Keys are passed through the cache's key function, so scripts share the
+    cache's prefix and version. The script is registered on first use and
+    afterwards sent by SHA.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self._script = None
+
+    def __call__(self, client, keys, args):
+        if self._script is None:
+            self._script = client.register_script(self.source)
+        return self._script(
+            keys=[cache.make_key(key) for key in keys],
+            args=args,
+            client=client,
+        )
@@ -0,0 +1,127 @@
+import random
+import threading
+import time
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+
+def parse_retry_after(value, now=None):
+    """
+    Parse a Retry-After header (delta-seconds or HTTP-date) into seconds.
+    Returns None when the header is missing or unparseable.
+    """
+    if not isinstance(value, str) or not value.strip():
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+
+    now = now or datetime.now(timezone.utc)
+    return max(0.0, (retry_at - now).total_seconds())
+
+
+class RetryBudget:
+    """
+    Caps retries at a fraction of regular traffic
+
+    Every first attempt deposits `ratio` tokens and every retry spends one,
+    so during an outage retries add at most `ratio` extra load on top of a
+    small `reserve` that lets low-traffic workers retry at all.
+    The budget is per worker process.
+    """
+
+    def __init__(self, ratio=0.1, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = float(reserve)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            # Rounded so ten deposits of 0.1 really make one token
+            self.tokens = min(self.reserve, round(self.tokens + self.ratio, 6))
+
+    def try_spend(self):
+        with self._lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class RetryStats:
+    """Per-worker counters for attempts made per upstream call"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.attempts = Counter()
+            self.outcomes = Counter()
+
+    def record(self, attempts, outcome):
+        with self._lock:
+            self.calls += 1
+            self.attempts[attempts] += 1
+            self.outcomes[outcome] += 1
+
+    def snapshot(self):
+        with self._lock:
+            total_attempts = sum(n * count for n, count in self.attempts.items())
+            return {
+                'calls': self.calls,
+                'attempts': dict(self.attempts),
+                'outcomes': dict(self.outcomes),
+                'avg_attempts': total_attempts / self.calls if self.calls else 0,
+            }
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter for transient upstream failures
+
+    Usage:
+        policy = RetryPolicy(max_attempts=3, budget=RetryBudget(0.1))
+        delay = policy.backoff(attempt, retry_after=parse_retry_after(header))
+    """
+
+    RETRYABLE_STATUSES = frozenset({429, 502, 503, 504})
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8.0,
+                 budget=None, stats=None, rng=random.random, sleep=time.sleep):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+        self.stats = stats or RetryStats()
+        self.rng = rng
+        self.sleep = sleep
+
+    def is_retryable_status(self, status_code):
+        return status_code in self.RETRYABLE_STATUSES
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Delay before the attempt following `attempt` (1-based).
+        Returns None when the server asked us to wait longer than max_delay.
+        """
+        if retry_after is not None:
+            if retry_after > self.max_delay:
+                return None
+            # Server told us when to come back; only add a little spread
+            return retry_after * (1 + 0.1 * self.rng())
+
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return ceiling * self.rng()
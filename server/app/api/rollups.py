@@ -0,0 +1,198 @@
+import ipaddress
+from datetime import timedelta, timezone as dt_timezone
+from django.db import transaction
+from .models import AIUsageLog, AIUsageRollup
+from .sketches import LatencySketch
+
+
+def hour_of(moment):
+    """Start of the UTC hour containing `moment`"""
+    return moment.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def ip_bucket(address):
+    """
+    The address rollups group a client under: IPv4 addresses as they are,
+    IPv6 ones by /64 network (usually one host or household)
+    """
+    if not address:
+        return None
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return None
+    if ip.version == 6:
+        if ip.ipv4_mapped:
+            return str(ip.ipv4_mapped)
+        return str(ipaddress.ip_network(f'{ip}/64', strict=False).network_address)
+    return str(ip)
+
+
+def _key(rollup):
+    return (rollup.hour, rollup.user_id, rollup.endpoint, rollup.ip_bucket, rollup.status_class)
+
+
+def aggregate(logs):
+    """
+    Fold usage logs (AIUsageLog instances, or named value rows with the
+    same attributes) into unsaved AIUsageRollup rows, one per rollup key
+    """
+    rollups = {}
+    sketches = {}
+    for log in logs:
+        key = (
+            hour_of(log.created_at),
+            log.user_id,
+            log.endpoint,
+            ip_bucket(log.ip_address),
+            log.status_code // 100,
+        )
+        rollup = rollups.get(key)
+        if rollup is None:
+            rollup = rollups[key] = AIUsageRollup(
+                hour=key[0], user_id=key[1], endpoint=key[2], ip_bucket=key[3], status_class=key[4]
+            )
+            sketches[key] = LatencySketch()
+        rollup.count += 1
+        rollup.duration_sum += log.duration
+        rollup.prompt_tokens += log.prompt_tokens or 0
+        sketches[key].add(log.duration)
+
+    for key, rollup in rollups.items():
+        rollup.latency = sketches[key].to_json()
+    return rollups
+
+
+def record_rollups(logs):
+    """
+    Add newly written usage logs to their hourly rollups
+
+    Registered as a UsageLogBuffer listener, so it runs once per flushed
+    batch. Existing rows are locked while they're merged into. Two
+    workers may both create a row for a new key; reports sum rows per
+    group, so that only costs a row.
+    """
+    pending = aggregate(logs)
+    if not pending:
+        return
+
+    with transaction.atomic():
+        existing = {}
+        rows = AIUsageRollup.objects.select_for_update().filter(
+            hour__in={key[0] for key in pending},
+            endpoint__in={key[2] for key in pending},
+        )
+        for row in rows:
+            existing.setdefault(_key(row), row)
+
+        created, updated = [], []
+        for key, rollup in pending.items():
+            row = existing.get(key)
+            if row is None:
+                created.append(rollup)
+                continue
+            row.count += rollup.count
+            row.duration_sum += rollup.duration_sum
+            row.prompt_tokens += rollup.prompt_tokens
+            row.latency = LatencySketch(row.latency).merge(LatencySketch(rollup.latency)).to_json()
+            updated.append(row)
+
+        AIUsageRollup.objects.bulk_create(created)
+        AIUsageRollup.objects.bulk_update(updated, ['count', 'duration_sum', 'prompt_tokens', 'latency'])
+
+
+def rebuild_rollups(start, end):
+    """
+    Recompute the rollups of every hour overlapping [start, end) from raw
+    AIUsageLog rows, e.g. to backfill history. Returns the rows written.
+    """
+    start = hour_of(start)
+    end = hour_of(end) + (timedelta(hours=1) if end != hour_of(end) else timedelta(0))
+    logs = AIUsageLog.objects.filter(created_at__gte=start, created_at__lt=end).values_list(
+        'user_id', 'endpoint', 'ip_address', 'status_code', 'duration', 'prompt_tokens', 'created_at',
+        named=True
+    ).order_by()
+
+    with transaction.atomic():
+        AIUsageRollup.objects.filter(hour__gte=start, hour__lt=end).delete()
+        rollups = aggregate(logs.iterator(chunk_size=5000))
+        AIUsageRollup.objects.bulk_create(rollups.values(), batch_size=1000)
+    return len(rollups)
+
+
+class UsageSummary:
+    """
+    Report totals accumulated in one pass over rollup rows
+
+    Takes `values()` dicts of AIUsageRollup with count, duration_sum,
+    prompt_tokens, latency, status_class, endpoint and user__username,
+    and keeps per-status counts, duration and token totals, merged
+    latency sketches overall and per endpoint, and per-user counts.
+    """
+
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self):
+        self.total = 0
+        self.by_status = {}
+        self.duration_sum = 0.0
+        self.prompt_tokens = 0
+        self.users = {}
+        self.endpoints = {}
+        # Raw sketch buckets, merged without decoding each row into a LatencySketch
+        self._latency = {}
+
+    @staticmethod
+    def _merge(buckets, other):
+        for index, count in other.items():
+            buckets[index] = buckets.get(index, 0) + count
+
+    def add(self, row):
+        count = row['count']
+        self.total += count
+        status_class = f"{row['status_class']}xx"
+        self.by_status[status_class] = self.by_status.get(status_class, 0) + count
+        self.duration_sum += row['duration_sum']
+        self.prompt_tokens += row['prompt_tokens']
+        self._merge(self._latency, row['latency'])
+
+        username = row['user__username']
+        self.users[username] = self.users.get(username, 0) + count
+
+        endpoint = self.endpoints.get(row['endpoint'])
+        if endpoint is None:
+            endpoint = self.endpoints[row['endpoint']] = {'count': 0, 'duration_sum': 0.0, 'latency': {}}
+        endpoint['count'] += count
+        endpoint['duration_sum'] += row['duration_sum']
+        self._merge(endpoint['latency'], row['latency'])
+
+    @property
+    def successful(self):
+        return self.by_status.get('2xx', 0)
+
+    @property
+    def latency(self):
+        return LatencySketch(self._latency)
+
+    def percentiles(self, sketch=None):
+        if sketch is None:
+            sketch = self.latency
+        return {f'p{p}': sketch.quantile(p / 100) for p in self.PERCENTILES}
+
+    def top_users(self, limit=10):
+        ranked = sorted(self.users.items(), key=lambda item: -item[1])[:limit]
+        return [{'user__username': username, 'count': count} for username, count in ranked]
+
+    def endpoint_usage(self):
+        return [
+            {
+                'endpoint': name,
+                'count': endpoint['count'],
+                'avg_duration': endpoint['duration_sum'] / endpoint['count'],
+                **{
+                    f'{key}_duration': value
+                    for key, value in self.percentiles(LatencySketch(endpoint['latency'])).items()
+                },
+            }
+            for name, endpoint in sorted(self.endpoints.items(), key=lambda item: -item[1]['count'])
+        ]
@@ -0,0 +1,131 @@
+import hashlib
+import math
+
+
+class LatencySketch:
+    """
+    Log-bucketed histogram of durations, for percentiles without raw rows
+
+    Bucket i counts values in (GAMMA**(i-1), GAMMA**i] seconds, so any
+    quantile is known to within about 5% of its value. Sketches merge by
+    adding bucket counts: hourly sketches combine into any longer window.
+    Stored as a small JSON object of {bucket index: count}.
+
+    Usage:
+        sketch = LatencySketch()
+        sketch.add(0.42)
+        sketch.quantile(0.95)
+    """
+
+    GAMMA = 1.1
+    MIN_VALUE = 0.001  # seconds; anything faster shares the lowest bucket
+
+    def __init__(self, buckets=None):
+        self.buckets = {int(index): count for index, count in (buckets or {}).items()}
+
+    @classmethod
+    def bucket(cls, value):
+        return math.ceil(math.log(max(value, cls.MIN_VALUE)) / math.log(cls.GAMMA))
+
+    @property
+    def count(self):
+        return sum(self.buckets.values())
+
+    def add(self, value, count=1):
+        index = self.bucket(value)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        return self
+
+    def quantile(self, q):
+        """Estimated value at quantile `q` (0..1), or None when empty"""
+        total = self.count
+        if not total:
+            return None
+        # Nearest rank: the smallest value with at least q of the total at or below it
+        rank = max(1, math.ceil(q * total))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                break
+        # Midpoint of the bucket, which bounds the relative error both ways
+        return 2 * self.GAMMA ** index / (self.GAMMA + 1)
+
+    def to_json(self):
+        return {str(index): count for index, count in self.buckets.items()}
+
+
+class HyperLogLog:
+    """
+    Approximate distinct count in fixed memory (2**p one-byte registers)
+
+    With the default p=12 (4 KB) the standard error is about 1.6%.
+    Sketches of the same p merge by taking the larger register, so hourly
+    sketches give the distinct count of any span of hours. Pure Python;
+    on Redis the native PFADD/PFCOUNT are used instead (see api/analytics.py).
+    """
+
+    def __init__(self, p=12, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+
+    def add(self, value):
+        x = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+        index = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        # Position of the first 1 bit in the remaining bits
+        rank = 64 - self.p - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            # Small cardinalities: linear counting is more accurate
+            return round(self.m * math.log(self.m / zeros))
+        return round(estimate)
+
+
+class TopK:
+    """
+    Heavy hitters in bounded memory (Space-Saving)
+
+    Tracks at most `capacity` items. A new item arriving when full takes
+    the place of the smallest one and inherits its count, so counts are
+    never underestimated and any item seen more than total / capacity
+    times is guaranteed to be tracked. Keep `capacity` well above the
+    number of items you ask `top` for.
+    """
+
+    def __init__(self, capacity=100, counts=None):
+        self.capacity = capacity
+        self.counts = dict(counts or {})
+
+    def add(self, item, count=1):
+        if item in self.counts or len(self.counts) < self.capacity:
+            self.counts[item] = self.counts.get(item, 0) + count
+            return
+        smallest = min(self.counts, key=self.counts.get)
+        self.counts[item] = self.counts.pop(smallest) + count
+
+    def merge(self, other):
+        for item, count in other.counts.items():
+            self.counts[item] = self.counts.get(item, 0) + count
+        if len(self.counts) > self.capacity:
+            self.counts = dict(self.top(self.capacity))
+        return self
+
+    def top(self, n=10):
+        """[(item, count)] for the `n` largest counts"""
+        return sorted(self.counts.items(), key=lambda item: -item[1])[:n]
@@ -1,5 +1,74 @@
-from rest_framework.throttling import UserRateThrottle, AnonRateThrottle
+import math
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.throttling import BaseThrottle, UserRateThrottle, AnonRateThrottle
 from rest_framework.exceptions import Throttled 
+from .anomaly import anomaly_detector
+from .limiters import LocalBlocklist
+from .metrics import THROTTLE_REJECTIONS
+from .redis_client import LuaScript, get_redis_client
+
+# KEYS: one key per scope
+# ARGV: now, unique member, then kind and two numbers for each key:
+#   'window': limit, duration  -> sorted set of request timestamps
+#   'bucket': capacity, refill per second  -> hash of tokens and last update
+# Returns {allowed, wait} with wait as a string (Lua numbers become ints)
+RATE_LIMITS = LuaScript("""
+local now = tonumber(ARGV[1])
+local denied = false
+local wait = 0
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local kind = ARGV[3 * i]
+    local a = tonumber(ARGV[3 * i + 1])
+    local b = tonumber(ARGV[3 * i + 2])
+    local scope_wait = nil
+    if kind == 'bucket' then
+        local state = redis.call('HMGET', key, 'tokens', 'ts')
+        local level = tonumber(state[1]) or a
+        local ts = tonumber(state[2]) or now
+        level = math.min(a, level + math.max(0, now - ts) * b)
+        levels[i] = level
+        if level < 1 then
+            scope_wait = (1 - level) / b
+        end
+    else
+        redis.call('ZREMRANGEBYSCORE', key, '-inf', now - b)
+        local count = redis.call('ZCARD', key)
+        if count >= a then
+            scope_wait = b
+            if a > 0 then
+                -- The request that has to age out before one more fits
+                local oldest = redis.call('ZRANGE', key, count - a, count - a, 'WITHSCORES')
+                scope_wait = tonumber(oldest[2]) + b - now
+            end
+        end
+    end
+    if scope_wait then
+        denied = true
+        if scope_wait > wait then
+            wait = scope_wait
+        end
+    end
+end
+if denied then
+    return {0, tostring(wait)}
+end
+for i, key in ipairs(KEYS) do
+    local a = tonumber(ARGV[3 * i + 1])
+    local b = tonumber(ARGV[3 * i + 2])
+    if ARGV[3 * i] == 'bucket' then
+        redis.call('HSET', key, 'tokens', levels[i] - 1, 'ts', now)
+        redis.call('EXPIRE', key, math.ceil(a / b) + 1)
+    else
+        redis.call('ZADD', key, now, ARGV[2])
+        redis.call('EXPIRE', key, math.ceil(b))
+    end
+end
+return {1, '0'}
+""")
 
 class AIServiceThrottle(UserRateThrottle): 
     """ Strict rate limiting for AI-powered endpoints Prevents abuse of expensive AI API calls """ 
@@ -50,4 +119,205 @@ class DailyAILimitThrottle(UserRateThrottle):
 class AnonymousStrictThrottle(AnonRateThrottle): 
     """ Very strict throttle for anonymous users Prevents bot attacks """ 
     scope = 'anon_strict' 
-    rate = '5/hour'
\ No newline at end of file
+    rate = '5/hour'
+
+
+def get_user_plan(user):
+    """
+    'premium' or 'free', from the user's UserAIQuota; cached for
+    AI_PLAN_CACHE_TTL seconds (see invalidate_user_plan)
+    """
+    if not user or not user.is_authenticated:
+        return 'free'
+    key = f'ai_plan:{user.pk}'
+    plan = cache.get(key)
+    if plan is None:
+        from .models import UserAIQuota
+        is_premium = UserAIQuota.objects.filter(user=user).values_list('is_premium', flat=True).first()
+        plan = 'premium' if is_premium else 'free'
+        cache.set(key, plan, settings.AI_PLAN_CACHE_TTL)
+    return plan
+
+
+RATE_PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 60 * 60 * 24}
+
+
+def parse_rate(rate):
+    """(requests, seconds) from a DRF rate string such as '5/min' or '1000/day'"""
+    num, period = rate.split('/')
+    return int(num), RATE_PERIODS[period[0]]
+
+
+def invalidate_user_plan(user_ids):
+    cache.delete_many([f'ai_plan:{user_id}' for user_id in user_ids])
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Token bucket with a refill rate and bucket size per plan
+
+    Each user's bucket holds up to `burst` tokens and refills at `rate`
+    (a DRF rate string, e.g. '5/min'); a request takes one token. Plans
+    come from AI_THROTTLE_PLANS[scope], keyed by get_user_plan. The state
+    is two numbers per key, not a history list.
+    """
+
+    scope = None
+    timer = time.time
+    cache_format = 'throttle_bucket_%(scope)s_%(ident)s'
+
+    def __init__(self):
+        self._wait = None
+
+    def get_bucket(self, request):
+        """(capacity, tokens per second) for the requesting user's plan"""
+        plans = settings.AI_THROTTLE_PLANS[self.scope]
+        plan = plans.get(get_user_plan(request.user)) or plans['free']
+        num_requests, duration = parse_rate(plan['rate'])
+        return plan['burst'], num_requests / duration
+
+    def get_cache_key(self, request, view):
+        if request.user and request.user.is_authenticated:
+            ident = request.user.pk
+        else:
+            ident = self.get_ident(request)
+        return self.cache_format % {'scope': self.scope, 'ident': ident}
+
+    def spec(self, request, view):
+        capacity, refill = self.get_bucket(request)
+        return ('bucket', self.get_cache_key(request, view), capacity, refill)
+
+    def allow_request(self, request, view):
+        allowed, self._wait = evaluate_rate_limits([self.spec(request, view)], self.timer())
+        return allowed
+
+    def wait(self):
+        return self._wait
+
+
+class BurstTokenBucketThrottle(TokenBucketThrottle):
+    """ Burst protection with per-plan burst credit (see AI_THROTTLE_PLANS['burst']) """
+    scope = 'burst'
+
+
+def _window_spec(throttle, request, view):
+    if throttle.rate is None:
+        return None
+    key = throttle.get_cache_key(request, view)
+    if key is None:
+        return None
+    return ('window', key, throttle.num_requests, throttle.duration)
+
+
+def evaluate_rate_limits(specs, now):
+    """
+    Check and record one request against every (kind, key, a, b) spec at once.
+    Returns (allowed, wait seconds).
+    """
+    if not specs:
+        return True, 0
+
+    client = get_redis_client()
+    if client is not None:
+        args = [now, f'{now}:{uuid.uuid4().hex[:8]}']
+        for kind, key, a, b in specs:
+            args += [kind, a, b]
+        allowed, wait = RATE_LIMITS(
+            client,
+            keys=[f'{key}:log' if kind == 'window' else key for kind, key, a, b in specs],
+            args=args,
+        )
+        return bool(allowed), float(wait)
+
+    states = cache.get_many([key for kind, key, a, b in specs])
+    waits = []
+    updated = {}
+    timeouts = []
+    for kind, key, a, b in specs:
+        if kind == 'bucket':
+            capacity, refill = a, b
+            state = states.get(key) or {'tokens': capacity, 'ts': now}
+            level = min(capacity, state['tokens'] + max(0, now - state['ts']) * refill)
+            if level < 1:
+                waits.append((1 - level) / refill)
+            updated[key] = {'tokens': level - 1, 'ts': now}
+            timeouts.append(math.ceil(capacity / refill) + 1)
+        else:
+            num_requests, duration = a, b
+            history = [t for t in states.get(key, []) if t > now - duration]
+            if len(history) >= num_requests:
+                waits.append(history[num_requests - 1] + duration - now if num_requests else duration)
+            updated[key] = [now] + history
+            timeouts.append(duration)
+
+    if waits:
+        return False, max(waits)
+    cache.set_many(updated, max(timeouts))
+    return True, 0
+
+
+class CompositeRateThrottle(BaseThrottle):
+    """
+    Evaluate several rate throttles for a request in one cache round trip
+
+    Usage (in a view):
+        def get_throttles(self):
+            return [CompositeRateThrottle(self.throttle_classes)]
+
+    Each member keeps its own scope, rate and cache key; members can be
+    DRF rate throttles or TokenBucketThrottles. On Redis all scopes are
+    checked and recorded by one Lua script (sorted sets of timestamps for
+    rate throttles, hashes for buckets); a request is only recorded when
+    every scope allows it.
+    `wait()` is the longest wait of the scopes that refused, i.e. when
+    the request would next be let through. Other cache backends read all
+    histories with get_many and write them back with set_many.
+
+    A refused request is remembered in a per-worker LocalBlocklist until
+    its wait is over, so retries during a flood don't reach the cache.
+    Refusals are counted by the anomaly detector, since they never reach
+    the usage logs.
+    """
+
+    timer = time.time
+    # Shared by all composites in the worker, see LocalBlocklist
+    local_blocklist = LocalBlocklist(settings.LOCAL_BLOCKLIST_MAX_KEYS)
+
+    def __init__(self, throttle_classes):
+        self.throttles = [throttle_class() for throttle_class in throttle_classes]
+        self._wait = None
+
+    def _specs(self, request, view):
+        specs = []
+        for throttle in self.throttles:
+            if isinstance(throttle, TokenBucketThrottle):
+                spec = throttle.spec(request, view)
+            else:
+                spec = _window_spec(throttle, request, view)
+            if spec is not None:
+                specs.append(spec)
+        return specs
+
+    def allow_request(self, request, view):
+        specs = self._specs(request, view)
+        local_key = '|'.join(spec[1] for spec in specs)
+        retry_after = self.local_blocklist.retry_after(local_key)
+        if retry_after is not None:
+            self._wait = retry_after
+            self._rejected(request)
+            return False
+
+        allowed, self._wait = evaluate_rate_limits(specs, self.timer())
+        if not allowed:
+            self.local_blocklist.block(local_key, self._wait)
+            self._rejected(request)
+        return allowed
+
+    def _rejected(self, request):
+        from .middleware import get_client_ip
+        THROTTLE_REJECTIONS.inc(throttle='composite')
+        user = getattr(request, 'user', None)
+        anomaly_detector.reject(user.pk if user and user.is_authenticated else None, get_client_ip(request))
+
+    def wait(self):
+        return self._wait
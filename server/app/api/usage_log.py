@@ -0,0 +1,245 @@
+import atexit
+import json
+import logging
+import os
+import threading
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from redis.exceptions import RedisError
+from .models import AIUsageLog
+from .redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+
+QUEUE_KEY = 'usage_log:queue'
+
+
+def _serialize(row):
+    data = {field.attname: getattr(row, field.attname) for field in AIUsageLog._meta.concrete_fields if not field.primary_key}
+    data['created_at'] = data['created_at'].isoformat()
+    return json.dumps(data)
+
+
+def _deserialize(raw):
+    data = json.loads(raw)
+    data['created_at'] = parse_datetime(data['created_at'])
+    return AIUsageLog(**data)
+
+
+class UsageLogBuffer:
+    """
+    Queues AIUsageLog rows and writes them with bulk_create
+
+    log_ai_usage only queues the row. The queue is flushed when it holds
+    `batch_size` rows or every `flush_interval` seconds by a background
+    thread, and drained at interpreter exit. Settings come from
+    AI_USAGE_LOG_BUFFER; with `enabled` off every row is written
+    immediately as before. A failed flush keeps its rows for the next
+    one, up to `max_pending`, beyond which the oldest are dropped.
+
+    On Redis the queue is a list shared by every worker (RPUSH on add, a
+    MULTI'd LRANGE/LTRIM per batch on flush), so rows queued by a worker
+    that is killed (timeout, OOM, SIGKILL) are written by the next flush
+    of any other. Only a batch taken off the list by a worker that dies
+    before writing it is lost. Other caches, or Redis errors, fall back to
+    this worker's memory, which only survives a graceful shutdown.
+
+    Listeners added with `add_listener` are called with each batch once
+    it is written, e.g. to update AIUsageRollup.
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._stopped = False
+        self.dropped = 0
+        self._listeners = []
+        # Rows in Redis are left for the other workers
+        atexit.register(self._drain_local)
+
+    @property
+    def config(self):
+        return settings.AI_USAGE_LOG_BUFFER
+
+    def add_listener(self, callback):
+        """Call `callback(rows)` with every batch of rows written"""
+        self._listeners.append(callback)
+
+    def add(self, **fields):
+        config = self.config
+        if not config['enabled']:
+            self._notify([AIUsageLog.objects.create(**fields)])
+            return
+
+        # Stamp now, not when the batch is written
+        fields.setdefault('created_at', timezone.now())
+        row = AIUsageLog(**fields)
+        queued = self._push(row)
+        if queued is None:
+            with self._lock:
+                self._pending.append(row)
+                self._trim()
+                queued = len(self._pending)
+        full = queued >= config['batch_size']
+
+        if config['flush_interval'] is None:
+            if full:
+                self.flush()
+            return
+
+        self._ensure_thread()
+        if full:
+            self._wakeup.set()
+
+    def _push(self, row):
+        """Append to the shared queue; its length, or None without Redis"""
+        client = get_redis_client()
+        if client is None:
+            return None
+        max_pending = self.config['max_pending']
+        try:
+            pipe = client.pipeline(transaction=True)
+            pipe.rpush(cache.make_key(QUEUE_KEY), _serialize(row))
+            pipe.ltrim(cache.make_key(QUEUE_KEY), -max_pending, -1)
+            length, _ = pipe.execute()
+        except RedisError as e:
+            logger.error(f"Usage Log Queue Error - {str(e)}")
+            return None
+        if length > max_pending:
+            self.dropped += length - max_pending
+        return min(length, max_pending)
+
+    def _trim(self):
+        # Caller holds self._lock
+        overflow = len(self._pending) - self.config['max_pending']
+        if overflow > 0:
+            del self._pending[:overflow]
+            self.dropped += overflow
+
+    def pending(self):
+        with self._lock:
+            count = len(self._pending)
+        client = get_redis_client()
+        if client is not None:
+            try:
+                count += client.llen(cache.make_key(QUEUE_KEY))
+            except RedisError:
+                pass
+        return count
+
+    def flush(self):
+        """Write everything queued so far. Returns the number of rows written."""
+        with self._flush_lock:
+            written = self._flush_local()
+            client = get_redis_client()
+            if client is not None:
+                written += self._flush_shared(client)
+            return written
+
+    def _drain_local(self):
+        with self._flush_lock:
+            self._flush_local()
+
+    def _flush_local(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return 0
+        if not self._write(batch):
+            with self._lock:
+                self._pending[:0] = batch
+                self._trim()
+            return 0
+        return len(batch)
+
+    def _flush_shared(self, client):
+        key = cache.make_key(QUEUE_KEY)
+        batch_size = self.config['batch_size']
+        written = 0
+        while True:
+            try:
+                pipe = client.pipeline(transaction=True)
+                pipe.lrange(key, 0, batch_size - 1)
+                pipe.ltrim(key, batch_size, -1)
+                raw, _ = pipe.execute()
+            except RedisError as e:
+                logger.error(f"Usage Log Queue Error - {str(e)}")
+                return written
+            if not raw:
+                return written
+
+            batch = [_deserialize(item) for item in raw]
+            if not self._write(batch):
+                # Back to the front of the queue, in order
+                try:
+                    client.lpush(key, *reversed(raw))
+                except RedisError:
+                    with self._lock:
+                        self._pending[:0] = batch
+                        self._trim()
+                return written
+            written += len(batch)
+            if len(raw) < batch_size:
+                return written
+
+    def _write(self, batch):
+        try:
+            AIUsageLog.objects.bulk_create(batch, batch_size=self.config['batch_size'])
+        except Exception as e:
+            logger.error(f"Usage Log Flush Error - Rows: {len(batch)}, Error: {str(e)}")
+            return False
+        self._notify(batch)
+        return True
+
+    def _notify(self, rows):
+        # The rows are saved either way; a failing listener only logs
+        for callback in self._listeners:
+            try:
+                callback(rows)
+            except Exception as e:
+                logger.error(f"Usage Log Listener Error - {callback.__name__}: {str(e)}")
+
+    def discard(self):
+        """Drop queued rows without writing them (tests)"""
+        with self._lock:
+            self._pending = []
+        client = get_redis_client()
+        if client is not None:
+            client.delete(cache.make_key(QUEUE_KEY))
+
+    def _ensure_thread(self):
+        # Started lazily and again after a fork: threads don't survive it
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name='ai-usage-log', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """End the background thread after its current wait (tests)"""
+        self._stopped = True
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.config['flush_interval'])
+            self._wakeup.clear()
+            if self._stopped:
+                return
+            close_old_connections()
+            self.flush()
+
+
+usage_log_buffer = UsageLogBuffer()
@@ -1,5 +1,8 @@
-import requests
 from django.conf import settings
+from .backends import get_backend
+from .decorators import record_ai_usage
+from .metrics import AI_FALLBACKS
+from .prompts import PromptBuilder
 
 _job_embedding_model = None
 
@@ -18,52 +21,42 @@ def _cosine_similarity(embedding_a, embedding_b):
 
 class HuggingFaceAI:
     def __init__(self):
-        self.api_key = settings.HUGGINGFACE_API_KEY
-        self.api_url = "https://router.huggingface.co/hf-inference/models/"
+        self.backends = {
+            endpoint: get_backend(name)
+            for endpoint, name in settings.AI_INFERENCE_BACKENDS.items()
+        }
+
+    def backend_for(self, endpoint):
+        """Backend configured for `endpoint` (remote when not configured)"""
+        return self.backends.get(endpoint) or get_backend('remote')
 
-    def generate_cover_letter(self, resume_text, job_description, user_profile):
+    def generate_cover_letter(self, resume_text, job_description, user_profile, deadline=None):
         """Generate cover letter using Hugging Face API"""
         try:
             # model = "facebook/bart-large-cnn"
             model = "Qwen/Qwen3-4B-Instruct-2507"
-            headers = {"Authorization": f"Bearer {self.api_key}"}
-
-            prompt = f"""
-            Generate a professional cover letter based on the following:
-
-            Candidate Profile:
-            Name: {user_profile.get('name', '')}
-            Skills: {user_profile.get('skills', '')}
-            Bio: {user_profile.get('bio', '')}
-
-            Job Description:
-            {job_description}
-
-            Resume Summary:
-            {resume_text[:500] if resume_text else 'Not provided'}
-            """
-
-            payload = {
-                "inputs": prompt,
-                "parameters": {
-                    "max_length": 500,
-                    "min_length": 200,
-                    "do_sample": True,
-                    "temperature": 0.7
-                }
+
+            prompt, prompt_tokens = PromptBuilder('cover_letter').cover_letter(
+                resume_text, job_description, user_profile
+            )
+            backend = self.backend_for('cover_letter')
+            record_ai_usage(prompt_tokens=prompt_tokens, backend=backend.name)
+
+            parameters = {
+                "max_length": 500,
+                "min_length": 200,
+                "do_sample": True,
+                "temperature": 0.7
             }
 
-            response = requests.post(
-                f"{self.api_url}{model}",
-                headers=headers,
-                json=payload,
-                timeout=30
+            result = backend.generate(
+                model, prompt, parameters, deadline=deadline, endpoint='cover_letter'
             )
 
-            if response.status_code == 200:
-                result = response.json()
-                # Summarization task returns 'summary_text', not 'generated_text'
-                return result[0].get('summary_text', '')
+            if result:
+                # Summarization task returns 'summary_text'; text-generation
+                # backends (local, mock) return 'generated_text'
+                return result[0].get('summary_text') or result[0].get('generated_text', '')
             else:
                 return self._generate_fallback_cover_letter(user_profile, job_description)
 
@@ -73,6 +66,8 @@ class HuggingFaceAI:
 
     def _generate_fallback_cover_letter(self, user_profile, job_description):
         """Fallback cover letter generation"""
+        record_ai_usage(fallback=True)
+        AI_FALLBACKS.inc(feature='cover_letter')
         name = user_profile.get('name', 'Applicant')
         skills = user_profile.get('skills', 'various technical skills')
 
@@ -89,7 +84,7 @@ Thank you for considering my application. I look forward to the opportunity to s
 Sincerely,
 {name}"""
 
-    def generate_chat_response(self, user_message, conversation_history=None):
+    def generate_chat_response(self, user_message, conversation_history=None, deadline=None, hedge=None, summary=''):
         """Generate AI chat response using Hugging Face
 
         NOTE: Qwen3-4B-Instruct-2507 is a chat/instruct model. This sends a
@@ -99,37 +94,37 @@ Sincerely,
         for a chat model — vs. requiring /v1/chat/completions with a proper
         `messages` array — hasn't been confirmed against the live API yet.
         Worth a real test call before relying on this in production.
+
+        `summary` is the running conversation summary (ChatSummary) sent
+        ahead of `conversation_history`.
+
+        With hedging on (`hedge=True`, or AI_CHAT_HEDGING['enabled'] when
+        `hedge` is None) a duplicate request is sent if the first one is
+        slower than the configured latency percentile.
         """
         try:
             model = "Qwen/Qwen3-4B-Instruct-2507"
-            headers = {"Authorization": f"Bearer {self.api_key}"}
-
-            context = ""
-            if conversation_history:
-                recent = conversation_history[:3]
-                context = "\n".join([f"User: {msg['message']}\nBot: {msg['response']}"
-                                    for msg in recent])
-
-            prompt = f"{context}\nUser: {user_message}\nBot:"
-
-            payload = {
-                "inputs": prompt,
-                "parameters": {
-                    "max_length": 200,
-                    "temperature": 0.8,
-                    "top_p": 0.9
-                }
+
+            prompt, prompt_tokens = PromptBuilder('chat').chat(
+                user_message, conversation_history, summary=summary
+            )
+            backend = self.backend_for('chat')
+            record_ai_usage(prompt_tokens=prompt_tokens, backend=backend.name)
+
+            parameters = {
+                "max_length": 200,
+                "temperature": 0.8,
+                "top_p": 0.9
             }
 
-            response = requests.post(
-                f"{self.api_url}{model}",
-                headers=headers,
-                json=payload,
-                timeout=30
+            if hedge is None:
+                hedge = settings.AI_CHAT_HEDGING['enabled']
+
+            result = backend.generate(
+                model, prompt, parameters, deadline=deadline, endpoint='chat', hedge=hedge
             )
 
-            if response.status_code == 200:
-                result = response.json()
+            if result:
                 return result[0].get('generated_text', '').split('Bot:')[-1].strip()
             else:
                 return self._generate_fallback_response(user_message)
@@ -140,6 +135,8 @@ Sincerely,
 
     def _generate_fallback_response(self, user_message):
         """Fallback chat responses"""
+        record_ai_usage(fallback=True)
+        AI_FALLBACKS.inc(feature='chat')
         responses = {
             'interview': "For interview preparation, focus on these key areas: 1) Review common technical questions, 2) Practice behavioral questions using the STAR method, 3) Research the company thoroughly, 4) Prepare questions to ask the interviewer.",
             'resume': "To improve your resume: 1) Use action verbs and quantify achievements, 2) Tailor it to each job application, 3) Keep it concise (1-2 pages), 4) Include relevant keywords from job descriptions.",
@@ -175,4 +172,6 @@ Sincerely,
 
         except Exception as e:
             print(f"Error recommending jobs: {str(e)}")
+            record_ai_usage(fallback=True)
+            AI_FALLBACKS.inc(feature='recommendations')
             return jobs[:10]
\ No newline at end of file
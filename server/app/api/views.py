@@ -1,3 +1,6 @@
+import ipaddress
+from django.conf import settings
+from django.http import Http404, HttpResponse
 from django.shortcuts import render
 from .models import CustomUser, Job, SavedJob, CoverLetter, Application, ChatMessage
 from .serializer import UserSerializer, JobSerializer, JobListSerializer, SavedJobSerializer, CoverLetterSerializer, ApplicationSerializer, ChatMessageSerializer
@@ -9,16 +12,19 @@ from django.utils import timezone
 from django.utils.decorators import method_decorator
 from .throttling import (
     CoverLetterThrottle, ChatMessageThrottle, 
-    JobRecommendationThrottle, BurstRateThrottle,
-    DailyAILimitThrottle
+    JobRecommendationThrottle, BurstTokenBucketThrottle,
+    DailyAILimitThrottle, CompositeRateThrottle
 )
 from .validators import ContentValidator
-from .decorators import ai_rate_limit, require_verified_user, log_ai_usage
+from .decorators import ai_rate_limit, require_verified_user, log_ai_usage, ai_fallback_used
 from .models import AIUsageLog, UserAIQuota
 from rest_framework.response import Response
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth import get_user_model
 from .utils import HuggingFaceAI
+from .chat_context import get_chat_summary, record_chat_turn
+from .quota import quota_counter
+from . import metrics
 import logging
 
 ai_helper = HuggingFaceAI()
@@ -73,7 +79,7 @@ class UserViewSet(viewsets.ModelViewSet):
         return Response({'message': 'Logged out successfully'}, status=status.HTTP_200_OK)
     
 class JobViewSet(viewsets.ModelViewSet):
-    queryset = Job.objects.filter(is_active=True)
+    queryset = Job.objects.filter(is_active=True).select_related('posted_by')
     serializer_class = JobSerializer
     permission_classes = [IsAuthenticated]
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
@@ -122,24 +128,33 @@ class JobViewSet(viewsets.ModelViewSet):
                 "message": "Please update your skills in profile to get recommendations"
                 }, status=status.HTTP_400_BAD_REQUEST)
         
-        # Check quota
+        # Check quota and hold capacity for this request
         quota, created = UserAIQuota.objects.get_or_create(user=user)
-        if not quota.can_make_request():
+        reservation = quota_counter.reserve(quota)
+        if not reservation.allowed:
+            metrics.THROTTLE_REJECTIONS.inc(throttle='quota')
             return Response({
                 'error': 'Quota exceeded',
                 'message': 'AI recommendation limit reached'
             }, status=status.HTTP_429_TOO_MANY_REQUESTS)
         
+        settled = False
         try:
             jobs = Job.objects.filter(is_active=True)
             recommended_jobs = ai_helper.recommend_jobs(user.skills, jobs)
+            data = JobListSerializer(recommended_jobs, many=True).data
             
-            # Increment usage
-            quota.increment_usage()
+            # Only charge for real recommendations, settled exactly once
+            if ai_fallback_used():
+                quota_counter.release(reservation)
+            else:
+                quota_counter.commit(reservation)
+            settled = True
         
-            serializer = JobListSerializer(recommended_jobs, many=True)
-            return Response(serializer.data)
+            return Response(data)
         except Exception as e:
+            if not settled:
+                quota_counter.release(reservation)
             logger.error(f"Job Recommendation Error - User: {user.id}, Error: {str(e)}")
             return Response({
                 'error': 'Recommendation service error',
@@ -151,7 +166,8 @@ class SavedJobViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     
     def get_queryset(self):
-        return SavedJob.objects.filter(user=self.request.user)
+        # job_details shows the job and its poster's username
+        return SavedJob.objects.filter(user=self.request.user).select_related('job__posted_by')
     
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -180,15 +196,15 @@ class SavedJobViewSet(viewsets.ModelViewSet):
 class CoverLetterViewSet(viewsets.ModelViewSet):
     serializer_class = CoverLetterSerializer
     permission_classes = [IsAuthenticated]
-    throttle_classes = [CoverLetterThrottle, BurstRateThrottle, DailyAILimitThrottle]
+    throttle_classes = [CoverLetterThrottle, BurstTokenBucketThrottle, DailyAILimitThrottle]
     
     def get_throttles(self):
         if self.action == 'create':
-            return [throttle() for throttle in self.throttle_classes]
+            return [CompositeRateThrottle(self.throttle_classes)]
         return []
     
     def get_queryset(self):
-        return CoverLetter.objects.filter(user=self.request.user)
+        return CoverLetter.objects.filter(user=self.request.user).select_related('job')
     
     @method_decorator([require_verified_user, log_ai_usage])
     def create(self, request):
@@ -213,17 +229,6 @@ class CoverLetterViewSet(viewsets.ModelViewSet):
                 'message': str(e)
             }, status=status.HTTP_400_BAD_REQUEST)
             
-        # Check user quota
-        quota, created = UserAIQuota.objects.get_or_create(user=request.user)
-        
-        if not quota.can_make_request():
-            return Response({
-                'error': 'Quota exceeded',
-                'message': f'You have reached your AI generation limit',
-                'daily_remaining': max(0, quota.daily_limit - quota.daily_usage),
-                'monthly_remaining': max(0, quota.monthly_limit - quota.monthly_usage)
-            }, status=status.HTTP_429_TOO_MANY_REQUESTS)
-        
         # Check for duplicate requests (within 5 minutes)
         recent_letter = CoverLetter.objects.filter(
             user=request.user,
@@ -239,6 +244,19 @@ class CoverLetterViewSet(viewsets.ModelViewSet):
                 **serializer.data
             }, status=status.HTTP_200_OK)
         
+        # Check user quota and hold capacity for this request
+        quota, created = UserAIQuota.objects.get_or_create(user=request.user)
+        reservation = quota_counter.reserve(quota)
+        
+        if not reservation.allowed:
+            metrics.THROTTLE_REJECTIONS.inc(throttle='quota')
+            return Response({
+                'error': 'Quota exceeded',
+                'message': f'You have reached your AI generation limit',
+                'daily_remaining': reservation.daily_remaining,
+                'monthly_remaining': reservation.monthly_remaining
+            }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+        
         user = request.user
         user_profile = {
             'name': user.get_full_name() or user.username,
@@ -246,6 +264,7 @@ class CoverLetterViewSet(viewsets.ModelViewSet):
             'bio': user.bio or ''
         }
         
+        settled = False
         try:
             # Generate cover letter
             generated_letter = ai_helper.generate_cover_letter(
@@ -253,7 +272,7 @@ class CoverLetterViewSet(viewsets.ModelViewSet):
                 job_description, 
                 user_profile
             )
-        
+            
             # Save cover letter
             cover_letter_data = {
                 'user': user.id,
@@ -273,8 +292,12 @@ class CoverLetterViewSet(viewsets.ModelViewSet):
                 generated_letter=generated_letter
             )
             
-            # Increment usage
-            quota.increment_usage()
+            # Only charge for real generations, once the letter is saved
+            if ai_fallback_used():
+                quota_counter.release(reservation)
+            else:
+                quota_counter.commit(reservation)
+            settled = True
             
             # Log successful generation
             logger.info(f"Cover Letter Generated - User: {user.id}, Job Desc Length: {len(job_description)}")
@@ -282,6 +305,8 @@ class CoverLetterViewSet(viewsets.ModelViewSet):
             serializer = self.get_serializer(cover_letter)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         except Exception as e:
+            if not settled:
+                quota_counter.release(reservation)
             logger.error(f"Cover Letter Error - User: {user.id}, Error: {str(e)}")
             return Response({
                 'error': 'AI service error',
@@ -294,9 +319,11 @@ class ApplicationViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         user = self.request.user
+        # user_name and job_details (with the poster's username) in one query
+        queryset = Application.objects.select_related('user', 'job__posted_by')
         if user.is_staff:
-            return Application.objects.all()
-        return Application.objects.filter(user=user)
+            return queryset
+        return queryset.filter(user=user)
     
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -328,11 +355,11 @@ class ApplicationViewSet(viewsets.ModelViewSet):
 class ChatMessageViewSet(viewsets.ModelViewSet):
     serializer_class = ChatMessageSerializer
     permission_classes = [IsAuthenticated]
-    throttle_classes = [ChatMessageThrottle, BurstRateThrottle, DailyAILimitThrottle]
+    throttle_classes = [ChatMessageThrottle, BurstTokenBucketThrottle, DailyAILimitThrottle]
     
     def get_throttles(self):
         if self.action == 'create':
-            return [throttle() for throttle in self.throttle_classes]
+            return [CompositeRateThrottle(self.throttle_classes)]
         return []
     
     def get_queryset(self):
@@ -349,39 +376,63 @@ class ChatMessageViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
             
-        # Check user quota
+        # Check user quota and hold capacity for this request
         quota, created = UserAIQuota.objects.get_or_create(user=request.user)
+        reservation = quota_counter.reserve(quota)
         
-        if not quota.can_make_request():
+        if not reservation.allowed:
+            metrics.THROTTLE_REJECTIONS.inc(throttle='quota')
             return Response({
                 'error': 'Quota exceeded',
                 'message': 'You have reached your AI generation limit',
-                'daily_remaining': max(0, quota.daily_limit - quota.daily_usage),
-                'monthly_remaining': max(0, quota.monthly_limit - quota.monthly_usage)
+                'daily_remaining': reservation.daily_remaining,
+                'monthly_remaining': reservation.monthly_remaining
             }, status=status.HTTP_429_TOO_MANY_REQUESTS)
         
-        # Get recent conversation history
-        recent_messages = ChatMessage.objects.filter(
-            user=request.user
-        ).order_by('-created_at')[:5]
-        
-        conversation_history = [
-            {'message': msg.message, 'response': msg.response}
-            for msg in reversed(recent_messages)
-        ]
-        
-        # Generate AI response
-        ai_response = ai_helper.generate_chat_response(message_text, conversation_history)
+        try:
+            # Running summary + latest exchange; cached, so normally no DB read
+            chat_summary = get_chat_summary(request.user)
+            
+            # Generate AI response
+            ai_response = ai_helper.generate_chat_response(
+                message_text,
+                chat_summary.recent_exchanges,
+                summary=chat_summary.summary
+            )
+            
+            # Save message
+            chat_message = ChatMessage.objects.create(
+                user=request.user,
+                message=message_text,
+                response=ai_response
+            )
+        except Exception:
+            quota_counter.release(reservation)
+            raise
         
-        # Save message
-        chat_message = ChatMessage.objects.create(
-            user=request.user,
-            message=message_text,
-            response=ai_response
-        )
+        # Canned fallback replies aren't charged
+        if ai_fallback_used():
+            quota_counter.release(reservation)
+        else:
+            quota_counter.commit(reservation)
         
-        # Increment usage
-        quota.increment_usage()
+        record_chat_turn(chat_summary, message_text, ai_response)
         
         serializer = self.get_serializer(chat_message)
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
\ No newline at end of file
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint, for internal networks only
+    (METRICS['allowed_networks']). Requests relayed by a proxy carry
+    X-Forwarded-For and are refused, so it can't be reached through one.
+    """
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        raise Http404
+    allowed = any(address in ipaddress.ip_network(network) for network in settings.METRICS['allowed_networks'])
+    if not allowed or 'HTTP_X_FORWARDED_FOR' in request.META:
+        raise Http404
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -54,6 +54,12 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Outermost, so request latency includes every other middleware
+    'api.middleware.MetricsMiddleware',
+    'api.middleware.QueryInstrumentationMiddleware',
+    'api.middleware.ProfilingMiddleware',
+    # Before the rest so the AI request budget covers every later stage
+    'api.middleware.DeadlineMiddleware',
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -234,6 +240,170 @@ ALLOWED_UPLOAD_EXTENSIONS = ['pdf', 'doc', 'docx', 'txt', 'jpg', 'jpeg', 'png']
 HUGGINGFACE_API_KEY = config('HUGGINGFACE_API_KEY', default='')
 HUGGING_FACE_TIMEOUT = 30  # seconds
 
+# Inference backend per AI endpoint: 'remote' (Hugging Face router),
+# 'local' (AI_LOCAL_MODEL via transformers on CPU) or 'mock' (deterministic)
+AI_INFERENCE_BACKENDS = {
+    'cover_letter': config('AI_COVER_LETTER_BACKEND', default='remote'),
+    'chat': config('AI_CHAT_BACKEND', default='remote'),
+}
+AI_LOCAL_MODEL = config('AI_LOCAL_MODEL', default='Qwen/Qwen2.5-0.5B-Instruct')
+
+# Prompt size limits, counted with the generation model's tokenizer
+# (approximated when transformers isn't installed)
+AI_TOKENIZER_MODEL = config('AI_TOKENIZER_MODEL', default='Qwen/Qwen3-4B-Instruct-2507')
+AI_PROMPT_TOKEN_BUDGETS = {
+    'cover_letter': 1500,
+    'chat': 800,
+}
+
+# Chat prompts carry a running summary plus the last CHAT_HISTORY_WINDOW
+# exchanges verbatim (see ChatSummary)
+CHAT_HISTORY_WINDOW = 1
+CHAT_SUMMARY_MAX_TOKENS = 200
+
+# Token-bucket throttles per plan: refill `rate` and bucket size `burst`.
+# A user's plan comes from UserAIQuota.is_premium, cached for AI_PLAN_CACHE_TTL.
+AI_THROTTLE_PLANS = {
+    'burst': {
+        'free': {'rate': '5/min', 'burst': 5},
+        'premium': {'rate': '30/min', 'burst': 20},
+    },
+}
+AI_PLAN_CACHE_TTL = 300  # seconds
+
+# AIUsageLog rows are queued (in a Redis list shared by the workers, or in
+# worker memory without Redis) and written with bulk_create every
+# `batch_size` rows or `flush_interval` seconds
+AI_USAGE_LOG_BUFFER = {
+    'enabled': config('AI_USAGE_LOG_BUFFER', default=True, cast=bool),
+    'batch_size': 100,
+    'flush_interval': 5.0,  # seconds; None flushes on batch size only
+    'max_pending': 10000,
+}
+
+# On Postgres AIUsageLog is partitioned by month (migration 0013):
+# maintain_usage_logs keeps partitions ready ahead and drops whole expired
+# months. Elsewhere it deletes expired rows in batches.
+AI_USAGE_LOG_PARTITIONS_AHEAD = 3
+AI_USAGE_LOG_RETENTION_MONTHS = config('AI_USAGE_LOG_RETENTION_MONTHS', default=6, cast=int)
+
+# Per-hour distinct counts and top users/IPs in the cache (api/analytics.py),
+# for ai_usage_report --fast
+AI_USAGE_ANALYTICS = {
+    'enabled': config('AI_USAGE_ANALYTICS', default=True, cast=bool),
+    'top_capacity': 100,  # items tracked per hour; keep well above the top N asked for
+    'ttl_days': 32,
+}
+
+# X-Forwarded-For is only believed from these proxies (comma-separated
+# networks, e.g. the load balancer's). Empty: REMOTE_ADDR is the client.
+TRUSTED_PROXIES = [
+    network.strip() for network in config('TRUSTED_PROXIES', default='').split(',') if network.strip()
+]
+
+# AI requests per IP per hour (IPRateLimitMiddleware)
+IP_RATE_LIMIT = 20
+
+# Streaming abuse detection over the usage-log pipeline (api/anomaly.py).
+# A user or IP over a threshold within `window` seconds is blocked from
+# AI endpoints for `block_seconds`. Requests refused by the throttles and
+# the IP limit are counted as well, so the request thresholds sit well
+# above what those let through (60/hour per user across the AI endpoints,
+# IP_RATE_LIMIT per IP): only clients that keep going after their 429s
+# are flagged. Only 5xx responses count as errors.
+AI_ANOMALY_DETECTION = {
+    'enabled': config('AI_ANOMALY_DETECTION', default=True, cast=bool),
+    'window': 3600,
+    'user_requests': 120,
+    'ip_requests': 3 * IP_RATE_LIMIT,
+    'error_rate': 0.2,
+    'min_requests': 10,  # before the error rate counts
+    'block_seconds': 3600,
+    'rejection_interval': 1.0,  # seconds a worker holds refused requests before counting them
+}
+
+# Prometheus metrics (api/metrics.py), scraped from /metrics. Workers
+# write their values to `directory`, where files from earlier runs of the
+# service are deleted at the next scrape; None keeps them per process.
+METRICS = {
+    'directory': config('METRICS_DIR', default='/tmp/tailorhire_metrics'),
+    'flush_interval': 5.0,  # seconds
+    'allowed_networks': ['127.0.0.0/8', '::1/128', '10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16'],
+}
+
+# Query count/time per request for a random sample of requests, logged
+# when over a threshold or when one query repeats (api/query_stats.py).
+# Cheap enough to leave on at a low sample rate.
+QUERY_INSTRUMENTATION = {
+    'enabled': config('QUERY_INSTRUMENTATION', default=False, cast=bool),
+    'sample_rate': config('QUERY_INSTRUMENTATION_SAMPLE_RATE', default=0.01, cast=float),
+    'max_queries': 30,
+    'max_db_ms': 500,
+    'repeat_threshold': 10,  # same query fingerprint within one request
+    'server_timing': True,
+}
+
+# Sampled statistical profiles of chosen URLs (api/profiling.py), written
+# beside logs/ and read with `manage.py summarize_profiles`. `routes` maps
+# a URL name, or 'METHOD url-name', to N for 1-in-N sampling; ProfilingRule
+# rows in the admin add to it without a deploy.
+PROFILING = {
+    'enabled': config('PROFILING', default=False, cast=bool),
+    'directory': os.path.join(BASE_DIR, 'profiles'),
+    'interval': 0.005,  # seconds between stack samples
+    'max_files': 500,  # oldest are deleted beyond this
+    'rules_ttl': 60,  # seconds
+    'routes': {
+        'job-recommended': 100,
+        'POST cover-letter-list': 100,
+    },
+}
+
+# Per-worker memory of rate-limited keys, so floods are refused without Redis
+LOCAL_BLOCKLIST_MAX_KEYS = 10000
+
+# Where AI quota usage is counted: 'cache' (Redis counters, reconciled
+# into UserAIQuota by reconcile_ai_quotas) or 'database' (conditional
+# UPDATEs on UserAIQuota)
+AI_QUOTA_STORE = config('AI_QUOTA_STORE', default='cache')
+
+# Chat context cache: per-worker LRU in front of the shared Redis cache
+CHAT_CONTEXT_CACHE = {
+    'local_entries': 1000,
+    'local_ttl': 30,  # seconds
+    'ttl': 60 * 60 * 24,  # seconds, in Redis
+}
+
+# Total wall-clock budget for one AI request, measured from the first middleware.
+# Upstream timeouts are capped by what is left of it.
+AI_REQUEST_DEADLINE = config('AI_REQUEST_DEADLINE', default=45, cast=float)  # seconds
+# Time kept back for the fallback path, DB writes and serialization
+AI_DEADLINE_RESERVE = config('AI_DEADLINE_RESERVE', default=2, cast=float)  # seconds
+# Don't bother calling upstream with less than this left
+AI_MIN_UPSTREAM_TIMEOUT = 1  # seconds
+
+# Retries for transient upstream failures (429, 502-504, connection errors).
+# The budget allows at most `budget_ratio` extra calls per worker on top of
+# a small reserve, so retries cannot multiply load during an outage.
+AI_RETRY_POLICY = {
+    'max_attempts': 3,
+    'base_delay': 0.5,  # seconds, doubled per attempt before jitter
+    'max_delay': 8,  # seconds; longer Retry-After values are not waited for
+    'budget_ratio': 0.1,
+    'budget_reserve': 10,
+}
+
+# Hedged chat requests: if the first call is slower than `percentile` of
+# recent latencies, send a duplicate and use whichever answers first.
+# Until `min_samples` calls have been seen, `initial_delay` is used instead.
+AI_CHAT_HEDGING = {
+    'enabled': config('AI_CHAT_HEDGING', default=False, cast=bool),
+    'percentile': 95,
+    'min_samples': 50,
+    'initial_delay': 5,  # seconds
+    'max_hedge_rate': 0.05,  # at most ~5% extra upstream calls
+}
+
 #  ============================================
 # CHANNELS CONFIGURATION (WebSockets)
 # ============================================
@@ -325,16 +495,19 @@ os.makedirs(LOGS_DIR, exist_ok=True)
 # CRONJOBS = [
 #     # Reset Axes failed attempts every hour
 #     ('0 * * * *', 'axes.cron.reset_failed_login_attempts'),
-#     # Reset daily AI quotas at midnight
-#     ('0 0 * * *', 'api.cron.reset_daily_quotas'),
-#     # Reset monthly AI quotas on 1st of month
-#     ('0 0 1 * *', 'api.cron.reset_monthly_quotas'),
 #     # Check for suspicious activity every hour
 #     ('0 * * * *', 'api.cron.check_suspicious_activity'),
 #     # Clean old logs daily at 2 AM
 #     ('0 2 * * *', 'api.cron.clean_old_logs'),
 # ]
 
+CRONJOBS = [
+    # Flush Redis AI quota counters back to UserAIQuota
+    ('*/5 * * * *', 'django.core.management.call_command', ['reconcile_ai_quotas']),
+    # Create upcoming usage log partitions, drop expired ones
+    ('0 2 * * *', 'django.core.management.call_command', ['maintain_usage_logs']),
+]
+
 # ============================================
 # SECURITY SETTINGS
 # ============================================
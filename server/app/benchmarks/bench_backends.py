@@ -0,0 +1,69 @@
+"""
+Latency and throughput of each inference backend on the same workload
+
+Backends that can't run here are skipped: 'local' needs transformers
+(installed in the Dockerfile.ai image), 'remote' needs HUGGINGFACE_API_KEY.
+
+Usage (from server/app):
+    python -m benchmarks.bench_backends --backends mock local --requests 20
+"""
+import argparse
+import importlib.util
+import json
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from api.backends import BACKENDS, get_backend  # noqa: E402
+from api.utils import HuggingFaceAI  # noqa: E402
+
+CHAT_PROMPTS = [
+    'How should I prepare for a system design interview?',
+    'What should I put in the summary section of my resume?',
+    'How do I negotiate a higher salary for a senior role?',
+]
+
+JOB_DESCRIPTION = (
+    'We are hiring a backend engineer to design and operate Python services. '
+    'You will build REST APIs with Django, own PostgreSQL schemas and work '
+    'closely with product teams. Experience with Redis and Docker is a plus.'
+)
+
+
+def available(name):
+    if name == 'local':
+        return importlib.util.find_spec('transformers') is not None
+    if name == 'remote':
+        return bool(settings.HUGGINGFACE_API_KEY)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument('--requests', type=int, default=10)
+    args = parser.parse_args()
+
+    report = {}
+    for name in args.backends:
+        if not available(name):
+            print(f'skipping {name}: not available in this environment')
+            continue
+
+        backend = get_backend(name)
+        ai = HuggingFaceAI()
+        ai.backends = {'chat': backend, 'cover_letter': backend}
+        for i in range(args.requests):
+            ai.generate_chat_response(CHAT_PROMPTS[i % len(CHAT_PROMPTS)], hedge=False)
+            ai.generate_cover_letter('', JOB_DESCRIPTION, {'name': 'Sam', 'skills': 'Python, Django'})
+        report[name] = backend.report()
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Cache (Redis) traffic during a bot flood, with and without the local blocklist
+
+Replays a flood through the IP rate limit: a few bot IPs send most of
+the traffic, many normal IPs send the rest. Time is simulated at --rps
+requests per second. Reports how many requests reach the shared limiter
+(one Lua script call, i.e. one Redis round trip, each) and the implied
+Redis QPS with LocalBlocklist off and on.
+
+Usage (from server/app):
+    python -m benchmarks.bench_flood --requests 50000 --rps 2000
+"""
+import argparse
+import json
+import os
+import random
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+django.setup()
+
+from django.core.cache import cache  # noqa: E402
+from django.test import override_settings  # noqa: E402
+from api.limiters import LocalBlocklist, SlidingWindowLimiter  # noqa: E402
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+def run(name, requests, rps, bots, humans, bot_share, use_local):
+    rng = random.Random(7)
+    clock = SimulatedClock()
+    local = LocalBlocklist(clock=clock) if use_local else None
+    limiter = SlidingWindowLimiter(f'bench_flood_{use_local:d}', limit=20, window=3600, clock=clock, local=local)
+
+    shared_calls = 0
+    shared_hit = limiter._hit
+
+    def counted_hit(key):
+        nonlocal shared_calls
+        shared_calls += 1
+        return shared_hit(key)
+    limiter._hit = counted_hit
+
+    refused = 0
+    for _ in range(requests):
+        clock.now += 1 / rps
+        if rng.random() < bot_share:
+            ip = rng.choice(bots)
+        else:
+            ip = rng.choice(humans)
+        refused += not limiter.hit(ip)[0]
+
+    per_request = shared_calls / requests
+    return {
+        'name': name,
+        'refused': refused,
+        'shared_calls_per_request': round(per_request, 3),
+        'redis_qps': round(per_request * rps),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=50000)
+    parser.add_argument('--rps', type=int, default=2000)
+    parser.add_argument('--bots', type=int, default=50)
+    parser.add_argument('--humans', type=int, default=5000)
+    parser.add_argument('--bot-share', type=float, default=0.95)
+    args = parser.parse_args()
+
+    bots = [f'203.0.{i // 256 % 256}.{i % 256}' for i in range(args.bots)]
+    humans = [f'10.{i // 65536}.{i // 256 % 256}.{i % 256}' for i in range(args.humans)]
+
+    with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+        cache.clear()
+        results = [
+            run(name, args.requests, args.rps, bots, humans, args.bot_share, use_local)
+            for name, use_local in (('shared only', False), ('local blocklist', True))
+        ]
+        cache.clear()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
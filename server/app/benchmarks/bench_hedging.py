@@ -0,0 +1,112 @@
+"""
+Hedged vs. plain chat requests against a local mock upstream
+
+The mock answers most requests quickly but a small share very slowly,
+which is the long-tail shape we see from the inference API.
+
+Usage (from server/app):
+    python -m benchmarks.bench_hedging --requests 500
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+django.setup()
+
+from api.backends import RemoteHTTPBackend  # noqa: E402
+from api.hedging import Hedger  # noqa: E402
+from api.utils import HuggingFaceAI  # noqa: E402
+
+
+def skewed_latency(rng):
+    """90% fast, 8% medium, 2% very slow"""
+    roll = rng.random()
+    if roll < 0.90:
+        return rng.uniform(0.010, 0.030)
+    if roll < 0.98:
+        return rng.uniform(0.050, 0.150)
+    return rng.uniform(0.600, 1.000)
+
+
+class MockUpstream(BaseHTTPRequestHandler):
+    rng = random.Random(42)
+    rng_lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.rng_lock:
+            delay = skewed_latency(self.rng)
+        time.sleep(delay)
+        body = json.dumps([{'generated_text': 'User: hi\nBot: hello'}]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))]
+
+
+def run(ai, count, hedge):
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        ai.generate_chat_response('How should I prepare for interviews?', hedge=hedge)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--percentile', type=int, default=95)
+    parser.add_argument('--max-hedge-rate', type=float, default=0.1)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockUpstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    backend = RemoteHTTPBackend()
+    backend.api_url = f'http://127.0.0.1:{server.server_port}/'
+    backend.hedger = Hedger(
+        percentile=args.percentile,
+        min_samples=50,
+        initial_delay=0.2,
+        max_hedge_rate=args.max_hedge_rate,
+    )
+    ai = HuggingFaceAI()
+    ai.backends = {'chat': backend}
+
+    results = {
+        'plain': run(ai, args.requests, hedge=False),
+        'hedged': run(ai, args.requests, hedge=True),
+    }
+    server.shutdown()
+
+    print(f"{'mode':<8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for mode, latencies in results.items():
+        print(
+            f"{mode:<8}"
+            f"{percentile(latencies, 50) * 1000:>10.1f}"
+            f"{percentile(latencies, 95) * 1000:>10.1f}"
+            f"{percentile(latencies, 99) * 1000:>10.1f}"
+            f"{max(latencies) * 1000:>10.1f}"
+        )
+    print(f"hedge stats: {backend.hedger.stats.snapshot()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Per-request cost of the IP rate limit: timestamp list vs. sliding-window counter
+
+Replays AI requests from a pool of IPs through the old list-based check
+(kept here as `legacy_hit`) and through SlidingWindowLimiter, and reports
+time and cache operations per request and the bytes each keeps per IP in
+the cache, pickled and zlib-compressed as django_redis stores them.
+On Redis every cache operation is a network round trip and the sliding
+window is a single script call.
+
+Runs against LocMemCache by default; pass --redis to use the configured
+REDIS_URL instead.
+
+Usage (from server/app):
+    python -m benchmarks.bench_ip_limiter --requests 20000 --ips 50
+"""
+import argparse
+import json
+import os
+import pickle
+import random
+import time
+import zlib
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+django.setup()
+
+from django.core.cache import cache  # noqa: E402
+from django.test import override_settings  # noqa: E402
+from api import limiters  # noqa: E402
+from api.limiters import SlidingWindowLimiter  # noqa: E402
+
+
+def legacy_hit(ip, limit=20, window=3600):
+    """IPRateLimitMiddleware's check before the sliding-window counter"""
+    current_time = time.time()
+    cache_key = f'bench_legacy:{ip}'
+    request_times = cache.get(cache_key, [])
+    request_times = [t for t in request_times if current_time - t < window]
+    if len(request_times) >= limit:
+        return False
+    request_times.append(current_time)
+    cache.set(cache_key, request_times, window)
+    return True
+
+
+def stored_bytes(value):
+    return len(zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+
+
+class CountingCache:
+    """Counts cache operations (each is a network round trip on Redis)"""
+
+    METHODS = ('get', 'set', 'get_many', 'set_many', 'add', 'incr', 'decr')
+
+    def __init__(self):
+        self.ops = 0
+        self._depth = 0
+        self._originals = {}
+
+    def _wrap(self, fn):
+        def counted(*args, **kwargs):
+            # Only the outermost call: LocMemCache.get_many calls get per key
+            self.ops += self._depth == 0
+            self._depth += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._depth -= 1
+        return counted
+
+    def __enter__(self):
+        for name in self.METHODS:
+            self._originals[name] = getattr(cache, name)
+            setattr(cache, name, self._wrap(self._originals[name]))
+        self._script = limiters.SLIDING_WINDOW
+        limiters.SLIDING_WINDOW = self._wrap(self._script)
+        return self
+
+    def __exit__(self, *exc):
+        for name, fn in self._originals.items():
+            setattr(cache, name, fn)
+        limiters.SLIDING_WINDOW = self._script
+
+
+def run(name, hit, ips, requests, rng):
+    with CountingCache() as counter:
+        start = time.perf_counter()
+        allowed = 0
+        for _ in range(requests):
+            allowed += bool(hit(rng.choice(ips)))
+        elapsed = time.perf_counter() - start
+    return {
+        'name': name,
+        'us_per_request': round(elapsed / requests * 1e6, 2),
+        'cache_ops_per_request': round(counter.ops / requests, 2),
+        'allowed': allowed,
+    }
+
+
+def clear_bench_keys():
+    """
+    Delete the benchmark's own keys. With --redis this is the app's cache,
+    so cache.clear() (FLUSHDB) would take sessions, quotas and throttle
+    state with it.
+    """
+    if hasattr(cache, 'delete_pattern'):
+        for pattern in ('bench_legacy:*', 'bench_sliding:*'):
+            cache.delete_pattern(pattern)
+    else:
+        cache.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--ips', type=int, default=50)
+    parser.add_argument('--redis', action='store_true')
+    args = parser.parse_args()
+
+    ips = [f'10.0.{i // 256}.{i % 256}' for i in range(args.ips)]
+    limiter = SlidingWindowLimiter('bench_sliding', limit=20, window=3600)
+
+    caches = None if args.redis else {
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+    }
+    with override_settings(**({'CACHES': caches} if caches else {})):
+        clear_bench_keys()
+        results = [
+            run('timestamp list', legacy_hit, ips, args.requests, random.Random(1)),
+            run('sliding window', lambda ip: limiter.hit(ip)[0], ips, args.requests, random.Random(1)),
+        ]
+        results[0]['bytes_per_ip'] = stored_bytes(cache.get(f'bench_legacy:{ips[0]}'))
+        index = int(time.time() // limiter.window)
+        results[1]['bytes_per_ip'] = sum(
+            stored_bytes(cache.get(key, 0)) for key in limiter._keys(ips[0], index)
+        )
+        clear_bench_keys()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
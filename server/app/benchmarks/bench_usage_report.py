@@ -0,0 +1,133 @@
+"""
+ai_usage_report over a large generated AIUsageLog: raw-log queries vs. rollups
+
+Generates --rows usage logs spread over --days days in a throwaway SQLite
+database, then times:
+  - the report's former raw-log queries (count, two filtered counts, an
+    average and two GROUP BYs, each scanning the period again)
+  - exact p50/p95/p99 from raw rows (one ORDER BY ... OFFSET each)
+  - building the hourly rollups from raw logs (a one-off backfill)
+  - ai_usage_report --format json, one scan of the rollups
+and compares the sketch's percentiles with the exact ones.
+
+Usage (from server/app):
+    python -m benchmarks.bench_usage_report --rows 1000000 --days 30
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
+
+import django
+
+_db = tempfile.NamedTemporaryFile(suffix='.sqlite3', delete=False)
+os.environ['DATABASE_URL'] = f'sqlite:///{_db.name}'
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+django.setup()
+
+from django.core.management import call_command  # noqa: E402
+from django.db.models import Avg, Count  # noqa: E402
+from django.utils import timezone  # noqa: E402
+from api.models import AIUsageLog, AIUsageRollup, CustomUser  # noqa: E402
+from api.rollups import rebuild_rollups  # noqa: E402
+
+ENDPOINTS = ['create', 'recommended', 'generate_cover_letter']
+STATUSES = [201] * 90 + [200] * 5 + [429] * 3 + [500] * 2
+
+
+def generate(rows, days, users, rng):
+    people = CustomUser.objects.bulk_create([
+        CustomUser(username=f'bench{i}', email=f'bench{i}@example.com', password='!')
+        for i in range(users)
+    ])
+    # Each user comes from one address, as behind a home or office router
+    addresses = {person.pk: f'10.0.{i // 256 % 256}.{i % 256}' for i, person in enumerate(people)}
+    now = timezone.now()
+    batch = []
+    for _ in range(rows):
+        person = rng.choice(people)
+        batch.append(AIUsageLog(
+            user=person,
+            endpoint=rng.choice(ENDPOINTS),
+            duration=rng.lognormvariate(0, 0.6),
+            status_code=rng.choice(STATUSES),
+            ip_address=addresses[person.pk],
+            prompt_tokens=rng.randrange(100, 2000),
+            created_at=now - timedelta(seconds=rng.uniform(0, days * 86400)),
+        ))
+        if len(batch) == 20000:
+            AIUsageLog.objects.bulk_create(batch)
+            batch = []
+    AIUsageLog.objects.bulk_create(batch)
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def raw_report(start):
+    logs = AIUsageLog.objects.filter(created_at__gte=start)
+    return {
+        'total': logs.count(),
+        'successful': logs.filter(status_code=201).count(),
+        'failed': logs.exclude(status_code=201).count(),
+        'avg': logs.aggregate(Avg('duration'))['duration__avg'],
+        'top_users': list(logs.values('user__username').annotate(count=Count('id')).order_by('-count')[:10]),
+        'endpoints': list(logs.values('endpoint').annotate(count=Count('id'), avg=Avg('duration')).order_by('-count')),
+    }
+
+
+def raw_percentiles(start, total):
+    durations = AIUsageLog.objects.filter(created_at__gte=start).order_by('duration').values_list('duration', flat=True)
+    return {f'p{p}': durations[max(0, -(-p * total // 100) - 1)] for p in (50, 95, 99)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--users', type=int, default=100)
+    args = parser.parse_args()
+
+    try:
+        call_command('migrate', verbosity=0)
+        generate_seconds, _ = timed(lambda: generate(args.rows, args.days, args.users, random.Random(3)))
+
+        now = timezone.now()
+        start = now - timedelta(days=args.days)
+        raw_seconds, raw = timed(lambda: raw_report(start))
+        exact_seconds, exact = timed(lambda: raw_percentiles(start, raw['total']))
+        backfill_seconds, rollup_rows = timed(lambda: rebuild_rollups(start, now))
+
+        out = StringIO()
+        report_seconds, _ = timed(lambda: call_command(
+            'ai_usage_report', '--format', 'json', '--days', str(args.days), stdout=out
+        ))
+        report = json.loads(out.getvalue())
+
+        print(json.dumps({
+            'rows': args.rows,
+            'generate_seconds': round(generate_seconds, 1),
+            'raw_report_seconds': round(raw_seconds, 3),
+            'raw_percentiles_seconds': round(exact_seconds, 3),
+            'rollup_backfill_seconds': round(backfill_seconds, 3),
+            'rollup_rows': rollup_rows,
+            'rollup_report_seconds': round(report_seconds, 3),
+            'total_requests': {'raw': raw['total'], 'rollups': report['total_requests']},
+            'percentiles': {
+                key: {'exact': round(value, 3), 'sketch': round(report['duration_percentiles'][key], 3)}
+                for key, value in exact.items()
+            },
+        }, indent=2))
+    finally:
+        os.unlink(_db.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import pytest
+import uuid
 from datetime import timedelta
 from django.utils import timezone
 from django.urls import reverse
@@ -13,9 +14,16 @@ from api.throttling import (
     BurstRateThrottle,
     DailyAILimitThrottle,
     AnonymousStrictThrottle,
-    AIServiceThrottle
+    AIServiceThrottle,
+    CompositeRateThrottle
 )
+from api.middleware import IPRateLimitMiddleware
+from api.usage_log import usage_log_buffer
+from api.anomaly import anomaly_detector
+from api.redis_client import get_redis_client
+from api.metrics import registry as metrics_registry
 from api.models import Job
+from api.chat_context import chat_context_cache
 from django.core.cache import cache
 from django.test import override_settings
 
@@ -32,7 +40,20 @@ def _use_locmem_cache_for_tests():
             "default": {
                 "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
             }
-        }
+        },
+        # No background flush thread: it would write outside the test's transaction
+        AI_USAGE_LOG_BUFFER={
+            "enabled": True,
+            "batch_size": 100,
+            "flush_interval": None,
+            "max_pending": 10000,
+        },
+        # Per process, so tests don't share files with each other or a dev server
+        METRICS={
+            "directory": None,
+            "flush_interval": 5.0,
+            "allowed_networks": ["127.0.0.0/8"],
+        },
     ):
         yield
 
@@ -138,8 +159,39 @@ def daily_ai_throttle():
 def anon_strict_throttle():
     return make_throttle(AnonymousStrictThrottle, rate="5/hour")
 
+@pytest.fixture(params=["locmem", "redis"])
+def cache_backend(request, settings):
+    """
+    Runs the test twice: on LocMemCache, which takes the cache-API
+    fallbacks, and on django_redis over fakeredis, which runs the Lua
+    scripts the way Redis does
+    """
+    if request.param == "redis":
+        fakeredis = pytest.importorskip("fakeredis")
+        pytest.importorskip("lupa")
+        settings.CACHES = {
+            "default": {
+                "BACKEND": "django_redis.cache.RedisCache",
+                # Fresh server per test
+                "LOCATION": f"redis://fake-{uuid.uuid4().hex}:6379/0",
+                "OPTIONS": {"CONNECTION_POOL_KWARGS": {"connection_class": fakeredis.FakeRedisConnection}},
+            }
+        }
+        assert get_redis_client() is not None
+    yield request.param
+    cache.clear()
+
 @pytest.fixture(autouse=True)
 def clear_cache():
     cache.clear()
+    chat_context_cache.clear_local()
+    CompositeRateThrottle.local_blocklist.clear()
+    IPRateLimitMiddleware.limiter.local.clear()
+    metrics_registry.reset()
     yield
-    cache.clear()
\ No newline at end of file
+    cache.clear()
+    chat_context_cache.clear_local()
+    CompositeRateThrottle.local_blocklist.clear()
+    IPRateLimitMiddleware.limiter.local.clear()
+    usage_log_buffer.discard()
+    anomaly_detector.discard()
\ No newline at end of file
@@ -0,0 +1,515 @@
+import json
+import os
+import subprocess
+import time
+import pytest
+from django.http import HttpResponse
+from django.urls import reverse
+from io import StringIO
+from unittest.mock import patch
+from django.core.management import call_command
+from api import metrics
+from api.deadline import get_current_deadline
+from types import SimpleNamespace
+from api.anomaly import AnomalyDetector, block, blocked
+from api.middleware import (
+    DeadlineMiddleware,
+    IPRateLimitMiddleware,
+    MetricsMiddleware,
+    ProfilingMiddleware,
+    QueryInstrumentationMiddleware,
+    get_client_ip,
+)
+from api.models import Job, ProfilingRule
+from api.profiling import SamplingProfiler, profiling_rules, read_profile
+from api.query_stats import fingerprint
+from api.limiters import LocalBlocklist, SlidingWindowLimiter
+
+#########################
+# Deadline Middleware Tests
+#########################
+def test_deadline_set_for_ai_endpoints(factory, settings):
+    settings.AI_REQUEST_DEADLINE = 20
+    seen = {}
+
+    def get_response(request):
+        seen["deadline"] = get_current_deadline()
+        return HttpResponse()
+
+    middleware = DeadlineMiddleware(get_response)
+    request = factory.post("/api/chat/")
+    middleware(request)
+
+    assert seen["deadline"] is request.deadline
+    assert 0 < request.deadline.remaining() <= 20
+    # Scope is cleared once the response is returned
+    assert get_current_deadline() is None
+
+def test_no_deadline_for_other_endpoints(factory):
+    seen = {}
+
+    def get_response(request):
+        seen["deadline"] = get_current_deadline()
+        return HttpResponse()
+
+    middleware = DeadlineMiddleware(get_response)
+    request = factory.get("/api/jobs/")
+    middleware(request)
+
+    assert request.deadline is None
+    assert seen["deadline"] is None
+
+
+#########################
+# IP Rate Limit Tests
+#########################
+class FakeClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def test_limiter_allows_up_to_limit_in_a_window(cache_backend):
+    clock = FakeClock(1000.0)
+    limiter = SlidingWindowLimiter("test_limit", limit=3, window=60, clock=clock)
+
+    results = [limiter.hit("1.2.3.4")[0] for _ in range(4)]
+
+    assert results == [True, True, True, False]
+    # Other keys are counted separately
+    assert limiter.hit("5.6.7.8")[0]
+
+def test_limiter_weights_previous_window(cache_backend):
+    clock = FakeClock(60.0)
+    limiter = SlidingWindowLimiter("test_limit", limit=4, window=60, clock=clock)
+    for _ in range(4):
+        limiter.hit("ip")
+
+    # A third of the way into the next window, two thirds of those still count
+    clock.now = 140.0
+    assert limiter.hit("ip")[0]
+    assert limiter.hit("ip")[0]
+    allowed, retry_after = limiter.hit("ip")
+
+    assert not allowed
+    # 4 * 2/3 + 2 drops below 4 once 10 more seconds of the old window expire
+    assert retry_after == pytest.approx(10)
+
+def test_limiter_resets_after_two_windows(cache_backend):
+    clock = FakeClock(0.0)
+    limiter = SlidingWindowLimiter("test_limit", limit=2, window=60, clock=clock)
+    limiter.hit("ip")
+    limiter.hit("ip")
+
+    clock.now = 120.0
+
+    assert limiter.hit("ip") == (True, 0)
+
+def test_refused_hits_are_not_counted(cache_backend):
+    clock = FakeClock(0.0)
+    limiter = SlidingWindowLimiter("test_limit", limit=1, window=60, clock=clock)
+    limiter.hit("ip")
+    for _ in range(5):
+        limiter.hit("ip")
+
+    clock.now = 90.0  # previous window weighted 0.5: 1 * 0.5 < 1
+
+    assert limiter.hit("ip")[0]
+
+@pytest.mark.parametrize("cache_backend", ["redis"], indirect=True)
+def test_limiter_script_counters_expire_after_two_windows(cache_backend):
+    from django.core.cache import cache
+    from api.redis_client import get_redis_client
+    limiter = SlidingWindowLimiter("test_limit", limit=2, window=60, clock=FakeClock(30.0))
+    limiter.hit("ip")
+
+    _, current = limiter._keys("ip", 0)
+    assert 60 < get_redis_client().ttl(cache.make_key(current)) <= 120
+
+def test_ip_rate_limit_middleware_blocks_after_20(factory, cache_backend):
+    middleware = IPRateLimitMiddleware(lambda request: HttpResponse())
+    statuses = [
+        middleware(factory.post("/api/chat/", REMOTE_ADDR="10.0.0.1")).status_code
+        for _ in range(21)
+    ]
+
+    assert statuses == [200] * 20 + [429]
+    blocked = middleware(factory.post("/api/chat/", REMOTE_ADDR="10.0.0.1"))
+    assert int(blocked["Retry-After"]) > 0
+    # Non-AI endpoints and other IPs are unaffected
+    assert middleware(factory.get("/api/jobs/", REMOTE_ADDR="10.0.0.1")).status_code == 200
+    assert middleware(factory.post("/api/chat/", REMOTE_ADDR="10.0.0.2")).status_code == 200
+
+def test_local_blocklist_refuses_without_cache(monkeypatch):
+    clock = FakeClock(0.0)
+    limiter = SlidingWindowLimiter("test_limit", limit=2, window=60, clock=clock, local=LocalBlocklist(clock=clock))
+    limiter.hit("ip")
+    limiter.hit("ip")
+    allowed, retry_after = limiter.hit("ip")
+    assert not allowed
+
+    calls = []
+    monkeypatch.setattr("api.limiters.cache.get_many", lambda *a, **k: calls.append(a) or {})
+    for _ in range(10):
+        assert limiter.hit("ip")[0] is False
+    assert calls == []
+
+    # Once the wait is over the shared counter decides again
+    clock.now = retry_after + 61
+    monkeypatch.undo()
+    assert limiter.hit("ip")[0] is True
+
+def test_local_blocklist_is_bounded():
+    blocklist = LocalBlocklist(max_keys=2)
+    for key in ("a", "b", "c"):
+        blocklist.block(key, 60)
+
+    assert blocklist.retry_after("a") is None
+    assert blocklist.retry_after("c") > 0
+
+#########################
+# Anomaly Detection Tests
+#########################
+def log(user_id=1, ip="203.0.113.7", status_code=201):
+    return SimpleNamespace(user_id=user_id, ip_address=ip, status_code=status_code)
+
+def test_detector_blocks_user_over_request_threshold(settings, cache_backend):
+    settings.AI_ANOMALY_DETECTION = {**settings.AI_ANOMALY_DETECTION, "user_requests": 5, "ip_requests": 100}
+    detector = AnomalyDetector(clock=FakeClock(1800))
+
+    assert detector.observe([log(ip=f"10.0.0.{i}") for i in range(4)]) == []
+    flagged = detector.observe([log(ip="10.0.0.9")])
+
+    assert [(kind, value) for kind, value, _ in flagged] == [("user", 1)]
+    assert "5 requests" in blocked("user", 1)["reason"]
+    # Already blocked: not flagged (or logged) again
+    assert detector.observe([log(ip="10.0.0.10")]) == []
+
+def test_detector_blocks_ip_on_error_rate(settings, cache_backend):
+    settings.AI_ANOMALY_DETECTION = {**settings.AI_ANOMALY_DETECTION, "min_requests": 10, "error_rate": 0.2}
+    detector = AnomalyDetector(clock=FakeClock(1800))
+
+    # Throttled and rejected requests aren't errors
+    assert detector.observe([log(user_id=i, status_code=429) for i in range(5)] + [log(user_id=5, status_code=400)]) == []
+    batch = [log(user_id=i, status_code=201) for i in range(4)] + [log(user_id=i, status_code=502) for i in range(3)]
+    flagged = detector.observe(batch)
+
+    assert [(kind, value) for kind, value, _ in flagged] == [("ip", "203.0.113.7")]
+    assert "error rate 23%" in blocked("ip", "203.0.113.7")["reason"]
+
+def test_detector_window_slides(settings, cache_backend):
+    settings.AI_ANOMALY_DETECTION = {**settings.AI_ANOMALY_DETECTION, "user_requests": 10, "ip_requests": 100}
+    clock = FakeClock(3599)
+    detector = AnomalyDetector(clock=clock)
+    detector.observe([log() for _ in range(8)])
+
+    # Half way through the next window the 8 weigh as 4
+    clock.now = 3600 + 1800
+    assert detector.observe([log() for _ in range(5)]) == []
+    assert detector.observe([log() for _ in range(1)]) == [("user", 1, "10 requests in the last 3600s (limit 10)")]
+
+@pytest.mark.parametrize("cache_backend", ["redis"], indirect=True)
+def test_detector_script_counters_expire(settings, cache_backend):
+    from django.core.cache import cache
+    from api.redis_client import get_redis_client
+    detector = AnomalyDetector(clock=FakeClock(1800))
+    detector.observe([log(status_code=502)])
+
+    client = get_redis_client()
+    for name in ("requests", "errors"):
+        key = cache.make_key(f"anomaly:user:1:{name}:0")
+        assert int(client.get(key)) == 1
+        # Kept for two windows: the previous window still weighs in during the next
+        assert 3600 < client.ttl(key) <= 7200
+
+def test_detector_disabled(settings):
+    settings.AI_ANOMALY_DETECTION = {**settings.AI_ANOMALY_DETECTION, "enabled": False, "user_requests": 1}
+    assert AnomalyDetector().observe([log()]) == []
+
+def test_ip_rate_limit_middleware_refuses_blocked_ip(factory):
+    calls = []
+    middleware = IPRateLimitMiddleware(lambda request: calls.append(request) or HttpResponse())
+    block("ip", "203.0.113.7", 600, "test")
+
+    res = middleware(factory.post("/api/chat/", REMOTE_ADDR="203.0.113.7"))
+
+    assert res.status_code == 429
+    assert 590 <= int(res["Retry-After"]) <= 600
+    assert calls == []
+    assert middleware(factory.post("/api/chat/", REMOTE_ADDR="203.0.113.8")).status_code == 200
+
+def test_detector_counts_requests_refused_by_throttles(auth_client, user, settings, monkeypatch):
+    settings.AI_ANOMALY_DETECTION = {**settings.AI_ANOMALY_DETECTION, "user_requests": 4, "rejection_interval": 0}
+    monkeypatch.setattr("api.views.ai_helper.generate_chat_response", lambda *a, **k: "Reply")
+    url = reverse("chat-message-list")
+
+    # 5 let through by the burst throttle (not flushed to the detector yet), then refused
+    codes = [auth_client.post(url, {"message": "Hi"}, format="json").status_code for _ in range(9)]
+
+    assert codes == [201] * 5 + [429] * 4
+    assert "4 requests" in blocked("user", user.pk)["reason"]
+
+def test_detector_counts_requests_refused_by_ip_limit(factory, settings, cache_backend):
+    settings.AI_ANOMALY_DETECTION = {**settings.AI_ANOMALY_DETECTION, "ip_requests": 3, "rejection_interval": 0}
+    middleware = IPRateLimitMiddleware(lambda request: HttpResponse())
+
+    for _ in range(IPRateLimitMiddleware.limiter.limit + 3):
+        middleware(factory.post("/api/chat/", REMOTE_ADDR="203.0.113.9"))
+
+    assert blocked("ip", "203.0.113.9") is not None
+    assert json.loads(middleware(factory.post("/api/chat/", REMOTE_ADDR="203.0.113.9")).content)["error"] == "Access suspended"
+
+def test_detector_holds_rejections_until_interval(settings, cache_backend):
+    settings.AI_ANOMALY_DETECTION = {**settings.AI_ANOMALY_DETECTION, "user_requests": 2, "rejection_interval": 1.0}
+    clock = FakeClock(1800)
+    detector = AnomalyDetector(clock=clock)
+
+    detector.reject(1, "203.0.113.7")
+    detector.reject(1, "203.0.113.7")
+    assert blocked("user", 1) is None
+    clock.now += 1
+    detector.reject(1, "203.0.113.7")
+    assert blocked("user", 1) is not None
+
+def test_detector_thresholds_above_throttle_rates(settings):
+    hourly = sum(
+        int(settings.REST_FRAMEWORK["DEFAULT_THROTTLE_RATES"][scope].split("/")[0])
+        for scope in ("chat_message", "cover_letter", "job_recommendation")
+    )
+    assert settings.AI_ANOMALY_DETECTION["user_requests"] > hourly
+    assert settings.AI_ANOMALY_DETECTION["ip_requests"] > IPRateLimitMiddleware.limiter.limit
+
+def test_client_ip_ignores_forwarded_for_from_untrusted_peer(factory, settings):
+    settings.TRUSTED_PROXIES = []
+    assert get_client_ip(factory.get("/", HTTP_X_FORWARDED_FOR="198.51.100.2", REMOTE_ADDR="203.0.113.7")) == "203.0.113.7"
+
+def test_client_ip_from_trusted_proxy(factory, settings):
+    settings.TRUSTED_PROXIES = ["10.0.0.0/8"]
+    # The right-most hop that isn't a proxy; anything left of it is the client's say-so
+    forwarded = "1.2.3.4, 198.51.100.2, 10.0.0.5"
+    assert get_client_ip(factory.get("/", HTTP_X_FORWARDED_FOR=forwarded, REMOTE_ADDR="10.0.0.1")) == "198.51.100.2"
+    assert get_client_ip(factory.get("/", HTTP_X_FORWARDED_FOR="evil", REMOTE_ADDR="10.0.0.1")) == "10.0.0.1"
+    assert get_client_ip(factory.get("/", REMOTE_ADDR="10.0.0.1")) == "10.0.0.1"
+
+#########################
+# Metrics Tests
+#########################
+def test_histogram_renders_cumulative_buckets():
+    registry = metrics.Registry()
+    latency = registry.register(metrics.Histogram(registry, "test_seconds", "Test", ["route"], buckets=(0.1, 1.0)))
+    for value in (0.05, 0.5, 0.5, 3):
+        latency.observe(value, route="a")
+
+    lines = registry.render().splitlines()
+
+    assert "# TYPE test_seconds histogram" in lines
+    assert 'test_seconds_bucket{route="a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{route="a",le="1.0"} 3' in lines
+    assert 'test_seconds_bucket{route="a",le="+Inf"} 4' in lines
+    assert 'test_seconds_sum{route="a"} 4.05' in lines
+    assert 'test_seconds_count{route="a"} 4' in lines
+
+def test_label_values_are_escaped():
+    registry = metrics.Registry()
+    things = registry.register(metrics.Counter(registry, "test_total", "Test", ["name"]))
+    things.inc(name='say "hi"\n')
+
+    assert 'test_total{name="say \\"hi\\"\\n"} 1' in registry.render()
+
+def test_metrics_summed_across_workers(settings, tmp_path):
+    settings.METRICS = {**settings.METRICS, "directory": str(tmp_path)}
+    boot = metrics.boot_id()
+    # Another worker's last flush, and one from before the service restarted
+    (tmp_path / f"{boot}-1-100.json").write_text(json.dumps([
+        ["tailorhire_throttle_rejections_total", ["quota"], 2],
+        ["tailorhire_ai_fallbacks_total", ["chat"], 1],
+    ]))
+    (tmp_path / "0.0-1-50.json").write_text(json.dumps([
+        ["tailorhire_throttle_rejections_total", ["quota"], 40],
+    ]))
+    metrics.THROTTLE_REJECTIONS.inc(throttle="quota")
+
+    rendered = metrics.render()
+
+    assert 'tailorhire_throttle_rejections_total{throttle="quota"} 3' in rendered
+    assert 'tailorhire_ai_fallbacks_total{feature="chat"} 1' in rendered
+    names = {path.name for path in tmp_path.iterdir()}
+    assert f"{boot}-1-100.json" in names and "0.0-1-50.json" not in names
+    own, = names - {f"{boot}-1-100.json"}
+    assert own.startswith(f"{boot}-{os.getpid()}-")
+
+def test_metrics_of_exited_workers_merged_into_one_file(settings, tmp_path):
+    settings.METRICS = {**settings.METRICS, "directory": str(tmp_path)}
+    boot = metrics.boot_id()
+    exited = []
+    for _ in range(2):
+        process = subprocess.Popen(["true"])
+        process.wait()
+        exited.append(process.pid)
+    for i, pid in enumerate(exited):
+        (tmp_path / f"{boot}-{pid}-{i}.json").write_text(json.dumps([
+            ["tailorhire_throttle_rejections_total", ["quota"], 2],
+        ]))
+
+    first = metrics.render()
+    # A later recycled worker is folded into the same file
+    (tmp_path / f"{boot}-{exited[0]}-9.json").write_text(json.dumps([
+        ["tailorhire_throttle_rejections_total", ["quota"], 5],
+    ]))
+    second = metrics.render()
+
+    assert 'tailorhire_throttle_rejections_total{throttle="quota"} 4' in first
+    assert 'tailorhire_throttle_rejections_total{throttle="quota"} 9' in second
+    names = {path.name for path in tmp_path.glob("*.json")}
+    own, = names - {f"{boot}-merged.json"}
+    assert own.startswith(f"{boot}-{os.getpid()}-")
+    # Only the latest merge's names are remembered, until the next one
+    assert json.loads((tmp_path / f"{boot}-merged.json").read_text())["merged"] == [f"{boot}-{exited[0]}-9.json"]
+
+def test_metrics_middleware_labels_by_route(factory):
+    middleware = MetricsMiddleware(lambda request: HttpResponse(status=404))
+    middleware(factory.get("/no/such/page"))
+    middleware(factory.generic("BREW", "/no/such/page"))
+
+    rendered = metrics.render()
+
+    assert (
+        'tailorhire_http_request_duration_seconds_count{method="GET",route="unmatched",status="404"} 1'
+        in rendered
+    )
+    assert 'method="other",route="unmatched"' in rendered
+
+@pytest.mark.django_db
+def test_metrics_view_serves_exposition_format(client):
+    client.get(reverse("metrics"))
+    res = client.get(reverse("metrics"))
+
+    assert res.status_code == 200
+    assert res["Content-Type"].startswith("text/plain; version=0.0.4")
+    # The first scrape, timed by MetricsMiddleware under its URL pattern
+    assert (
+        'tailorhire_http_request_duration_seconds_count{method="GET",route="metrics",status="200"} 1'
+        in res.content.decode()
+    )
+
+@pytest.mark.django_db
+def test_metrics_view_internal_only(client):
+    assert client.get(reverse("metrics"), REMOTE_ADDR="203.0.113.7").status_code == 404
+    assert client.get(reverse("metrics"), HTTP_X_FORWARDED_FOR="203.0.113.7").status_code == 404
+
+#########################
+# Query Instrumentation Tests
+#########################
+def test_fingerprint_strips_literals():
+    assert fingerprint('SELECT * FROM "api_job" WHERE "api_job"."id" = 3') == 'SELECT * FROM "api_job" WHERE "api_job"."id" = ?'
+    assert fingerprint("SELECT 1 FROM t WHERE a = 'it''s' AND b IN (%s, %s,  %s)") == "SELECT ? FROM t WHERE a = ? AND b IN (...)"
+    assert fingerprint('SELECT * FROM "t1" WHERE x = %s') == fingerprint('SELECT * FROM "t1" WHERE x = 42')
+
+def instrumented(settings, get_response, **config):
+    settings.QUERY_INSTRUMENTATION = {
+        **settings.QUERY_INSTRUMENTATION, "enabled": True, "sample_rate": 1.0, **config
+    }
+    return QueryInstrumentationMiddleware(get_response)
+
+@pytest.mark.django_db
+def test_query_instrumentation_logs_repeated_queries(settings, factory, job):
+    def get_response(request):
+        # One query per row, as an N+1 would
+        for _ in range(5):
+            Job.objects.filter(pk=job.pk).first()
+        return HttpResponse()
+
+    middleware = instrumented(settings, get_response, repeat_threshold=5, max_queries=100)
+    with patch("api.middleware.logger") as logger:
+        res = middleware(factory.get("/no/such/page"))
+
+    assert res["Server-Timing"].startswith("db;dur=")
+    assert res["Server-Timing"].endswith('desc="5 queries"')
+    message = logger.warning.call_args[0][0]
+    assert "GET unmatched (/no/such/page): 5 queries" in message
+    assert '5x SELECT "api_job"."id"' in message
+    assert 'tailorhire_db_queries_per_request_count{route="unmatched"} 1' in metrics.render()
+
+@pytest.mark.django_db
+def test_query_instrumentation_quiet_under_thresholds(settings, factory, job):
+    def get_response(request):
+        Job.objects.filter(pk=job.pk).first()
+        return HttpResponse()
+
+    middleware = instrumented(settings, get_response)
+    with patch("api.middleware.logger") as logger:
+        res = middleware(factory.get("/"))
+
+    assert res["Server-Timing"].endswith('desc="1 queries"')
+    logger.warning.assert_not_called()
+
+def test_query_instrumentation_unsampled(settings, factory):
+    middleware = instrumented(settings, lambda request: HttpResponse(), sample_rate=0)
+    assert not middleware(factory.get("/")).has_header("Server-Timing")
+
+#########################
+# Profiling Tests
+#########################
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+def test_sampling_profiler_records_stacks():
+    profiler = SamplingProfiler(0.001).start()
+    busy_wait(0.05)
+    stacks = profiler.stop()
+
+    assert sum(stacks.values()) > 5
+    assert any(stack.endswith("tests.test_middleware:busy_wait") for stack in stacks)
+    assert profiler.duration >= 0.05
+
+@pytest.fixture
+def profiling(settings, tmp_path):
+    settings.PROFILING = {
+        **settings.PROFILING, "enabled": True, "directory": str(tmp_path), "interval": 0.001, "routes": {}
+    }
+    profiling_rules.clear()
+    yield tmp_path
+    profiling_rules.clear()
+
+@pytest.mark.django_db
+def test_profiling_middleware_samples_ruled_routes(profiling, factory):
+    ProfilingRule.objects.create(url_name="job-recommended", method="GET", sample_every=1)
+    middleware = ProfilingMiddleware(lambda request: busy_wait(0.02) or HttpResponse())
+
+    middleware(factory.get("/api/jobs/recommended/"))
+    middleware(factory.post("/api/jobs/recommended/"))
+    middleware(factory.get("/api/jobs/"))
+
+    (path,) = profiling.iterdir()
+    meta, stacks = read_profile(path)
+    assert meta["url_name"] == "job-recommended"
+    assert meta["method"] == "GET"
+    assert meta["status"] == "200"
+    assert any("busy_wait" in stack for stack in stacks)
+
+@pytest.mark.django_db
+def test_profiles_rotate(profiling, settings, factory):
+    settings.PROFILING = {**settings.PROFILING, "max_files": 2, "routes": {"job-list": 1}}
+    middleware = ProfilingMiddleware(lambda request: HttpResponse())
+    for _ in range(4):
+        middleware(factory.get("/api/jobs/"))
+
+    assert len(list(profiling.iterdir())) == 2
+
+@pytest.mark.django_db
+def test_summarize_profiles(profiling, settings, factory, tmp_path_factory):
+    settings.PROFILING = {**settings.PROFILING, "routes": {"job-list": 1, "job-recommended": 1}}
+    ProfilingMiddleware(lambda request: busy_wait(0.03) or HttpResponse())(factory.get("/api/jobs/"))
+    ProfilingMiddleware(lambda request: HttpResponse())(factory.get("/api/jobs/recommended/"))
+    merged = tmp_path_factory.mktemp("merged") / "merged.folded"
+
+    out = StringIO()
+    call_command("summarize_profiles", "--url-name", "job-list", "--output", str(merged), stdout=out)
+
+    output = out.getvalue()
+    assert "=== 1 Profiles," in output
+    assert "tests.test_middleware:busy_wait" in output
+    assert merged.read_text().strip()
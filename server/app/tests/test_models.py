@@ -1,9 +1,11 @@
 import pytest
 import django.db
-from api.models import CustomUser, Job, SavedJob, CoverLetter, Application, ChatMessage
+from api.models import CustomUser, Job, SavedJob, CoverLetter, Application, ChatMessage, UserAIQuota
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.exceptions import ValidationError
 from decimal import Decimal
+from datetime import timedelta
+from django.utils import timezone
 
 #########################
 # Custom User Model Tests
@@ -479,4 +481,46 @@ class TestChatMessageModel:
         """created_at should be automatically populated on creation"""
         chat_message = ChatMessage.objects.create(user=user, message="Hello")
 
-        assert chat_message.created_at is not None
\ No newline at end of file
+        assert chat_message.created_at is not None
+
+#########################
+# User AI Quota Tests
+#########################
+@pytest.mark.django_db
+class TestUserAIQuotaModel:
+
+    def make_quota(self, user, last_reset_date, **fields):
+        quota = UserAIQuota.objects.create(user=user, **fields)
+        UserAIQuota.objects.filter(pk=quota.pk).update(last_reset_date=last_reset_date)
+        quota.refresh_from_db()
+        return quota
+
+    def test_usage_from_today_counts(self, user):
+        quota = self.make_quota(user, timezone.localdate(), daily_usage=5, monthly_usage=20)
+
+        assert quota.current_daily_usage == 5
+        assert quota.current_monthly_usage == 20
+
+    def test_stale_day_reads_as_zero_without_a_reset(self, user):
+        today = timezone.localdate()
+        yesterday = today - timedelta(days=1)
+        quota = self.make_quota(user, yesterday, daily_usage=50, monthly_usage=60, daily_limit=50)
+
+        assert quota.current_daily_usage == 0
+        assert quota.current_monthly_usage == (60 if yesterday.month == today.month else 0)
+        assert quota.can_make_request()
+
+    def test_stale_month_reads_as_zero(self, user):
+        quota = self.make_quota(user, timezone.localdate() - timedelta(days=40), daily_usage=3, monthly_usage=900)
+
+        assert quota.current_daily_usage == 0
+        assert quota.current_monthly_usage == 0
+
+    def test_increment_rolls_the_period_first(self, user):
+        quota = self.make_quota(user, timezone.localdate() - timedelta(days=40), daily_usage=3, monthly_usage=900)
+
+        quota.increment_usage()
+        quota.refresh_from_db()
+
+        assert (quota.daily_usage, quota.monthly_usage) == (1, 1)
+        assert quota.last_reset_date == timezone.localdate()
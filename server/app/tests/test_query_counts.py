@@ -0,0 +1,168 @@
+import os
+import time
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.test import APIClient
+from api.models import Application, ChatMessage, CoverLetter, CustomUser, Job, SavedJob
+
+# Pinned per endpoint: the most queries a request may run, and its time
+# budget in seconds for each page size. A list is a COUNT plus one SELECT
+# for the page; anything per row is an N+1 and fails here. The time
+# budgets are about 10x what the requests take on a laptop, to catch a
+# lost index or an N+1 that slips past the query cap (e.g. in Python),
+# not noise. QUERY_BUDGET_TIME_SCALE stretches them on slow machines; 0
+# only reports the times (the `seconds` property in --junitxml output).
+LIST_BUDGETS = {
+    # url name: (queries, {page size: seconds})
+    "job-list": (2, {20: 0.5, 100: 1.0}),
+    "saved-job-list": (2, {20: 0.5, 100: 1.0}),
+    "cover-letter-list": (2, {20: 0.5, 100: 1.0}),
+    "application-list": (2, {20: 0.5, 100: 1.0}),
+    "chat-message-list": (2, {20: 0.25, 100: 0.5}),
+}
+DETAIL_BUDGETS = {
+    # url name: (queries, seconds)
+    "job-detail": (1, 0.25),
+    "saved-job-detail": (1, 0.25),
+    "cover-letter-detail": (1, 0.25),
+    "application-detail": (1, 0.25),
+    "chat-message-detail": (1, 0.25),
+}
+TIME_SCALE = float(os.environ.get("QUERY_BUDGET_TIME_SCALE", 1))
+
+#########################
+# Query Count Tests
+#########################
+@pytest.fixture(scope="module")
+def seeded(django_db_setup, django_db_blocker):
+    """
+    Realistic volumes: 2000 jobs from 20 posters, 2000 applications from
+    other users, and a few hundred of each kind of row for the returned
+    user. Seeded once for the module, outside the tests' transactions, and
+    deleted afterwards.
+    """
+    with django_db_blocker.unblock():
+        user, users, jobs = seed()
+    yield user
+    with django_db_blocker.unblock():
+        Job.objects.filter(pk__in=[job.pk for job in jobs]).delete()
+        CustomUser.objects.filter(pk__in=[u.pk for u in users]).delete()
+
+def seed():
+    user = CustomUser.objects.create_user(username="recruiter", email="test@test.com", password="pass1234")
+    posters = CustomUser.objects.bulk_create([
+        CustomUser(username=f"poster{i}", email=f"poster{i}@example.com", password="!")
+        for i in range(20)
+    ])
+    jobs = Job.objects.bulk_create([
+        Job(
+            title=f"Engineer {i}",
+            company=f"Company {i % 50}",
+            location="Remote",
+            description="Build things",
+            requirements=["Python", "Django"],
+            posted_by=posters[i % len(posters)],
+        )
+        for i in range(2000)
+    ])
+    applicants = CustomUser.objects.bulk_create([
+        CustomUser(username=f"applicant{i}", email=f"applicant{i}@example.com", password="!")
+        for i in range(200)
+    ])
+    Application.objects.bulk_create(
+        [Application(user=applicant, job=jobs[(i * 10 + j) % len(jobs)])
+         for i, applicant in enumerate(applicants) for j in range(10)]
+        + [Application(user=user, job=job) for job in jobs[:300]]
+    )
+    SavedJob.objects.bulk_create([SavedJob(user=user, job=job) for job in jobs[:300]])
+    CoverLetter.objects.bulk_create([
+        CoverLetter(user=user, job=job, job_description="Build things", generated_letter="Dear team")
+        for job in jobs[:300]
+    ])
+    ChatMessage.objects.bulk_create([
+        ChatMessage(user=user, message=f"Question {i}", response="Answer") for i in range(300)
+    ])
+    return user, [user, *posters, *applicants], jobs
+
+def request(client, url):
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        res = client.get(url)
+        elapsed = time.perf_counter() - start
+    assert res.status_code == 200
+    return res, len(queries), elapsed
+
+def check_time(record_property, url_name, elapsed, budget):
+    record_property("seconds", round(elapsed, 4))
+    if TIME_SCALE:
+        assert elapsed < budget * TIME_SCALE, f"{url_name} took {elapsed:.3f}s (budget {budget * TIME_SCALE:.3f}s)"
+
+def client_for(user, staff):
+    # A fresh copy: the seeded user is shared, and the save is rolled back with the test
+    user = CustomUser.objects.get(pk=user.pk)
+    if staff:
+        user.is_staff = True
+        user.save()
+    client = APIClient()
+    client.force_authenticate(user=user)
+    return client
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("page_size", [20, 100])
+@pytest.mark.parametrize("url_name, staff", [
+    ("job-list", False),
+    ("saved-job-list", False),
+    ("cover-letter-list", False),
+    ("application-list", False),
+    # Staff see every application
+    ("application-list", True),
+    ("chat-message-list", False),
+])
+def test_list_query_count(seeded, monkeypatch, record_property, url_name, staff, page_size):
+    monkeypatch.setattr(PageNumberPagination, "page_size", page_size)
+    client = client_for(seeded, staff)
+
+    max_queries, seconds = LIST_BUDGETS[url_name]
+
+    res, queries, elapsed = request(client, reverse(url_name))
+
+    assert len(res.data["results"]) == page_size
+    assert queries <= max_queries, f"{url_name} ran {queries} queries for a page of {page_size}"
+    check_time(record_property, url_name, elapsed, seconds[page_size])
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("url_name, model", [
+    ("job-detail", Job),
+    ("saved-job-detail", SavedJob),
+    ("cover-letter-detail", CoverLetter),
+    ("application-detail", Application),
+    ("chat-message-detail", ChatMessage),
+])
+def test_detail_query_count(seeded, record_property, url_name, model):
+    client = client_for(seeded, staff=False)
+    if model is Job:
+        pk = Job.objects.values_list("pk", flat=True).first()
+    else:
+        pk = model.objects.filter(user=seeded).values_list("pk", flat=True).first()
+
+    max_queries, seconds = DETAIL_BUDGETS[url_name]
+
+    _, queries, elapsed = request(client, reverse(url_name, args=[pk]))
+
+    assert queries <= max_queries, f"{url_name} ran {queries} queries"
+    check_time(record_property, url_name, elapsed, seconds)
+
+@pytest.mark.django_db
+def test_application_page_joins_related_rows(seeded):
+    client = client_for(seeded, staff=True)
+
+    with CaptureQueriesContext(connection) as queries:
+        client.get(reverse("application-list"))
+
+    # The COUNT, then the page with its job, poster and applicant joined in
+    page = queries.captured_queries[-1]["sql"]
+    assert 'JOIN "api_job"' in page
+    assert page.count('JOIN "api_customuser"') == 2
@@ -6,9 +6,17 @@ from pathlib import Path
 from api import models
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from io import StringIO
 import pytest
 import json
 from .test_utils import HuggingFaceAI
+from api.backends import MockBackend
+from api.chat_context import chat_context_cache
+from api.usage_log import usage_log_buffer
+from api.anomaly import block
 ai_helper = HuggingFaceAI()
 
 #########################
@@ -418,6 +426,22 @@ class TestCoverLetterAPI:
 
         assert res.status_code == status.HTTP_201_CREATED
         assert models.CoverLetter.objects.first().job == job
+
+    def test_failed_save_releases_reservation_once(self, auth_client, user, monkeypatch):
+        from api.backends import get_backend
+        from api.quota import quota_counter
+        # A fallback letter releases its unit; the failed save must not release it again
+        monkeypatch.setattr(get_backend("remote"), "generate", lambda *a, **k: None)
+        monkeypatch.setattr(models.CoverLetter.objects, "create", lambda **kwargs: 1 / 0)
+        payload = {
+            "job_description": "We are looking for a Backend Developer with strong experience in Python and Django to join our growing team.",
+            "resume_text": "Python developer"
+        }
+
+        res = auth_client.post(reverse("cover-letter-list"), payload, format="json")
+
+        assert res.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+        assert quota_counter.usage([user.pk])[user.pk] == (0, 0)
         
 #########################
 # Application Views Tests
@@ -585,6 +609,54 @@ class TestChatMessageAPI:
         assert models.ChatMessage.objects.count() == 1
         assert models.ChatMessage.objects.first().user == user
 
+    def test_prompt_tokens_logged(self, auth_client, user, monkeypatch):
+        monkeypatch.setattr("api.views.ai_helper.backends", {"chat": MockBackend()})
+
+        res = auth_client.post(reverse("chat-message-list"), {"message": "Any resume tips?"}, format="json")
+
+        assert res.status_code == status.HTTP_201_CREATED
+        usage_log_buffer.flush()
+        log = models.AIUsageLog.objects.get(user=user)
+        assert log.prompt_tokens > 0
+        assert log.request_data == {"backend": "mock"}
+
+    def test_usage_log_is_written_in_batches(self, auth_client, user, monkeypatch):
+        monkeypatch.setattr("api.views.ai_helper.generate_chat_response", lambda *a, **k: "Reply")
+        url = reverse("chat-message-list")
+
+        with CaptureQueriesContext(connection) as ctx:
+            auth_client.post(url, {"message": "Hi"}, format="json")
+
+        assert not any("api_aiusagelog" in q["sql"] for q in ctx.captured_queries)
+        assert usage_log_buffer.pending() == 1
+        assert usage_log_buffer.flush() == 1
+        assert models.AIUsageLog.objects.get(user=user).endpoint == "create"
+
+    def test_flush_updates_hourly_rollup(self, auth_client, user, monkeypatch):
+        monkeypatch.setattr("api.views.ai_helper.generate_chat_response", lambda *a, **k: "Reply")
+        url = reverse("chat-message-list")
+
+        auth_client.post(url, {"message": "Hi"}, format="json")
+        auth_client.post(url, {"message": "Hello"}, format="json")
+        usage_log_buffer.flush()
+
+        rollup = models.AIUsageRollup.objects.get(user=user)
+        assert rollup.endpoint == "create"
+        assert rollup.status_class == 2
+        assert rollup.count == 2
+
+    def test_blocked_user_is_refused(self, auth_client, user, monkeypatch):
+        calls = []
+        monkeypatch.setattr("api.views.ai_helper.generate_chat_response", lambda *a, **k: calls.append(a) or "Reply")
+        block("user", user.pk, 600, "test")
+
+        res = auth_client.post(reverse("chat-message-list"), {"message": "Hi"}, format="json")
+
+        assert res.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+        assert res.data["error"] == "Access suspended"
+        assert int(res["Retry-After"]) > 0
+        assert calls == []
+
     def test_missing_message_returns_400(self, auth_client):
         url = reverse("chat-message-list")
         res = auth_client.post(url, {}, format="json")
@@ -607,30 +679,113 @@ class TestChatMessageAPI:
         assert len(results) == 1
         assert results[0]["message"] == "Hi"
 
-    def test_conversation_history_passed_in_chronological_order(
+    def test_prompt_gets_summary_and_latest_exchange(
         self, auth_client, user, monkeypatch
     ):
-        """View must pass prior messages oldest-first, so recent context is intact"""
-        for i in range(5):
-            models.ChatMessage.objects.create(
-                user=user, message=f"Question {i}", response=f"Answer {i}"
-            )
+        """Older turns reach the prompt through the summary, only the latest verbatim"""
+        captured = {}
+
+        def mock_generate(message_text, conversation_history=None, summary=""):
+            captured["conversation_history"] = conversation_history
+            captured["summary"] = summary
+            return f"Answer to {message_text}"
+
+        monkeypatch.setattr("api.views.ai_helper.generate_chat_response", mock_generate)
+
+        for i in range(4):
+            res = auth_client.post(reverse("chat-message-list"), {"message": f"Question {i}"}, format="json")
+            assert res.status_code == status.HTTP_201_CREATED
+
+        history = captured["conversation_history"]
+        assert history == [{"message": "Question 2", "response": "Answer to Question 2"}]
+        assert "Question 0" in captured["summary"]
+        assert "Question 1" in captured["summary"]
+        assert models.ChatSummary.objects.get(user=user).turn_count == 4
+
+    def test_summary_seeded_from_existing_history(self, auth_client, user, monkeypatch):
+        for i in range(3):
+            models.ChatMessage.objects.create(user=user, message=f"Old {i}", response=f"Reply {i}")
 
         captured = {}
 
-        def mock_generate(message_text, conversation_history=None):
+        def mock_generate(message_text, conversation_history=None, summary=""):
             captured["conversation_history"] = conversation_history
             return "New response"
 
         monkeypatch.setattr("api.views.ai_helper.generate_chat_response", mock_generate)
 
-        res = auth_client.post(reverse("chat-message-list"), {"message": "Question 5"}, format="json")
+        auth_client.post(reverse("chat-message-list"), {"message": "New"}, format="json")
 
-        assert res.status_code == status.HTTP_201_CREATED
-        history = captured["conversation_history"]
-        assert len(history) == 5
-        assert history[0]["message"] == "Question 0"   # oldest first
-        assert history[-1]["message"] == "Question 4"  # most recent last
+        assert captured["conversation_history"] == [{"message": "Old 2", "response": "Reply 2"}]
+
+    def test_chat_turn_cost_constant_with_history(
+        self, auth_client, user, monkeypatch
+    ):
+        monkeypatch.setattr("api.views.ai_helper.generate_chat_response", lambda *a, **k: "Reply")
+        url = reverse("chat-message-list")
+
+        auth_client.post(url, {"message": "Warm up"}, format="json")
+        with CaptureQueriesContext(connection) as early:
+            auth_client.post(url, {"message": "Second"}, format="json")
+
+        for i in range(20):
+            auth_client.post(url, {"message": f"Filler {i}"}, format="json")
+        with CaptureQueriesContext(connection) as late:
+            auth_client.post(url, {"message": "Much later"}, format="json")
+
+        assert len(late.captured_queries) == len(early.captured_queries)
+
+    def test_warm_turn_reads_context_from_cache(self, auth_client, user, monkeypatch):
+        monkeypatch.setattr("api.views.ai_helper.generate_chat_response", lambda *a, **k: "Reply")
+        url = reverse("chat-message-list")
+
+        auth_client.post(url, {"message": "First"}, format="json")
+        with CaptureQueriesContext(connection) as ctx:
+            auth_client.post(url, {"message": "Second"}, format="json")
+
+        selects = [
+            q["sql"] for q in ctx.captured_queries
+            if q["sql"].startswith("SELECT") and ("api_chatsummary" in q["sql"] or "api_chatmessage" in q["sql"])
+        ]
+        assert selects == []
+
+    def test_stale_cached_context_does_not_lose_turns(self, auth_client, user, monkeypatch):
+        """A worker holding an outdated copy must not overwrite a newer turn"""
+        monkeypatch.setattr("api.views.ai_helper.generate_chat_response", lambda *a, **k: "Reply")
+        url = reverse("chat-message-list")
+
+        auth_client.post(url, {"message": "First"}, format="json")
+        stale = chat_context_cache.get(user.pk)
+
+        auth_client.post(url, {"message": "Second"}, format="json")
+        chat_context_cache.set(user.pk, stale)  # as if this worker missed the second turn
+        auth_client.post(url, {"message": "Third"}, format="json")
+
+        chat_summary = models.ChatSummary.objects.get(user=user)
+        assert chat_summary.turn_count == 3
+        assert "Second" in chat_summary.summary
+        assert chat_summary.recent_exchanges[-1]["message"] == "Third"
+
+    def test_deleted_message_leaves_the_context(self, auth_client, user, monkeypatch):
+        captured = {}
+
+        def mock_generate(message_text, conversation_history=None, summary=""):
+            captured["context"] = f"{summary} {conversation_history}"
+            return "Reply"
+
+        monkeypatch.setattr("api.views.ai_helper.generate_chat_response", mock_generate)
+        url = reverse("chat-message-list")
+        for message in ("Secret", "Public"):
+            auth_client.post(url, {"message": message}, format="json")
+        secret = models.ChatMessage.objects.get(user=user, message="Secret")
+
+        res = auth_client.delete(reverse("chat-message-detail", args=[secret.pk]))
+        assert res.status_code == status.HTTP_204_NO_CONTENT
+        assert chat_context_cache.get(user.pk) is None
+
+        auth_client.post(url, {"message": "Next"}, format="json")
+        assert "Secret" not in captured["context"]
+        assert "Public" in captured["context"]
 
     def test_response_is_not_settable_by_client(self, auth_client, monkeypatch):
         def mock_generate(*args, **kwargs):
@@ -667,4 +822,32 @@ class TestChatMessageAPI:
         )
 
         res = auth_client.post(reverse("chat-message-list"), {"message": "Hello"}, format="json")
-        assert res.status_code == status.HTTP_429_TOO_MANY_REQUESTS
\ No newline at end of file
+        assert res.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+
+    def test_usage_is_counted_without_saving_quota_row(self, auth_client, user, monkeypatch):
+        monkeypatch.setattr("api.views.ai_helper.generate_chat_response", lambda *a, **k: "Reply")
+        models.UserAIQuota.objects.create(user=user, daily_limit=2)
+        url = reverse("chat-message-list")
+
+        codes = [auth_client.post(url, {"message": "Hi"}, format="json").status_code for _ in range(3)]
+
+        assert codes == [201, 201, 429]
+        # The row only changes when the counters are reconciled
+        assert models.UserAIQuota.objects.get(user=user).daily_usage == 0
+        call_command("reconcile_ai_quotas", stdout=StringIO())
+        assert models.UserAIQuota.objects.get(user=user).daily_usage == 2
+
+    def test_fallback_reply_is_not_charged(self, auth_client, user, monkeypatch):
+        from api.backends import get_backend
+        monkeypatch.setattr(get_backend("remote"), "generate", lambda *a, **k: None)
+        models.UserAIQuota.objects.create(user=user, daily_limit=1)
+        url = reverse("chat-message-list")
+
+        codes = [auth_client.post(url, {"message": "Hi"}, format="json").status_code for _ in range(3)]
+
+        # Every reply fell back, so the single-request limit is never used up
+        assert codes == [201, 201, 201]
+        call_command("reconcile_ai_quotas", stdout=StringIO())
+        assert models.UserAIQuota.objects.get(user=user).daily_usage == 0
+        usage_log_buffer.flush()
+        assert models.AIUsageLog.objects.filter(request_data__fallback=True).count() == 3
\ No newline at end of file
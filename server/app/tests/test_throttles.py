@@ -2,6 +2,8 @@ import pytest
 from rest_framework.exceptions import Throttled
 from django.contrib.auth.models import AnonymousUser
 from api.models import CustomUser
+from django.core.cache import cache
+from unittest.mock import patch
 
 # ── Helpers ────────────────────────────────────────────────────────────────────
 
@@ -183,3 +185,196 @@ def test_daily_ai_wait_is_within_day(factory, daily_ai_throttle, db):
     daily_ai_throttle.allow_request(req, None)
     assert 0 < daily_ai_throttle.wait() <= 86400
     
+
+
+# ── CompositeRateThrottle ──────────────────────────────────────────────────────
+
+def make_composite(*rates):
+    """Composite over BurstRateThrottle-style scopes with the given rates"""
+    from api.throttling import CompositeRateThrottle, BurstRateThrottle
+    classes = [
+        type(f"Scope{i}", (BurstRateThrottle,), {"scope": f"scope_{i}", "rate": rate})
+        for i, rate in enumerate(rates)
+    ]
+    return CompositeRateThrottle(classes)
+
+def test_composite_blocks_on_tightest_scope(factory, db, cache_backend):
+    req = make_auth_request(factory, make_user("composite_user"))
+    composite = make_composite("3/min", "10/hour")
+
+    results = [composite.allow_request(req, None) for _ in range(4)]
+
+    assert results == [True, True, True, False]
+    assert 0 < composite.wait() <= 60
+
+def test_composite_wait_is_longest_refusing_scope(factory, db, cache_backend):
+    req = make_auth_request(factory, make_user("composite_wait_user"))
+    composite = make_composite("2/min", "2/hour")
+    exhaust_throttle(composite, req, 2)
+
+    assert composite.allow_request(req, None) is False
+    # Both scopes are full; only the hourly one decides when the next request fits
+    assert 60 < composite.wait() <= 3600
+
+def test_composite_does_not_record_refused_requests(factory, db):
+    req = make_auth_request(factory, make_user("composite_refused_user"))
+    composite = make_composite("1/min", "5/hour")
+    composite.allow_request(req, None)
+    for _ in range(3):
+        composite.allow_request(req, None)
+
+    hourly = make_composite("1/min", "5/hour").throttles[1]
+    history = cache.get(hourly.get_cache_key(req, None))
+    assert len(history) == 1
+
+@pytest.mark.parametrize("cache_backend", ["redis"], indirect=True)
+def test_composite_script_records_only_allowed_requests(factory, db, cache_backend):
+    from api.redis_client import get_redis_client
+    client = get_redis_client()
+    req = make_auth_request(factory, make_user("composite_script_user"))
+    composite = make_composite("1/min", "5/hour")
+    composite.allow_request(req, None)
+    composite.local_blocklist.clear()
+    assert make_composite("1/min", "5/hour").allow_request(req, None) is False
+
+    minute, hourly = (cache.make_key(f"{t.get_cache_key(req, None)}:log") for t in composite.throttles)
+    # The refused request wasn't added to either window, and the windows expire with their duration
+    assert (client.zcard(minute), client.zcard(hourly)) == (1, 1)
+    assert 0 < client.ttl(minute) <= 60
+    assert 60 < client.ttl(hourly) <= 3600
+
+def test_composite_uses_one_read_and_one_write(factory, db):
+    req = make_auth_request(factory, make_user("composite_calls_user"))
+    composite = make_composite("5/min", "10/hour", "50/day")
+
+    with patch.object(cache, "get_many", wraps=cache.get_many) as get_many, \
+            patch.object(cache, "set_many", wraps=cache.set_many) as set_many:
+        composite.allow_request(req, None)
+
+    # One batched read and one batched write for all three scopes
+    assert get_many.call_count == 1
+    assert set_many.call_count == 1
+
+def test_chat_create_is_throttled_by_composite(auth_client, user, monkeypatch, cache_backend):
+    from django.urls import reverse
+    monkeypatch.setattr("api.views.ai_helper.generate_chat_response", lambda *a, **k: "Reply")
+    url = reverse("chat-message-list")
+
+    codes = [auth_client.post(url, {"message": "Hi"}, format="json").status_code for _ in range(6)]
+
+    # BurstRateThrottle is the tightest scope at 5/min
+    assert codes == [201] * 5 + [429]
+
+
+# ── TokenBucketThrottle ────────────────────────────────────────────────────────
+
+def make_bucket(now=1000.0):
+    from api.throttling import BurstTokenBucketThrottle
+    bucket = BurstTokenBucketThrottle()
+    bucket.timer = lambda: now
+    return bucket
+
+def test_bucket_allows_burst_then_refills(factory, db, cache_backend):
+    req = make_auth_request(factory, make_user("bucket_user"))
+    bucket = make_bucket(1000.0)
+
+    results = [bucket.allow_request(req, None) for _ in range(6)]
+
+    # Free plan: 5 tokens, one more every 12 seconds
+    assert results == [True] * 5 + [False]
+    assert bucket.wait() == pytest.approx(12)
+
+    bucket.timer = lambda: 1012.0
+    assert bucket.allow_request(req, None) is True
+    assert bucket.allow_request(req, None) is False
+
+def test_premium_plan_gets_bigger_burst(factory, db, cache_backend):
+    from api.models import UserAIQuota
+    user = make_user("premium_bucket_user")
+    UserAIQuota.objects.create(user=user, is_premium=True)
+    req = make_auth_request(factory, user)
+    bucket = make_bucket()
+
+    results = [bucket.allow_request(req, None) for _ in range(21)]
+
+    assert results == [True] * 20 + [False]
+    # Premium refills at 30/min
+    assert bucket.wait() == pytest.approx(2)
+
+def test_plan_lookup_is_cached(factory, db, django_assert_num_queries):
+    from api.throttling import get_user_plan, invalidate_user_plan
+    from api.models import UserAIQuota
+    user = make_user("plan_cache_user")
+    quota = UserAIQuota.objects.create(user=user)
+
+    with django_assert_num_queries(1):
+        assert get_user_plan(user) == "free"
+        assert get_user_plan(user) == "free"
+
+    quota.is_premium = True
+    quota.save()
+    assert get_user_plan(user) == "free"
+    invalidate_user_plan([user.pk])
+    assert get_user_plan(user) == "premium"
+
+def test_make_premium_invalidates_filtered_users(factory, db):
+    from django.contrib.admin.sites import site
+    from api.models import UserAIQuota
+    from api.throttling import get_user_plan
+    user = make_user("filtered_premium_user")
+    UserAIQuota.objects.create(user=user)
+    assert get_user_plan(user) == "free"
+
+    # As when the changelist is filtered by is_premium=False
+    queryset = UserAIQuota.objects.filter(is_premium=False)
+    model_admin = site._registry[UserAIQuota]
+    with patch.object(model_admin, "message_user"):
+        model_admin.make_premium(factory.get("/"), queryset)
+
+    assert get_user_plan(user) == "premium"
+
+def test_parse_rate():
+    from api.throttling import parse_rate
+    assert parse_rate("5/min") == (5, 60)
+    assert parse_rate("1000/day") == (1000, 86400)
+    assert parse_rate("30/hour") == (30, 3600)
+
+def test_composite_mixes_windows_and_buckets(factory, db, settings):
+    from api.throttling import CompositeRateThrottle, BurstTokenBucketThrottle, DailyAILimitThrottle
+    # Only the throttle's own cache reads
+    settings.AI_ANOMALY_DETECTION = {**settings.AI_ANOMALY_DETECTION, "enabled": False}
+    req = make_auth_request(factory, make_user("mixed_user"))
+    composite = CompositeRateThrottle([BurstTokenBucketThrottle, DailyAILimitThrottle])
+    composite.timer = lambda: 1000.0
+
+    with patch.object(cache, "get_many", wraps=cache.get_many) as get_many:
+        results = [composite.allow_request(req, None) for _ in range(6)]
+
+    assert results == [True] * 5 + [False]
+    assert get_many.call_count == 6
+    # The refused request took no token and wasn't added to the daily window
+    daily = DailyAILimitThrottle()
+    assert len(cache.get(daily.get_cache_key(req, None))) == 5
+
+def test_premium_user_not_stopped_by_free_burst(auth_client, user, monkeypatch, cache_backend):
+    from django.urls import reverse
+    from api.models import UserAIQuota
+    UserAIQuota.objects.create(user=user, is_premium=True)
+    monkeypatch.setattr("api.views.ai_helper.generate_chat_response", lambda *a, **k: "Reply")
+    url = reverse("chat-message-list")
+
+    codes = [auth_client.post(url, {"message": "Hi"}, format="json").status_code for _ in range(8)]
+
+    assert codes == [201] * 8
+
+def test_composite_refusals_are_remembered_locally(factory, db):
+    req = make_auth_request(factory, make_user("local_block_user"))
+    composite = make_composite("2/min")
+    exhaust_throttle(composite, req, 2)
+    assert composite.allow_request(req, None) is False
+
+    with patch.object(cache, "get_many", wraps=cache.get_many) as get_many:
+        for _ in range(10):
+            assert make_composite("2/min").allow_request(req, None) is False
+
+    assert get_many.call_count == 0